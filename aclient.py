@@ -0,0 +1,201 @@
+# aclient.py
+# asyncio-based client: a single event loop can drive many connections, each using two tasks
+# (receiver and heartbeat) instead of the three threads used by client.BackboneClient.
+import asyncio
+import json
+import time
+from uuid import UUID
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import codec
+import frame
+from client import BackboneClient
+from message import BackboneMessageC2S as MsgC2S, BackboneMessageC2C as MsgC2C, BackboneMessageFormat as MsgFormat, BackboneC2SType as MsgC2SType, BackboneMessage
+
+
+class AsyncBackboneClient:
+    def __init__(self, client_id:UUID, key:rsa.RSAPrivateKey) -> None:
+        self.id  = client_id
+        self.key = key
+        self.settings = None
+
+        self._reader = None
+        self._writer = None
+        self._session = None
+        self._frame_version = 1
+        self._max_frame_size = None
+        self._compression = None
+        self._messages_in = None
+        self._tasks = []
+        self._last_send = 0
+        # Set when the server reports that a recipient's queue is full:
+        self.throttled = asyncio.Event()
+        # Credit for sending C2C messages, if the server limits the number of messages in flight:
+        self._credit = None
+
+    # Connects to the server and completes the challenge, returns False if authentication failed.
+    async def start(self, address:str, port:int=4000) -> bool:
+        if self.is_running():
+            return False
+
+        self._reader, self._writer = await asyncio.open_connection(address, port)
+
+        # Same handshake as BackboneClient._run:
+        response, server_public_key, session = BackboneClient._respond(await frame.read_async(self._reader), self.id, self.key)
+        await frame.send_async(self._writer, response, server_public_key)
+        result = await frame.read_async(self._reader, session)
+
+        settings = BackboneClient._read_config(result)
+        if settings == None:
+            print(f"{self.id}-master: Invalid response received from server, assuming authentication failed.")
+            self._writer.close()
+            self._writer = None
+            return False
+
+        self.settings = settings
+        self._session = session
+        self._frame_version  = settings["frame_version"] if "frame_version" in settings else 1
+        self._max_frame_size = settings["max_frame_size"] if "max_frame_size" in settings else None
+
+        self._compression    = codec.select(settings["compression"]) if "compression" in settings else None
+
+        # Messages are sent as they come, but the server may send us batches:
+        options = BackboneClient._client_options(settings)
+        if len(options) > 0:
+            await frame.send_async(self._writer, MsgC2S(MsgC2SType.CONFIG, payload=json.dumps(options).encode(encoding='utf-8')).to_bytes(), session, self._frame_version)
+        self._credit = asyncio.Semaphore(settings["credit_window"]) if "credit" in options else None
+        self._messages_in = asyncio.Queue()
+        self._last_send = time.monotonic()
+        self._tasks = [
+            asyncio.create_task(self._receiver()),
+            asyncio.create_task(self._heartbeat())
+        ]
+        return True
+
+    async def stop(self) -> bool:
+        if not self.is_running():
+            return False
+
+        try:
+            await self.send(MsgC2S(MsgC2SType.STOP))
+        except Exception as e:
+            print(f"{self.id}-master: Failed to send STOP message to server: {e}")
+
+        self._close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        return True
+
+    def is_running(self) -> bool:
+        return self._writer != None and not self._writer.is_closing()
+
+    async def send(self, msg:BackboneMessage) -> None:
+        if not self.is_running():
+            raise ConnectionError("Client is not connected.")
+
+        # Wait for the server to return credit before sending more messages than it allows:
+        if self._credit != None and msg.format == MsgFormat.C2C:
+            await self._credit.acquire()
+
+        # Each frame is written with a single call, so concurrent senders can't interleave:
+        await frame.send_async(self._writer, codec.compress_message(msg.to_bytes(), self._compression), self._session, self._frame_version, self._max_frame_size)
+        self._last_send = time.monotonic()
+
+    # Joins a group, C2C messages addressed to the group ID are then delivered to this client as well.
+    async def subscribe(self, group_id:UUID) -> None:
+        await self.send(MsgC2S(MsgC2SType.SUBSCRIBE, payload=group_id.bytes))
+
+    async def unsubscribe(self, group_id:UUID) -> None:
+        await self.send(MsgC2S(MsgC2SType.UNSUBSCRIBE, payload=group_id.bytes))
+
+    # Waits for the next message from the server, returns None once the connection has closed.
+    async def read(self) -> MsgC2C | None:
+        if self._messages_in == None:
+            return None
+        if not self.is_running() and self._messages_in.empty():
+            return None
+        return await self._messages_in.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> MsgC2C:
+        msg = await self.read()
+        if msg == None:
+            raise StopAsyncIteration
+        return msg
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def _close(self):
+        for task in self._tasks:
+            if task != asyncio.current_task():
+                task.cancel()
+        if self._writer != None:
+            self._writer.close()
+        # Wake anyone waiting in read:
+        if self._messages_in != None:
+            self._messages_in.put_nowait(None)
+
+    async def _receiver(self):
+        prefix = f"{self.id}-receive: "
+        try:
+            while True:
+                msg_b = await frame.read_async(self._reader, self._session, self._frame_version)
+
+                if msg_b == None:
+                    continue
+
+                msg = BackboneMessage.from_bytes(codec.decompress_message(msg_b, self._compression))
+                if msg == None:
+                    print(f"{prefix}Failed to parse data as a message: {msg_b}")
+                    continue
+
+                # The server may batch C2S messages (e.g. CREDIT) along with C2C messages:
+                for msg in (msg.messages if msg.format == MsgFormat.BATCH else [msg]):
+                    match msg.format:
+                        case MsgFormat.C2C:
+                            self._messages_in.put_nowait(msg)
+                        case MsgFormat.C2S:
+                            match msg.type:
+                                case MsgC2SType.STOP:
+                                    print(f"{prefix}Received a STOP message from the server. Reason was: {msg.payload}")
+                                    return
+                                case MsgC2SType.CONFIG:
+                                    try:
+                                        BackboneClient._update_settings(self.settings, json.loads(msg.payload))
+                                    except Exception as e:
+                                        print(f"{prefix}Failed to update settings: {e}")
+                                case MsgC2SType.THROTTLE:
+                                    print(f"{prefix}Server is throttling messages: {msg.payload}")
+                                    self.throttled.set()
+                                case MsgC2SType.CREDIT:
+                                    if self._credit != None:
+                                        for _ in range(int.from_bytes(msg.payload)):
+                                            self._credit.release()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"{prefix}Connection closed: {e}")
+        finally:
+            self._close()
+
+    async def _heartbeat(self):
+        while True:
+            heartbeat_interval = self.settings["heartbeat_interval"] if "heartbeat_interval" in self.settings else 30
+            remaining = heartbeat_interval - (time.monotonic() - self._last_send)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                continue
+
+            try:
+                await self.send(MsgC2S(MsgC2SType.HEARTBEAT))
+            except Exception as e:
+                print(f"{self.id}-heartbeat: Failed to send heartbeat: {e}")
+                self._close()
+                return
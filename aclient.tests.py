@@ -0,0 +1,71 @@
+from tempfile import TemporaryDirectory
+import asyncio
+import time
+import random
+import unittest
+from uuid import uuid4
+
+import key
+from identity import IdentityComponent
+from aclient import AsyncBackboneClient
+from server import BackboneServer
+from message import BackboneMessageC2C as MsgC2C
+
+class TestAsyncBackboneClient(unittest.TestCase):
+    def test_creation(self):
+        AsyncBackboneClient(uuid4(), key.generate())
+
+    def test_c2c(self):
+        print()
+
+        client_id1  = uuid4()
+        client_key1 = key.generate()
+        client_id2  = uuid4()
+        client_key2 = key.generate()
+        port        = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id1, client_key1.public_key())
+            auth.add_client_key(client_id2, client_key2.public_key())
+
+            backbone_server = BackboneServer(settings={ "port": port }, identities=auth)
+
+            async def run():
+                client1 = AsyncBackboneClient(client_id1, client_key1)
+                client2 = AsyncBackboneClient(client_id2, client_key2)
+
+                self.assertTrue(await client1.start("127.0.0.1", port))
+                self.assertTrue(await client2.start("127.0.0.1", port))
+                # The handlers register their queues after the clients are ready:
+                await asyncio.sleep(0.2)
+                self.assertTrue(client1.is_running())
+
+                async with client1, client2:
+                    msg1 = MsgC2C(client_id1, b'loopback')
+                    await client1.send(msg1)
+                    self.assertEqual(await asyncio.wait_for(client1.read(), 3), msg1)
+
+                    msgs = [MsgC2C(client_id2, f'client1->client2 #{i}'.encode()) for i in range(5)]
+                    await asyncio.gather(*[client1.send(msg) for msg in msgs])
+
+                    received = []
+                    async for msg in client2:
+                        received.append(msg)
+                        if len(received) == len(msgs):
+                            break
+                    self.assertEqual(received, msgs)
+
+                self.assertFalse(client1.is_running(), "Leaving the context should stop the client.")
+                self.assertIsNone(await client1.read(), "read should return None once the client has stopped.")
+
+            try:
+                backbone_server.start()
+                time.sleep(0.2)
+                asyncio.run(run())
+            finally:
+                backbone_server.stop(block=True)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,375 @@
+# aserver.py
+# asyncio-based server engine: each client is served by a pair of tasks on a single event loop,
+# instead of the three threads used by handle.ClientHandler.
+import asyncio
+import functools
+import json
+import threading
+import time
+import traceback
+from uuid import UUID
+
+from identity import Identity, IdentityComponent, ChallengeFailed
+from server import BackboneServer
+from handle import ClientHandler
+import handle
+import frame
+from spool import Spool
+from message import BackboneMessage, BackboneMessageC2S as MsgC2S, BackboneC2SType as MsgC2SType, BackboneMessageFormat as MsgFormat, BackboneS2SType as MsgS2SType, BackboneMessageS2S as MsgS2S
+
+# Client queue for the asyncio engine, with the same limits and policies as handle.ClientQueue. Every client
+# shares the event loop, so senders never wait for room: the "block" policy drops the new message instead.
+class AsyncClientQueue(asyncio.Queue):
+    def __init__(self, limit:int=0, policy:str="drop_newest") -> None:
+        if policy not in handle.QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy '{policy}', expected one of: {', '.join(handle.QUEUE_POLICIES)}")
+        super().__init__()
+        self.limit = limit
+        self.policy = policy
+        self.high_water = 0
+        self.dropped = 0
+        self.overflowed = False
+
+    # Adds a routed message, returns False if the message (or the recipient) was dropped because the queue was full.
+    # on_taken is called once the message has left the queue, whether it was read, dropped or the queue was closed.
+    # It isn't called if offer returns False.
+    def offer(self, msg:BackboneMessage, on_taken=None) -> bool:
+        if 0 < self.limit <= self.qsize():
+            match self.policy:
+                case "drop_oldest":
+                    # Messages from the server (e.g. STOP) are never dropped:
+                    if not isinstance(self._queue[0], tuple) and self._queue[0].format != MsgFormat.C2C:
+                        self.dropped += 1
+                        return False
+                    self.get_nowait()
+                    self.dropped += 1
+                case "disconnect":
+                    if not self.overflowed:
+                        self.overflowed = True
+                        self.put_nowait(MsgS2S(MsgS2SType.STOP, payload=b'queue limit exceeded'))
+                    self.dropped += 1
+                    return False
+                case _:
+                    self.dropped += 1
+                    return False
+
+        self.put_nowait(msg if on_taken == None else (msg, on_taken))
+        self.high_water = max(self.high_water, self.qsize())
+        return True
+
+    # get waits for an item and then calls get_nowait, so this covers both.
+    def get_nowait(self) -> BackboneMessage:
+        item = super().get_nowait()
+        if isinstance(item, tuple):
+            item[1]()
+            return item[0]
+        return item
+
+    # Empties the queue once its handler has stopped, so that callbacks for messages that will never be read are still made.
+    def close(self):
+        while not self.empty():
+            self.get_nowait()
+
+
+class AsyncBackboneServer(BackboneServer):
+    # Uses the same settings, identities and start/stop interface as BackboneServer.
+
+    # Connections are cleaned up by their tasks as they finish, so the supervisor isn't used. Running
+    # as a worker of a cluster isn't supported, so there's no relay either.
+    @staticmethod
+    def _run(stop_flag:threading.Event, auth:IdentityComponent, settings:dict, supervisor=None, relay=None, ready_flag:threading.Event=None):
+        if relay != None:
+            raise ValueError("The asyncio server can't run as a worker of a cluster.")
+        asyncio.run(AsyncBackboneServer._serve(stop_flag, auth, settings, ready_flag))
+
+    @staticmethod
+    async def _serve(stop_flag:threading.Event, auth:IdentityComponent, settings:dict, ready_flag:threading.Event=None):
+        next_connection_id = 1
+        # Client queues, keyed by the raw bytes of the client ID. Only touched from the event loop, so no locking is needed:
+        queues = {}
+        # Group subscriptions, keyed by the raw bytes of the group ID, each holding the raw IDs of its members:
+        groups = {}
+        connections = set()
+
+        port              = settings["port"] if "port" in settings else 4000
+        challenge_size    = settings["challenge_size"] if "challenge_size" in settings else 2048
+        handshake_timeout = settings["handshake_timeout"] if "handshake_timeout" in settings else 10
+        handshake_backlog = settings["handshake_backlog"] if "handshake_backlog" in settings else 64
+        max_frame_size    = settings["max_frame_size"] if "max_frame_size" in settings else None
+        spool             = BackboneServer._open_spool(settings, auth)
+        handle.set_spool(spool)
+        BackboneServer._set_queue_limits(settings)
+
+        async def on_connection(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+            nonlocal next_connection_id
+            connection_id = next_connection_id
+            next_connection_id += 1
+            connections.add(asyncio.current_task())
+
+            print(f"{connection_id}: New connection from {writer.get_extra_info('peername')}")
+
+            try:
+                try:
+                    client = await asyncio.wait_for(auth.challenge_async(reader, writer, challenge_size, settings["client"], max_frame_size), handshake_timeout)
+                    print(f"{connection_id}: challenge met for client {client.id}")
+                except ChallengeFailed as e:
+                    print(f"{connection_id}: Challenge failed: {e}")
+                    writer.close()
+                    return
+                except TimeoutError:
+                    print(f"{connection_id}: Client did not complete the challenge within {handshake_timeout}s.")
+                    writer.close()
+                    return
+                except Exception as e:
+                    # Something went wrong with the underlying connection, close it.
+                    print(f"{connection_id}: Unexpected failure during challenge: {e}")
+                    traceback.print_tb(e.__traceback__)
+                    writer.close()
+                    return
+
+                if client.id.bytes in queues:
+                    print(f"{connection_id}: Client {client.id} is already connected, dropping this connection.")
+                    writer.close()
+                    return
+
+                limit, policy, _ = handle.get_queue_limits(client.id)
+                client_queue = AsyncClientQueue(limit, policy)
+                queues[client.id.bytes] = client_queue
+                try:
+                    await AsyncBackboneServer._handle_client(reader, writer, client, auth, client_queue, queues, groups, settings, spool)
+                finally:
+                    del queues[client.id.bytes]
+                    client_queue.close()
+                    for group_id in client.groups:
+                        AsyncBackboneServer._unsubscribe(groups, group_id, client)
+            finally:
+                connections.discard(asyncio.current_task())
+
+        server = await asyncio.start_server(on_connection, host="0.0.0.0", port=port, backlog=handshake_backlog, reuse_port=settings["reuse_port"] if "reuse_port" in settings else None)
+        print(f"Server listening on {server.sockets[0].getsockname()[1]}")
+        if ready_flag != None:
+            ready_flag.set()
+
+        try:
+            await asyncio.to_thread(stop_flag.wait)
+        finally:
+            server.close()
+            # Ask every client task to stop, then wait for them to finish:
+            for client_queue in list(queues.values()):
+                client_queue.put_nowait(MsgS2S(MsgS2SType.STOP))
+            if len(connections) > 0:
+                await asyncio.wait(list(connections), timeout=10)
+            await server.wait_closed()
+            handle.set_spool(None)
+
+            print("Server stopped.")
+
+    @staticmethod
+    async def _handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, client:Identity, server:IdentityComponent, client_queue:asyncio.Queue, queues:dict, groups:dict, settings:dict, spool:Spool=None):
+        print(f"{client.id}: handler started")
+
+        send_key = client.session if client.session != None else client.key
+        monitors = [
+            asyncio.create_task(AsyncBackboneServer._monitor_queue(writer, client, client_queue, send_key, spool)),
+            asyncio.create_task(AsyncBackboneServer._monitor_socket(reader, client, server, queues, groups, settings))
+        ]
+
+        try:
+            # Either monitor finishing means that the connection should be closed:
+            done, pending = await asyncio.wait(monitors, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            print(f"{client.id}: Handler stopping...")
+            for task in monitors:
+                task.cancel()
+            await asyncio.gather(*monitors, return_exceptions=True)
+
+            try:
+                # Try to let the client know that the handler is stopping:
+                await frame.send_async(writer, MsgC2S(MsgC2SType.STOP, payload=b'handler stopping').to_bytes(), send_key, client.frame_version)
+            except Exception as e:
+                print(f"{client.id}: Failed to send STOP message to client: {e}")
+            writer.close()
+            print(f"{client.id}: Handler stopped")
+
+    @staticmethod
+    async def _monitor_queue(writer:asyncio.StreamWriter, client:Identity, client_queue:asyncio.Queue, send_key, spool:Spool=None):
+        handler_id = f"{client.id}-queue"
+        # Frames are collected here and handed to the stream together:
+        frames = frame.FrameWriter(None, send_key, client.frame_version)
+        # Messages spooled while the client was offline are written ahead of anything on the queue:
+        if spool != None:
+            await AsyncBackboneServer._replay_spool(handler_id, client, writer, frames, spool)
+        while True:
+            msg = await client_queue.get()
+
+            stopping = False
+            outgoing = []
+            outgoing_size = 0
+            while True:
+                if msg.format == MsgFormat.S2S and msg.type == MsgS2SType.STOP:
+                    print(f"{handler_id}: Received {msg.type.name} message on queue, stopping...")
+                    stopping = True
+                    break
+                data = ClientHandler._queued_message_data(handler_id, msg, client)
+                if data != None:
+                    outgoing.append(data)
+                    outgoing_size += len(data)
+                if client_queue.empty() or outgoing_size >= frames.coalesce_size:
+                    break
+                msg = client_queue.get_nowait()
+
+            ClientHandler._write_messages(handler_id, client, frames, outgoing)
+            writer.writelines(frames.take())
+            await writer.drain()
+
+            if stopping:
+                return
+
+    # Same as ClientHandler._replay_spool: segments are only deleted once the messages read from them have been
+    # written, if writing fails they are replayed again next time.
+    @staticmethod
+    async def _replay_spool(handler_id:str, client:Identity, writer:asyncio.StreamWriter, frames:frame.FrameWriter, spool:Spool):
+        replayed = 0
+        outgoing = []
+        outgoing_size = 0
+
+        async def flush():
+            ClientHandler._write_messages(handler_id, client, frames, outgoing)
+            writer.writelines(frames.take())
+            await writer.drain()
+
+        replay = spool.replay(client.id)
+        try:
+            for data in replay:
+                outgoing.append(data)
+                outgoing_size += len(data)
+                replayed += 1
+                if outgoing_size >= frames.coalesce_size:
+                    await flush()
+                    replay.commit()
+                    outgoing = []
+                    outgoing_size = 0
+            await flush()
+            replay.commit()
+        finally:
+            replay.close()
+
+        if replayed > 0:
+            print(f"{handler_id}: Replayed {replayed} spooled messages")
+
+    @staticmethod
+    async def _monitor_socket(reader:asyncio.StreamReader, client:Identity, server:IdentityComponent, queues:dict, groups:dict, settings:dict):
+        handler_id = f"{client.id}-socket"
+        heartbeat_timeout = settings["client"]["heartbeat_timeout"] if "heartbeat_timeout" in settings["client"] else 30
+        receive_key = client.session if client.session != None else server.server_state["private_key"]
+
+        while True:
+            try:
+                data = await asyncio.wait_for(frame.read_async(reader, receive_key, client.frame_version, client.max_frame_size), heartbeat_timeout)
+            except TimeoutError:
+                print(f"{handler_id}: No activity within {heartbeat_timeout}s, stopping...")
+                return
+            except (asyncio.IncompleteReadError, OSError) as e:
+                print(f"{handler_id}: Failed to read data from socket: {e}")
+                return
+            except frame.FrameTooLarge as e:
+                print(f"{handler_id}: {e}, closing connection.")
+                return
+
+            if data == None:
+                continue
+
+            msg = ClientHandler._read_message(handler_id, data, client)
+
+            if msg == None:
+                print(f"{handler_id}: Failed to parse data as a message: {data}")
+                continue
+
+            if not AsyncBackboneServer._process_message(handler_id, msg, client, queues, groups, server):
+                return
+
+    # Handles a message received on the socket, returns False if the handler should stop.
+    @staticmethod
+    def _process_message(handler_id:str, msg:BackboneMessage, client:Identity, queues:dict, groups:dict, server:IdentityComponent=None) -> bool:
+        match msg.format:
+            case MsgFormat.C2C:
+                if client.credit != None and not client.credit.consume():
+                    print(f"{handler_id}: Client sent a message without credit, dropping it.")
+                    return True
+
+                recipient = msg.recipient.bytes
+                if recipient in queues:
+                    # Credit for a message sent to a single client is returned once the recipient has taken it off its queue:
+                    AsyncBackboneServer._deliver(handler_id, msg, queues[recipient], client, queues, client.credit != None)
+                    return True
+
+                if recipient in groups:
+                    for member in groups[recipient]:
+                        AsyncBackboneServer._deliver(handler_id, msg, queues[member], client, queues)
+                else:
+                    ClientHandler._spool_message(handler_id, msg)
+                if client.credit != None:
+                    AsyncBackboneServer._release_credit(client, queues)
+
+            case MsgFormat.C2S:
+                match msg.type:
+                    case MsgC2SType.HEARTBEAT:
+                        print(f"{handler_id}: Received {msg.type.name}")
+                    case MsgC2SType.STOP:
+                        print(f"{handler_id}: Received {msg.type.name}, stopping...")
+                        return False
+                    case MsgC2SType.CONFIG:
+                        ClientHandler._apply_client_config(handler_id, msg, client)
+                    case MsgC2SType.SUBSCRIBE | MsgC2SType.UNSUBSCRIBE:
+                        ClientHandler._apply_subscription(handler_id, msg, client, functools.partial(AsyncBackboneServer._subscribe, groups), functools.partial(AsyncBackboneServer._unsubscribe, groups), server)
+                    case _:
+                        print(f"{handler_id}: Received unknown C2S message type ({msg.type}), dropping it.")
+            case MsgFormat.BATCH:
+                for batched_msg in msg.messages:
+                    if not AsyncBackboneServer._process_message(handler_id, batched_msg, client, queues, groups, server):
+                        return False
+            case _:
+                print(f"{handler_id}: Recevied a {msg.format} message on socket, dropping it (only C2C or C2S permitted)")
+
+        return True
+
+    # Same as ClientHandler._deliver: adds a routed message to a recipient queue, and lets the sender know if the queue is full.
+    @staticmethod
+    def _deliver(handler_id:str, msg:BackboneMessage, queue:AsyncClientQueue, client:Identity, queues:dict, release_credit:bool=False):
+        delivered = queue.offer(msg, functools.partial(AsyncBackboneServer._release_credit, client, queues) if release_credit else None)
+        if release_credit and not delivered:
+            AsyncBackboneServer._release_credit(client, queues)
+        if delivered and not 0 < queue.limit <= queue.qsize():
+            return
+        if not delivered:
+            print(f"{handler_id}: Queue for {msg.recipient} is full, dropped message.")
+
+        now = time.monotonic()
+        if now - client.throttled_at < handle.THROTTLE_INTERVAL:
+            return
+        client.throttled_at = now
+        if client.id.bytes in queues:
+            payload = json.dumps({ "recipient": msg.recipient.hex, "dropped": not delivered }).encode(encoding='utf-8')
+            queues[client.id.bytes].put_nowait(MsgS2S(MsgS2SType.THROTTLE, payload=payload))
+
+    # Same as ClientHandler._release_credit.
+    @staticmethod
+    def _release_credit(client:Identity, queues:dict):
+        grant = client.credit.release()
+        if grant > 0 and client.id.bytes in queues:
+            queues[client.id.bytes].put_nowait(MsgS2S(MsgS2SType.CREDIT, payload=grant.to_bytes(4)))
+
+    @staticmethod
+    def _subscribe(groups:dict, group_id:UUID, client:Identity):
+        if group_id.bytes not in groups:
+            groups[group_id.bytes] = set()
+        groups[group_id.bytes].add(client.id.bytes)
+
+    @staticmethod
+    def _unsubscribe(groups:dict, group_id:UUID, client:Identity):
+        members = groups[group_id.bytes] if group_id.bytes in groups else None
+        if members == None:
+            return
+        members.discard(client.id.bytes)
+        if len(members) == 0:
+            del groups[group_id.bytes]
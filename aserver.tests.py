@@ -0,0 +1,208 @@
+from tempfile import TemporaryDirectory
+import time
+import random
+import unittest
+from uuid import uuid4
+
+import handle
+import key, message
+from identity import Identity, IdentityComponent
+from client import BackboneClient
+from aserver import AsyncBackboneServer, AsyncClientQueue
+from message import BackboneMessageC2C as MsgC2C
+
+class TestAsyncBackboneServer(unittest.TestCase):
+    def test_creation(self):
+        server = AsyncBackboneServer()
+        self.assertIsInstance(server, AsyncBackboneServer)
+
+    def test_client_queue_policies(self):
+        msgs = [MsgC2C(uuid4(), f'#{i}'.encode()) for i in range(3)]
+
+        for policy in ("drop_newest", "block"):
+            q = AsyncClientQueue(limit=2, policy=policy)
+            self.assertEqual([q.offer(msg) for msg in msgs], [True, True, False], "Senders should never wait on the event loop.")
+            self.assertEqual([q.get_nowait(), q.get_nowait()], msgs[:2])
+
+        q = AsyncClientQueue(limit=2, policy="drop_oldest")
+        self.assertEqual([q.offer(msg) for msg in msgs], [True, True, True])
+        self.assertEqual([q.get_nowait(), q.get_nowait()], msgs[1:])
+        self.assertEqual(q.dropped, 1)
+
+        q = AsyncClientQueue(limit=2, policy="disconnect")
+        self.assertEqual([q.offer(msg) for msg in msgs], [True, True, False])
+        q.get_nowait(), q.get_nowait()
+        stop = q.get_nowait()
+        self.assertEqual((stop.format, stop.type), (message.BackboneMessageFormat.S2S, message.BackboneS2SType.STOP), "Overflowing the queue should stop the recipient's handler.")
+
+        # Limits are taken from the server's settings, including per-client overrides:
+        client_id = uuid4()
+        handle.set_queue_limits(10, "drop_oldest", overrides={ client_id.hex: { "limit": 1 } })
+        try:
+            self.assertEqual(handle.get_queue_limits(client_id)[:2], (1, "drop_oldest"))
+            self.assertEqual(handle.get_queue_limits(uuid4())[:2], (10, "drop_oldest"))
+        finally:
+            handle.set_queue_limits()
+
+        sender = Identity(uuid4(), None)
+        queues = { sender.id.bytes: AsyncClientQueue() }
+        recipient_queue = AsyncClientQueue(limit=1)
+        for msg in msgs:
+            AsyncBackboneServer._deliver("test", msg, recipient_queue, sender, queues)
+        self.assertEqual(recipient_queue.qsize(), 1)
+        self.assertEqual(queues[sender.id.bytes].get_nowait().type, message.BackboneS2SType.THROTTLE, "Senders should be told when a recipient's queue is full.")
+
+    def test_credit(self):
+        sender = Identity(uuid4(), None)
+        sender.credit = handle.CreditWindow(4)
+        recipient_id = uuid4()
+        queues = { sender.id.bytes: AsyncClientQueue(), recipient_id.bytes: AsyncClientQueue() }
+
+        msg = MsgC2C(recipient_id, b'data')
+        self.assertTrue(AsyncBackboneServer._process_message("test", msg, sender, queues, {}))
+        self.assertTrue(queues[sender.id.bytes].empty(), "Credit should not be returned while the message is still queued.")
+        self.assertEqual(queues[recipient_id.bytes].get_nowait(), msg)
+        self.assertEqual(queues[sender.id.bytes].get_nowait().type, message.BackboneS2SType.CREDIT, "Credit should be returned once the recipient has taken the message.")
+
+        self.assertTrue(AsyncBackboneServer._process_message("test", msg, sender, queues, {}))
+        queues[recipient_id.bytes].close()
+        self.assertEqual(queues[sender.id.bytes].get_nowait().type, message.BackboneS2SType.CREDIT, "Credit should be returned for messages left on a closed queue.")
+
+    def test_start_stop(self):
+        with TemporaryDirectory() as tmp_path:
+            server = AsyncBackboneServer(settings={ "port": random.randint(40000, 50000) }, identities=IdentityComponent(state_dir=tmp_path))
+            server.start()
+            time.sleep(0.5)
+            self.assertTrue(server.is_running())
+            server.stop(block=True)
+            self.assertFalse(server.is_running())
+
+    def test_c2c(self):
+        print()
+
+        client_id1  = uuid4()
+        client_key1 = key.generate()
+        client_id2  = uuid4()
+        client_key2 = key.generate()
+        client1 = BackboneClient(client_id1, client_key1)
+        client2 = BackboneClient(client_id2, client_key2)
+        port    = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id1, client_key1.public_key())
+            auth.add_client_key(client_id2, client_key2.public_key())
+
+            backbone_server = AsyncBackboneServer(settings={ "port": port }, identities=auth)
+
+            try:
+                backbone_server.start()
+                time.sleep(0.2)
+                self.assertTrue(client1.start("127.0.0.1", port).wait(3))
+                self.assertTrue(client2.start("127.0.0.1", port).wait(3))
+
+                msg1 = MsgC2C(client_id1, b'loopback')
+                client1.send(msg1).wait()
+                self.assertEqual(client1.read(block=True), msg1)
+
+                msg2 = MsgC2C(client_id2, b'client1->client2')
+                client1.send(msg2).wait()
+                self.assertEqual(client2.read(block=True), msg2)
+
+                msg3 = MsgC2C(client_id1, b'client2->client1')
+                client2.send(msg3).wait()
+                self.assertEqual(client1.read(block=True), msg3)
+            finally:
+                backbone_server.stop(block=True)
+                client1.stop()
+                client2.stop()
+
+            self.assertFalse(client1.is_running(), "Clients should be told to stop when the server stops.")
+
+    def test_c2c_group(self):
+        client_ids  = [uuid4() for _ in range(3)]
+        client_keys = [key.generate() for _ in range(3)]
+        clients     = [BackboneClient(client_id, client_key) for client_id, client_key in zip(client_ids, client_keys)]
+        group_id    = uuid4()
+        port        = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            for client_id, client_key in zip(client_ids, client_keys):
+                auth.add_client_key(client_id, client_key.public_key())
+            server = AsyncBackboneServer(settings={ "port": port }, identities=auth)
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                for client in clients:
+                    self.assertTrue(client.start("127.0.0.1", port).wait(3))
+                clients[1].subscribe(group_id).wait()
+                clients[2].subscribe(group_id).wait()
+                # The handlers register their queues and subscriptions after the clients are ready:
+                time.sleep(0.2)
+
+                msg1 = MsgC2C(group_id, b'client1->group')
+                clients[0].send(msg1).wait()
+                self.assertEqual(clients[1].read(block=True), msg1)
+                self.assertEqual(clients[2].read(block=True), msg1)
+
+                clients[2].unsubscribe(group_id).wait()
+                time.sleep(0.2)
+                msg2 = MsgC2C(group_id, b'client1->group again')
+                clients[0].send(msg2).wait()
+                self.assertEqual(clients[1].read(block=True), msg2)
+                time.sleep(0.2)
+                self.assertIsNone(clients[2].read(), "Clients should not receive group messages after unsubscribing.")
+            finally:
+                for client in clients:
+                    client.stop()
+                server.stop(block=True)
+
+    def test_c2c_spool(self):
+        client_id1  = uuid4()
+        client_key1 = key.generate()
+        client_id2  = uuid4()
+        client_key2 = key.generate()
+        client1 = BackboneClient(client_id1, client_key1)
+        port    = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id1, client_key1.public_key())
+            auth.add_client_key(client_id2, client_key2.public_key())
+            server = AsyncBackboneServer(settings={ "port": port, "spool": True }, identities=auth)
+            connections = []
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                self.assertTrue(client1.start("127.0.0.1", port).wait(3))
+
+                # client2 isn't connected yet, so this should be spooled:
+                msg = MsgC2C(client_id2, b'client1->client2')
+                client1.send(msg).wait()
+                time.sleep(0.2)
+                spool = handle.get_spool()
+                self.assertTrue(spool.pending(client_id2))
+
+                received = []
+                for _ in range(2):
+                    client2 = BackboneClient(client_id2, client_key2)
+                    connections.append(client2)
+                    self.assertTrue(client2.start("127.0.0.1", port).wait(3))
+                    time.sleep(0.3)
+                    received.append(client2.read())
+                    client2.stop()
+                    time.sleep(0.2)
+                self.assertEqual(received, [msg, None], "Spooled messages should only be delivered once.")
+                self.assertFalse(spool.pending(client_id2), "The spool should be emptied once its messages have been delivered.")
+            finally:
+                client1.stop()
+                for client2 in connections:
+                    client2.stop()
+                server.stop(block=True)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -1,18 +1,20 @@
-from datetime import datetime, timedelta
 import signal
 import socket
 import os
 import time
 import json
 from uuid import uuid4, UUID
-from threading import Thread, Event
-from queue import Queue, Empty
+from threading import Thread, Event, Semaphore
+from queue import Queue, Empty, Full
 
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+import codec
 import frame
 import key
-from message import BackboneMessageC2S as MsgC2S, BackboneMessageC2C as MsgC2C, BackboneMessageFormat as MsgFormat, BackboneC2SType as MsgC2SType, BackboneMessage
+import timer
+from wakeup import StopFlag
+from message import BackboneMessageC2S as MsgC2S, BackboneMessageC2C as MsgC2C, BackboneMessageBatch as MsgBatch, BackboneMessageFormat as MsgFormat, BackboneC2SType as MsgC2SType, BackboneMessage
 
 
 class BackboneClient:
@@ -20,11 +22,17 @@ class BackboneClient:
         self.id  = client_id
         self.key = key
     
-    def start(self, address:str, port:int=4000) -> Event:
+    # queue_size limits the number of messages waiting to be sent or read (0 for no limit). Once the
+    # outbound queue is full send blocks, and once the inbound queue is full the client stops reading
+    # from the server until read is called.
+    def start(self, address:str, port:int=4000, queue_size:int=0) -> Event:
         ready_flag = Event()
-        self.stop_flag = Event()
-        self._messages_in = Queue()
-        self._messages_out = Queue()
+        # Setting the flag wakes up the sender and receiver, so the client stops right away:
+        self.stop_flag = StopFlag()
+        # Set when the server reports that a recipient's queue is full, see throttled:
+        self.throttled = Event()
+        self._messages_in = Queue(maxsize=queue_size)
+        self._messages_out = Queue(maxsize=queue_size)
         self._thread   = Thread(
             target=BackboneClient._run,
             kwargs={
@@ -35,7 +43,8 @@ class BackboneClient:
                 "messages_in": self._messages_in,
                 "messages_out": self._messages_out,
                 "stop_flag": self.stop_flag,
-                "ready_flag": ready_flag
+                "ready_flag": ready_flag,
+                "throttled_flag": self.throttled
             })
         self.stop_flag.clear()
         self._thread.start()
@@ -45,7 +54,13 @@ class BackboneClient:
         if not self.is_running():
             return False
         
-        sent_flag = self.send(MsgC2S(MsgC2SType.STOP))
+        # The outbound queue may be full (e.g. while the sender waits for credit), in which case the client stops
+        # without telling the server rather than waiting for room:
+        sent_flag = Event()
+        try:
+            self._messages_out.put_nowait((MsgC2S(MsgC2SType.STOP), sent_flag))
+        except Full:
+            pass
 
         sent_flag.wait(1)
         
@@ -69,6 +84,13 @@ class BackboneClient:
         self._messages_out.put((msg, message_sent))
         return message_sent
     
+    # Joins a group, C2C messages addressed to the group ID are then delivered to this client as well.
+    def subscribe(self, group_id:UUID) -> Event:
+        return self.send(MsgC2S(MsgC2SType.SUBSCRIBE, payload=group_id.bytes))
+
+    def unsubscribe(self, group_id:UUID) -> Event:
+        return self.send(MsgC2S(MsgC2SType.UNSUBSCRIBE, payload=group_id.bytes))
+    
     # Attempts to retrieve a message from the client's inbound message queue.
     def read(self, block=False) -> MsgC2C | None:
         if not self.is_running():
@@ -85,66 +107,79 @@ class BackboneClient:
 
     
     @staticmethod
-    def _run(address:str, port:int, client_id:UUID, private_key:rsa.RSAPrivateKey, messages_in:Queue, messages_out:Queue, stop_flag:Event, ready_flag:Event):
+    def _run(address:str, port:int, client_id:UUID, private_key:rsa.RSAPrivateKey, messages_in:Queue, messages_out:Queue, stop_flag:StopFlag, ready_flag:Event, throttled_flag:Event=None):
         
         with socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM) as sock:
             sock.connect((address, port))
+            try:
+                # Frames are coalesced before they are written, so Nagle's algorithm only adds latency:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
 
-            # Receive server challenge:
-            challenge =  frame.read(sock)
-            key_length = int.from_bytes(challenge[0:2])
-            server_public_key_b = challenge[2:2+key_length]
-            server_public_key = key.deserialize(server_public_key_b)
-
-            # Prepare challenge response:
-            challenge_data = challenge[2+key_length:]
-            signature = key.sign(private_key, challenge_data)
-            msg = client_id.bytes + signature
-
-            # Send response:
-            frame.send(sock, msg, server_public_key)
-            result = frame.read(sock, private_key)
+            # Receive server challenge and send response:
+            response, server_public_key, session = BackboneClient._respond(frame.read(sock), client_id, private_key)
+            frame.send(sock, response, server_public_key)
+            result = frame.read(sock, session)
 
-            try:
-                msg = BackboneMessage.from_bytes(result)
-            except Exception as e:
+            settings = BackboneClient._read_config(result)
+            if settings == None:
                 print(f"{client_id}-master: Invalid response received from server, assuming authentication failed.")
                 stop_flag.set()
                 return
 
-            if msg.format != MsgFormat.C2S or msg.type != MsgC2SType.CONFIG:
-                print(f"{client_id}-master: Invalid response received from server, assuming authentication failed.")
-                stop_flag.set()
-                return
-            
-            settings = json.loads(msg.payload.decode(encoding='utf-8'))
+            options = BackboneClient._client_options(settings)
+            if len(options) > 0:
+                # Let the server know which of the optional features it offered we support:
+                frame.send(sock, MsgC2S(MsgC2SType.CONFIG, payload=json.dumps(options).encode(encoding='utf-8')).to_bytes(), session, settings["frame_version"] if "frame_version" in settings else 1)
+
             settings_flag = Event()
+            # With credit enabled, every C2C message takes one unit of credit and CREDIT messages from the server return it:
+            credit = Semaphore(settings["credit_window"]) if "credit" in options else None
 
             send_thread = Thread(
                 target=BackboneClient._sender,
                 kwargs={
                     "client_id": client_id,
-                    "server_key": server_public_key,
+                    "session": session,
                     "messages_out": messages_out,
                     "connection": sock,
                     "stop_flag": stop_flag,
                     "settings": settings,
-                    "settings_flag": settings_flag
+                    "settings_flag": settings_flag,
+                    "credit": credit
                 }
             )
             receive_thread= Thread(
                 target=BackboneClient._receiver,
                 kwargs={
                     "client_id": client_id,
-                    "private_key": private_key,
+                    "session": session,
                     "messages_in": messages_in,
                     "connection": sock,
                     "stop_flag": stop_flag,
                     "settings": settings,
-                    "settings_flag": settings_flag
+                    "settings_flag": settings_flag,
+                    "throttled_flag": throttled_flag,
+                    "credit": credit
                 }
             )
 
+            def wake_threads():
+                # The sender takes None off the queue as a wakeup:
+                try:
+                    messages_out.put_nowait(None)
+                except Full:
+                    # The sender has messages to send, so it isn't waiting.
+                    pass
+                try:
+                    sock.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+                # The receiver may be waiting for room on the inbound queue:
+                BackboneClient._wake_put(messages_in)
+            stop_flag.on_set(wake_threads)
+
             print(f"{client_id}-master: Starting send thread")
             send_thread.start()
             print(f"{client_id}-master: Starting receive thread")
@@ -161,27 +196,128 @@ class BackboneClient:
 
 
 
+    # Builds the response to a server challenge, offering a secret for the session keys used after authentication
+    # along with the highest supported frame version.
+    # Returns the response along with the server public key used to send it and the resulting session.
+    @staticmethod
+    def _respond(challenge:bytes, client_id:UUID, private_key:rsa.RSAPrivateKey) -> tuple[bytes, rsa.RSAPublicKey, key.Session]:
+        key_length = int.from_bytes(challenge[0:2])
+        server_public_key_b = challenge[2:2+key_length]
+        server_public_key = key.deserialize(server_public_key_b)
+
+        challenge_data = challenge[2+key_length:]
+        session_secret = os.urandom(key.SESSION_SECRET_SIZE)
+        extensions = session_secret + frame.FRAME_VERSION.to_bytes(1)
+        signature = key.sign(private_key, challenge_data + extensions)
+        response = client_id.bytes + signature + extensions
+
+        return response, server_public_key, key.Session(session_secret, challenge_data, initiator=True)
+
+    # Parses the CONFIG message sent by the server on successful authentication, returns None if the message is anything else.
+    @staticmethod
+    def _read_config(result:bytes) -> dict | None:
+        try:
+            msg = BackboneMessage.from_bytes(result)
+        except Exception as e:
+            return None
+
+        if msg == None or msg.format != MsgFormat.C2S or msg.type != MsgC2SType.CONFIG:
+            return None
+
+        return json.loads(msg.payload.decode(encoding='utf-8'))
+
+    # Returns the optional features to announce to the server, based on those offered in its CONFIG message.
+    @staticmethod
+    def _client_options(settings:dict) -> dict:
+        options = {}
+        if "batching" in settings and settings["batching"]:
+            options["batching"] = True
+        compression = codec.select(settings["compression"]) if "compression" in settings else None
+        if compression != None:
+            options["compression"] = compression
+        if "credit_window" in settings and settings["credit_window"] > 0:
+            options["credit"] = True
+        return options
+
     @staticmethod
-    def _sender(client_id:UUID, server_key:rsa.RSAPublicKey, messages_out:Queue, connection:socket.socket, stop_flag:Event, settings:dict, settings_flag:Event):
+    def _update_settings(dst:dict, src:dict):
+        for key in src.keys():
+            if isinstance(src[key], dict):
+                if key not in dst or not isinstance(dst[key], dict):
+                    dst[key] = {}
+                BackboneClient._update_settings(dst[key], src[key])
+            else:
+                dst[key] = src[key]
+
+    @staticmethod
+    def _sender(client_id:UUID, session:key.Session, messages_out:Queue, connection:socket.socket, stop_flag:StopFlag, settings:dict, settings_flag:Event, credit:Semaphore=None):
         prefix = f"{client_id}-send: "
         print(f"{prefix}Started.")
-        heartbeat_interval = timedelta(seconds=settings["heartbeat_interval"]) if "heartbeat_interval" in settings else timedelta(seconds=30)
-        last_send = datetime.now()
+        heartbeat_interval = settings["heartbeat_interval"] if "heartbeat_interval" in settings else 30
+        frame_version  = settings["frame_version"] if "frame_version" in settings else 1
+        max_frame_size = settings["max_frame_size"] if "max_frame_size" in settings else None
+        compression    = codec.select(settings["compression"]) if "compression" in settings else None
+        last_send = time.monotonic()
+        # Messages that are already waiting on the queue are written to the socket together:
+        writer = frame.FrameWriter(connection, session, frame_version, max_frame_size)
+
+        # Queues a heartbeat once nothing has been sent for heartbeat_interval, otherwise checks again when it might be due:
+        def on_heartbeat():
+            if stop_flag.is_set():
+                return None
+            remaining = heartbeat_interval - (time.monotonic() - last_send)
+            if remaining > 0:
+                return remaining
+            try:
+                messages_out.put_nowait((MsgC2S(MsgC2SType.HEARTBEAT), Event()))
+            except Full:
+                # The queue is full, so a message will be sent soon anyway.
+                pass
+            return heartbeat_interval
+        heartbeat_timer = timer.shared().schedule(heartbeat_interval, on_heartbeat)
+        # Stopping releases credit, to wake up the sender if it is waiting for some:
+        if credit != None:
+            stop_flag.on_set(credit.release)
 
         while not stop_flag.is_set():
             if settings_flag.is_set():
-                heartbeat_interval = timedelta(seconds=settings["heartbeat_interval"]) if "heartbeat_interval" in settings else timedelta(seconds=30)
+                heartbeat_interval = settings["heartbeat_interval"] if "heartbeat_interval" in settings else 30
                 settings_flag.clear()
             try:
-                msg_record = messages_out.get(timeout=1.0)
-                frame.send(connection, msg_record[0].to_bytes(), server_key)
-                last_send = datetime.now()
-                msg_record[1].set()
-            except Empty:
-                if heartbeat_interval < datetime.now() - last_send:
-                    frame.send(connection, MsgC2S(MsgC2SType.HEARTBEAT).to_bytes(), server_key)
-                    last_send = datetime.now()
-                continue
+                msg_record = messages_out.get()
+                if msg_record == None:
+                    continue
+                outgoing = []
+                outgoing_size = 0
+                batching = "batching" in settings and settings["batching"]
+                while True:
+                    if credit != None and msg_record[0].format == MsgFormat.C2C and not credit.acquire(blocking=False):
+                        # Out of credit: send what has been collected so far, then hold the message until the server returns credit.
+                        BackboneClient._send_messages(prefix, writer, outgoing, batching, compression)
+                        outgoing = []
+                        outgoing_size = 0
+                        last_send = time.monotonic()
+                        # Heartbeats queued by the timer can't get past this message, so they are sent from here:
+                        while not credit.acquire(timeout=max(0, heartbeat_interval - (time.monotonic() - last_send))):
+                            writer.send(MsgC2S(MsgC2SType.HEARTBEAT).to_bytes())
+                            last_send = time.monotonic()
+                        if stop_flag.is_set():
+                            break
+
+                    data = msg_record[0].to_bytes()
+                    outgoing.append((data, msg_record[1]))
+                    outgoing_size += len(data)
+                    if outgoing_size >= writer.coalesce_size:
+                        break
+                    try:
+                        msg_record = messages_out.get_nowait()
+                    except Empty:
+                        break
+                    if msg_record == None:
+                        break
+
+                BackboneClient._send_messages(prefix, writer, outgoing, batching, compression)
+                last_send = time.monotonic()
             except Exception as e:
                 print(f"{prefix}Unexpected exception {e}")
                 try:
@@ -189,49 +325,91 @@ class BackboneClient:
                 except:
                     pass
                 stop_flag.set()
+        heartbeat_timer.cancel()
         print(f"{prefix}stopped.")
         
 
     
+    # Writes (data, sent_flag) records to the socket and sets the flags of those that were sent.
     @staticmethod
-    def _receiver(client_id:UUID, private_key:rsa.RSAPrivateKey, messages_in:Queue, connection:socket.socket, stop_flag:Event, settings:dict, settings_flag:Event):
+    def _send_messages(prefix:str, writer:frame.FrameWriter, outgoing:list[tuple[bytes, Event]], batching:bool, compression:str=None):
+        sent = BackboneClient._write_messages(prefix, writer, outgoing, batching, compression)
+        writer.flush()
+        for sent_flag in sent:
+            sent_flag.set()
+
+    # Adds (data, sent_flag) records to the writer, packing them into batches if the server accepts them.
+    # Returns the flags for the messages that were written.
+    @staticmethod
+    def _write_messages(prefix:str, writer:frame.FrameWriter, outgoing:list[tuple[bytes, Event]], batching:bool, compression:str=None) -> list[Event]:
+        groups = MsgBatch.group(outgoing, size=lambda record: len(record[0])) if batching else [[record] for record in outgoing]
+        sent = []
+        for group in groups:
+            try:
+                writer.write(codec.compress_message(group[0][0] if len(group) == 1 else MsgBatch.encode([record[0] for record in group]), compression))
+                sent.extend(record[1] for record in group)
+                continue
+            except frame.FrameTooLarge as e:
+                if len(group) == 1:
+                    # Nothing has been buffered for this message, so the rest can still be sent:
+                    print(f"{prefix}Dropping message: {e}")
+                    continue
+
+            # The batch didn't fit in a frame, fall back to sending its messages one by one:
+            for data, sent_flag in group:
+                try:
+                    writer.write(codec.compress_message(data, compression))
+                    sent.append(sent_flag)
+                except frame.FrameTooLarge as e:
+                    print(f"{prefix}Dropping message: {e}")
+        return sent
+
+    @staticmethod
+    def _receiver(client_id:UUID, session:key.Session, messages_in:Queue, connection:socket.socket, stop_flag:Event, settings:dict, settings_flag:Event, throttled_flag:Event=None, credit:Semaphore=None):
         prefix = f"{client_id}-receive: "
         print(f"{prefix}Started.")
+        frame_version = settings["frame_version"] if "frame_version" in settings else 1
+        compression   = codec.select(settings["compression"]) if "compression" in settings else None
+        reader = frame.FrameReader(connection, session, frame_version)
         while not stop_flag.is_set():
             try:
-                msg_b = frame.read(connection, private_key)
+                msg_b = reader.read()
 
                 if msg_b == None:
                     continue
 
-                msg = BackboneMessage.from_bytes(msg_b)
-                match msg.format:
-                    case MsgFormat.C2C:
-                        messages_in.put(msg)
-                    case MsgFormat.C2S:
-                        match msg.type:
-                            case MsgC2SType.STOP:
-                                print(f"{prefix}Received a STOP message from the server. Reason was: {msg.payload}")
-                                stop_flag.set()
-                            case MsgC2SType.CONFIG:
-                                def update_settings(dst:dict, src:dict):
-                                    for key in src.keys():
-                                        if isinstance(src[key], dict):
-                                            if not isinstance(src[key], dict):
-                                                dst[key] = {}
-                                            update_settings(dst[key], src[key])
-                                        else:
-                                            dst[key] = src[key]
-                                try:
-                                    new_settings = json.loads(msg.payload)
-                                    update_settings(settings, new_settings)
-                                    settings_flag.set()
-                                except Exception as e:
-                                    print(f"{prefix}Failed to update settings: {e}")
+                msg = BackboneMessage.from_bytes(codec.decompress_message(msg_b, compression))
+                # The server may batch C2S messages (e.g. CREDIT) along with C2C messages:
+                for msg in (msg.messages if msg.format == MsgFormat.BATCH else [msg]):
+                    match msg.format:
+                        case MsgFormat.C2C:
+                            BackboneClient._put_message(messages_in, msg, stop_flag)
+                        case MsgFormat.C2S:
+                            match msg.type:
+                                case MsgC2SType.STOP:
+                                    print(f"{prefix}Received a STOP message from the server. Reason was: {msg.payload}")
+                                    stop_flag.set()
+                                case MsgC2SType.CONFIG:
+                                    try:
+                                        new_settings = json.loads(msg.payload)
+                                        BackboneClient._update_settings(settings, new_settings)
+                                        settings_flag.set()
+                                    except Exception as e:
+                                        print(f"{prefix}Failed to update settings: {e}")
+                                case MsgC2SType.THROTTLE:
+                                    print(f"{prefix}Server is throttling messages: {msg.payload}")
+                                    if throttled_flag != None:
+                                        throttled_flag.set()
+                                case MsgC2SType.CREDIT:
+                                    if credit != None:
+                                        credit.release(int.from_bytes(msg.payload))
 
             except socket.timeout:
                 pass
             except Exception as e:
+                if stop_flag.is_set():
+                    # The socket was shut down to wake up the receiver.
+                    break
                 print(f"{prefix}Unexpected exception {e}")
                 try:
                     frame.send(MsgC2S(MsgC2SType.STOP, payload=b'Unexpected error!'))
@@ -240,6 +418,24 @@ class BackboneClient:
                 stop_flag.set()
         print(f"{prefix}stopped.")
 
+    # Waits for room on a bounded inbound queue, giving up if the client is stopped (stopping notifies the waiters,
+    # see _wake_put).
+    @staticmethod
+    def _put_message(messages_in:Queue, msg:MsgC2C, stop_flag:Event):
+        with messages_in.not_full:
+            while 0 < messages_in.maxsize <= messages_in._qsize():
+                if stop_flag.is_set():
+                    return
+                messages_in.not_full.wait()
+            messages_in._put(msg)
+            messages_in.unfinished_tasks += 1
+            messages_in.not_empty.notify()
+
+    @staticmethod
+    def _wake_put(messages_in:Queue):
+        with messages_in.not_full:
+            messages_in.not_full.notify_all()
+
 
 if __name__ == "__main__":
     client_id = uuid4()
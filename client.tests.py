@@ -1,15 +1,18 @@
 from tempfile import TemporaryDirectory
-from threading import Thread, Event
+from threading import Thread, Event, Semaphore
+from queue import Queue
 import time
 import socket
 import unittest
 import random
+import os
 from uuid import uuid4
 
 import key
 import frame
 from identity import ChallengeFailed, IdentityComponent
 from client import BackboneClient
+from wakeup import StopFlag
 from server import BackboneServer
 from message import BackboneMessageC2C as MsgC2C, BackboneMessageC2S as MsgC2S, BackboneC2SType as MsgC2SType, BackboneMessageFormat as MsgFormat, BackboneMessage
 
@@ -138,9 +141,137 @@ class TestBackboneClient(unittest.TestCase):
                 client1.stop()
                 client2.stop()
 
-            
 
+    def test_c2c_batched(self):
+        print()
+
+        client_id1  = uuid4()
+        client_key1 = key.generate()
+        client_id2  = uuid4()
+        client_key2 = key.generate()
+        client1 = BackboneClient(client_id1, client_key1)
+        client2 = BackboneClient(client_id2, client_key2)
+        port    = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id1, client_key1.public_key())
+            auth.add_client_key(client_id2, client_key2.public_key())
+
+            backbone_server = BackboneServer(settings={ "port": port }, identities=auth)
+
+            try:
+                backbone_server.start()
+                time.sleep(0.2)
+                self.assertTrue(client1.start("127.0.0.1", port).wait(3))
+                self.assertTrue(client2.start("127.0.0.1", port).wait(3))
+                time.sleep(0.2)
+
+                # Queue the messages faster than they can be sent, so that they get batched:
+                msgs  = [MsgC2C(client_id2, f'client1->client2 #{i}'.encode()) for i in range(500)]
+                flags = [client1.send(msg) for msg in msgs]
+                for flag in flags:
+                    self.assertTrue(flag.wait(3))
+
+                received = [client2.read(block=True) for _ in msgs]
+                self.assertEqual(received, msgs, "Batched messages should be delivered in order.")
+
+                msg = MsgC2C(client_id2, b'{"text": "hello"}' * 1000)
+                self.assertTrue(client1.send(msg).wait(3))
+                self.assertEqual(client2.read(block=True), msg, "Compressed messages should be delivered intact.")
+            finally:
+                backbone_server.stop(block=True)
+                client1.stop()
+                client2.stop()
+
+    def test_c2c_large_message(self):
+        print()
+
+        client_id  = uuid4()
+        client_key = key.generate()
+        client     = BackboneClient(client_id, client_key)
+        port       = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id, client_key.public_key())
+
+            backbone_server = BackboneServer(settings={ "port": port, "max_frame_size": 2**19 }, identities=auth)
+
+            try:
+                backbone_server.start()
+                time.sleep(0.2)
+                self.assertTrue(client.start("127.0.0.1", port).wait(3))
+
+                msg = MsgC2C(client_id, os.urandom(2**18))
+                client.send(msg).wait(3)
+                self.assertEqual(client.read(block=True), msg, "Messages larger than 64KiB should be delivered once extended frames have been negotiated.")
+
+                too_large = client.send(MsgC2C(client_id, os.urandom(2**19)))
+                self.assertFalse(too_large.wait(1), "Messages larger than max_frame_size should be dropped by the client.")
+                self.assertTrue(client.is_running(), "Dropping a message that is too large should not stop the client.")
+            finally:
+                backbone_server.stop(block=True)
+                client.stop()
+
+
+    def test_stop_without_credit(self):
+        client_id = uuid4()
+        socket1, socket2 = socket.socketpair()
+        messages_out = Queue(maxsize=1)
+        stop_flag = StopFlag()
+        sent = Event()
+        sender = Thread(target=BackboneClient._sender, kwargs={
+            "client_id": client_id,
+            "session": None,
+            "messages_out": messages_out,
+            "connection": socket1,
+            "stop_flag": stop_flag,
+            "settings": {},
+            "settings_flag": Event(),
+            "credit": Semaphore(0)
+        })
+
+        try:
+            sender.start()
+            messages_out.put((MsgC2C(client_id, b'no credit'), sent))
+            time.sleep(0.2)
+            self.assertFalse(sent.is_set(), "Messages should be held back while the client has no credit.")
+
+            start_time = time.monotonic()
+            stop_flag.set()
+            sender.join(1)
+            self.assertFalse(sender.is_alive(), "Stopping should wake up a sender that is waiting for credit.")
+            self.assertLess(time.monotonic() - start_time, 0.5)
+            self.assertFalse(sent.is_set())
+        finally:
+            stop_flag.set()
+            socket1.close()
+            socket2.close()
+
+
+
+    def test_stop_with_full_inbound_queue(self):
+        client_id = uuid4()
+        messages_in = Queue(maxsize=1)
+        messages_in.put(MsgC2C(client_id, b'unread'))
+        stop_flag = StopFlag()
+        stop_flag.on_set(lambda: BackboneClient._wake_put(messages_in))
+        receiver = Thread(target=BackboneClient._put_message, args=(messages_in, MsgC2C(client_id, b'waiting'), stop_flag))
+
+        receiver.start()
+        time.sleep(0.2)
+        self.assertTrue(receiver.is_alive(), "The receiver should wait for room on the inbound queue.")
+        start_time = time.monotonic()
+        stop_flag.set()
+        receiver.join(1)
+        self.assertFalse(receiver.is_alive())
+        self.assertLess(time.monotonic() - start_time, 0.5, "Stopping should wake up a receiver waiting for room on the inbound queue.")
 
+        self.assertEqual(messages_in.get_nowait().payload, b'unread')
+        stop_flag = StopFlag()
+        BackboneClient._put_message(messages_in, MsgC2C(client_id, b'room'), stop_flag)
+        self.assertEqual(messages_in.get_nowait().payload, b'room')
 
 
 if __name__ == "__main__":
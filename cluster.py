@@ -0,0 +1,288 @@
+# cluster.py
+# Prefork server: several worker processes, each running a BackboneServer, listen on the same port
+# (SO_REUSEPORT) so that handshakes and frame encryption are spread across cores instead of being
+# limited to one by the GIL.
+#
+# Workers are connected to a broker in the parent process by pipes (see relay.py). The broker keeps
+# track of the worker each client is connected to, and which workers have members in each group, and
+# passes on C2C messages whose recipients are connected to another worker.
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import threading
+import time
+import tomllib
+from multiprocessing.connection import Connection
+from uuid import UUID
+
+import handle
+import relay
+from identity import IdentityComponent
+from message import BackboneMessage, BackboneMessageFormat as MsgFormat
+from relay import Relay
+from server import BackboneServer
+from wakeup import Waker
+
+class Broker:
+    def __init__(self, connections:list[Connection], name:str="broker") -> None:
+        self.name = name
+        # Connections to the workers, a worker is referred to by its index:
+        self.connections = connections
+        self.stop_flag = threading.Event()
+        self.thread = None
+        # Set once every worker is listening for connections:
+        self.ready = threading.Event()
+
+        # Worker that each client is connected to, keyed by the raw bytes of the client ID:
+        self._presence = {}
+        # Workers with members in each group, keyed by the raw bytes of the group ID:
+        self._groups = {}
+        self._ready_workers = set()
+        self._routed = 0
+        self._dropped = 0
+        self._waker = Waker()
+
+    def start(self):
+        self.stop_flag.clear()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    # Stops the broker, asking the workers to stop as well.
+    def stop(self, block:bool=False):
+        self.stop_flag.set()
+        self._waker.wake()
+        if block and self.thread:
+            self.thread.join()
+
+    def is_running(self) -> bool:
+        return self.thread != None and self.thread.is_alive()
+
+    # Only read from the broker thread, so these may be a little out of date:
+    def stats(self) -> dict:
+        return {
+            "workers": len(self.connections),
+            "clients": len(self._presence),
+            "groups": len(self._groups),
+            "routed": self._routed,
+            "dropped": self._dropped
+        }
+
+    def _run(self):
+        print(f"{self.name}: Broker started")
+        workers = { connection: worker for worker, connection in enumerate(self.connections) }
+        try:
+            while not self.stop_flag.is_set() and len(workers) > 0:
+                for ready in multiprocessing.connection.wait(list(workers.keys()) + [self._waker]):
+                    if ready is self._waker:
+                        self._waker.clear()
+                        continue
+
+                    worker = workers[ready]
+                    try:
+                        data = ready.recv_bytes()
+                    except (EOFError, OSError):
+                        print(f"{self.name}: Lost the connection to worker {worker}")
+                        del workers[ready]
+                        self._remove_worker(worker)
+                        continue
+                    self._handle(worker, data)
+        finally:
+            for connection in workers.keys():
+                try:
+                    connection.send_bytes(relay.STOP)
+                except (OSError, ValueError):
+                    pass
+            print(f"{self.name}: Broker stopped")
+
+    def _handle(self, worker:int, data:bytes):
+        op, body = data[:1], data[1:]
+        match op:
+            case relay.ROUTE:
+                self._route(worker, body)
+            case relay.PRESENT:
+                present = self._presence.get(body)
+                if present != None and present != worker:
+                    # Same as a single server, the client's new connection is refused while the old one is still up.
+                    # The worker's ABSENT for the refused connection is ignored, since the client isn't present there:
+                    print(f"{self.name}: Client {UUID(bytes=body)} is already connected to worker {present}, refusing its connection to worker {worker}.")
+                    try:
+                        self.connections[worker].send_bytes(relay.REFUSE + body)
+                    except (OSError, ValueError) as e:
+                        print(f"{self.name}: Failed to refuse the connection on worker {worker}: {e}")
+                    return
+                self._presence[body] = worker
+            case relay.ABSENT:
+                if self._presence.get(body) == worker:
+                    del self._presence[body]
+            case relay.JOIN:
+                if body not in self._groups:
+                    self._groups[body] = set()
+                self._groups[body].add(worker)
+            case relay.LEAVE:
+                if body in self._groups:
+                    self._groups[body].discard(worker)
+                    if len(self._groups[body]) == 0:
+                        del self._groups[body]
+            case relay.READY:
+                self._ready_workers.add(worker)
+                if len(self._ready_workers) == len(self.connections):
+                    self.ready.set()
+            case _:
+                print(f"{self.name}: Received unknown message from worker {worker} ({op}), dropping it.")
+
+    # Passes a C2C message on to the worker its recipient is connected to, or to every other worker with
+    # members in the group it is addressed to (the sending worker has already delivered it to its own).
+    def _route(self, origin:int, data:bytes):
+        msg = BackboneMessage.from_bytes(data)
+        if msg == None or msg.format != MsgFormat.C2C:
+            print(f"{self.name}: Worker {origin} sent something other than a C2C message, dropping it.")
+            return
+
+        key = msg.recipient.bytes
+        if key in self._presence:
+            targets = [self._presence[key]]
+        elif key in self._groups:
+            targets = [worker for worker in self._groups[key] if worker != origin]
+        else:
+            targets = []
+
+        if len(targets) == 0:
+            # Unknown recipients are common, since workers pass on every group message they can't be sure about.
+            self._dropped += 1
+            return
+        for worker in targets:
+            try:
+                self.connections[worker].send_bytes(relay.ROUTE + data)
+                self._routed += 1
+            except (OSError, ValueError) as e:
+                print(f"{self.name}: Failed to pass a message on to worker {worker}: {e}")
+                self._dropped += 1
+
+    def _remove_worker(self, worker:int):
+        for key in [key for key, present in self._presence.items() if present == worker]:
+            del self._presence[key]
+        for key in list(self._groups.keys()):
+            self._groups[key].discard(worker)
+            if len(self._groups[key]) == 0:
+                del self._groups[key]
+
+
+class BackboneCluster:
+    # settings are the same as for BackboneServer, cluster_workers sets the number of worker processes
+    # (0 for one per core). Every worker reads its identities from state_dir.
+    def __init__(self, settings={}, state_dir:str=None) -> None:
+        self.settings = settings if settings != None else {}
+        # Settings are completed once, so that every worker gets the same:
+        BackboneServer._ensure_settings(self)
+        self.state_dir = state_dir
+
+        # Makes sure that the server key exists before the workers start, so they don't all create one:
+        self.auth = IdentityComponent(state_dir=state_dir, key_cache_size=self.settings["key_cache_size"], key_store=self.settings["key_store"])
+
+        self.workers = []
+        self.broker = None
+
+    def start(self, block:bool = False) -> bool:
+        if self.is_running():
+            return False
+        if not hasattr(socket, "SO_REUSEPORT"):
+            print("SO_REUSEPORT is not supported on this platform, can't start a cluster.")
+            return False
+
+        worker_count = self.settings["cluster_workers"] if "cluster_workers" in self.settings else 0
+        if worker_count <= 0:
+            worker_count = os.cpu_count() or 1
+        settings = dict(self.settings)
+        settings["reuse_port"] = True
+
+        # Workers are spawned rather than forked, since the parent may already be running threads:
+        context = multiprocessing.get_context("spawn")
+        connections = []
+        self.workers = []
+        for i in range(worker_count):
+            broker_end, worker_end = context.Pipe()
+            worker = context.Process(target=BackboneCluster._worker, name=f"worker-{i}", kwargs={
+                "connection": worker_end,
+                "settings": settings,
+                "state_dir": self.state_dir
+            })
+            worker.start()
+            # The broker end is the only one the parent needs, closing this one lets the broker notice a worker exiting:
+            worker_end.close()
+            connections.append(broker_end)
+            self.workers.append(worker)
+
+        self.broker = Broker(connections)
+        self.broker.start()
+
+        if block:
+            for worker in self.workers:
+                worker.join()
+
+        return True
+
+    def is_running(self) -> bool:
+        return any(worker.is_alive() for worker in self.workers)
+
+    # Returns an event that is set once every worker is listening for connections.
+    def ready(self) -> threading.Event:
+        return self.broker.ready if self.broker != None else None
+
+    def stop(self, block:bool = False):
+        if self.broker == None:
+            return False
+        print(f"Stopping cluster {self}")
+        self.broker.stop(block=True)
+        if block:
+            for worker in self.workers:
+                worker.join(10)
+                if worker.is_alive():
+                    print(f"{worker.name} did not stop, terminating it.")
+                    worker.terminate()
+        return True
+
+    def stats(self) -> dict | None:
+        if self.broker == None:
+            return None
+        return self.broker.stats()
+
+    @staticmethod
+    def _worker(connection:Connection, settings:dict, state_dir:str):
+        # The cluster stops its workers through the broker, rather than each of them handling signals:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        auth = IdentityComponent(state_dir=state_dir, key_cache_size=settings["key_cache_size"], key_store=settings["key_store"])
+        worker_relay = Relay(connection, deliver=handle.deliver_relayed, refuse=handle.disconnect_client)
+        server = BackboneServer(settings=settings, identities=auth, relay=worker_relay)
+        server.start()
+        try:
+            while not server.ready_flag.wait(1):
+                if not server.is_running():
+                    print("Worker server failed to start.")
+                    return
+            worker_relay.ready()
+            # Runs until the broker asks the worker to stop or goes away:
+            worker_relay.run()
+        finally:
+            server.stop(block=True)
+            connection.close()
+
+if __name__ == "__main__":
+    with open("./settings.toml", 'rb') as f:
+        settings = tomllib.load(f)
+    cluster = BackboneCluster(settings=settings)
+
+    def terminate(signum, frame):
+        print(f"Received {signal.Signals(signum).name} at {frame}")
+        print(f"Trying to stop the cluster...")
+        cluster.stop()
+
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGTERM, terminate)
+
+    cluster.start(block=False)
+    while cluster.is_running():
+        # Busy-waiting so that we can handle the SIGINT, SIGTERM
+        time.sleep(1)
@@ -0,0 +1,149 @@
+import multiprocessing
+import random
+import threading
+import time
+import unittest
+from tempfile import TemporaryDirectory
+from uuid import uuid4
+
+import key
+from client import BackboneClient
+from cluster import BackboneCluster, Broker
+from message import BackboneMessage, BackboneMessageC2C as MsgC2C
+from relay import Relay
+
+class TestCluster(unittest.TestCase):
+
+    def test_broker(self):
+        pipes = [multiprocessing.Pipe() for _ in range(3)]
+        broker = Broker([broker_end for broker_end, _ in pipes])
+        received = [[] for _ in pipes]
+        refused  = [[] for _ in pipes]
+        relays = [Relay(worker_end, deliver=lambda data, i=i: received[i].append(BackboneMessage.from_bytes(bytes(data))), refuse=refused[i].append) for i, (_, worker_end) in enumerate(pipes)]
+        threads = [threading.Thread(target=worker_relay.run) for worker_relay in relays]
+        for thread in threads:
+            thread.start()
+        broker.start()
+
+        try:
+            for worker_relay in relays:
+                worker_relay.ready()
+            self.assertTrue(broker.ready.wait(2), "The broker should be ready once every worker is.")
+
+            client_id = uuid4()
+            group_id  = uuid4()
+            relays[1].announce(client_id, True)
+            relays[0].join(group_id, True)
+            relays[2].join(group_id, True)
+            # Each worker has its own pipe, so give the broker a moment to read the announcements first:
+            time.sleep(0.1)
+
+            direct = MsgC2C(client_id, b'direct')
+            group  = MsgC2C(group_id, b'group')
+            relays[0].forward(direct.to_bytes())
+            relays[0].forward(group.to_bytes())
+            relays[0].forward(MsgC2C(uuid4(), b'unknown').to_bytes())
+            time.sleep(0.2)
+
+            self.assertEqual(received[1], [direct], "Messages should be passed on to the worker the recipient is connected to.")
+            self.assertEqual(received[2], [group], "Group messages should be passed on to the other workers with members.")
+            self.assertEqual(received[0], [], "Group messages should not be passed back to the sending worker.")
+            self.assertEqual(broker.stats()["dropped"], 1)
+
+            # A second connection for the same client, on another worker:
+            relays[2].announce(client_id, True)
+            time.sleep(0.1)
+            self.assertEqual(refused, [[], [], [client_id]], "Clients should not be able to connect to more than one worker at a time.")
+            relays[2].announce(client_id, False)
+            time.sleep(0.1)
+            relays[0].forward(direct.to_bytes())
+            time.sleep(0.2)
+            self.assertEqual(received[1], [direct, direct], "Closing the refused connection should not affect the client's first connection.")
+            self.assertEqual(received[2], [group])
+
+            relays[1].announce(client_id, False)
+            relays[2].join(group_id, False)
+            time.sleep(0.1)
+            relays[0].forward(direct.to_bytes())
+            relays[0].forward(group.to_bytes())
+            time.sleep(0.2)
+            self.assertEqual(received[1], [direct, direct], "Messages should not be passed on once the recipient has disconnected.")
+            self.assertEqual(received[2], [group], "Group messages should not be passed on once the worker has no members left.")
+        finally:
+            broker.stop(block=True)
+            for thread in threads:
+                thread.join(2)
+                self.assertFalse(thread.is_alive(), "Stopping the broker should stop the workers.")
+
+    def test_cluster(self):
+        clients = [(uuid4(), key.generate()) for _ in range(4)]
+        port    = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            cluster = BackboneCluster(settings={ "port": port, "cluster_workers": 2 }, state_dir=tmp_path)
+            for client_id, client_key in clients:
+                cluster.auth.add_client_key(client_id, client_key.public_key())
+            clients = [BackboneClient(client_id, client_key) for client_id, client_key in clients]
+
+            try:
+                self.assertTrue(cluster.start())
+                self.assertTrue(cluster.ready().wait(30), "Every worker should start listening.")
+                for client in clients:
+                    self.assertTrue(client.start("127.0.0.1", port).wait(5))
+                time.sleep(0.5)
+
+                # Whichever workers the clients ended up on, every message should arrive:
+                for sender in clients:
+                    for recipient in clients:
+                        msg = MsgC2C(recipient.id, f"{sender.id}->{recipient.id}".encode())
+                        self.assertTrue(sender.send(msg).wait(5))
+                        self.assertEqual(recipient.read(block=True), msg)
+            finally:
+                for client in clients:
+                    client.stop()
+                cluster.stop(block=True)
+            self.assertFalse(cluster.is_running(), "Stopping the cluster should stop every worker.")
+
+    def test_duplicate_connection(self):
+        client_id, client_key = uuid4(), key.generate()
+        sender_id, sender_key = uuid4(), key.generate()
+        port = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            cluster = BackboneCluster(settings={ "port": port, "cluster_workers": 2 }, state_dir=tmp_path)
+            cluster.auth.add_client_key(client_id, client_key.public_key())
+            cluster.auth.add_client_key(sender_id, sender_key.public_key())
+            client = BackboneClient(client_id, client_key)
+            sender = BackboneClient(sender_id, sender_key)
+            duplicates = []
+
+            try:
+                self.assertTrue(cluster.start())
+                self.assertTrue(cluster.ready().wait(30), "Every worker should start listening.")
+                self.assertTrue(client.start("127.0.0.1", port).wait(5))
+                self.assertTrue(sender.start("127.0.0.1", port).wait(5))
+                time.sleep(0.5)
+
+                # Connections are spread across the workers by the kernel, so connect a few times to be sure
+                # that some of them end up on the other worker:
+                for _ in range(6):
+                    duplicate = BackboneClient(client_id, client_key)
+                    duplicates.append(duplicate)
+                    duplicate.start("127.0.0.1", port).wait(5)
+                    deadline = time.monotonic() + 5
+                    while duplicate.is_running() and time.monotonic() < deadline:
+                        time.sleep(0.1)
+                    self.assertFalse(duplicate.is_running(), "A second connection for a connected client should be refused, whichever worker it is on.")
+
+                self.assertTrue(client.is_running())
+                msg = MsgC2C(client_id, b'still connected')
+                self.assertTrue(sender.send(msg).wait(5))
+                self.assertEqual(client.read(block=True), msg, "Refusing a second connection should not affect the first.")
+                self.assertEqual(cluster.stats()["clients"], 2)
+            finally:
+                for running in [client, sender] + duplicates:
+                    running.stop()
+                cluster.stop(block=True)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
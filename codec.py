@@ -0,0 +1,65 @@
+# codec.py
+# Compression codecs for message data. The server offers the codecs it knows in its CONFIG message,
+# the client picks one and announces it in a CONFIG message of its own, after which both ends may
+# compress the messages they send.
+import zlib
+
+# Set on the first byte of a message when the rest of the message has been compressed:
+COMPRESSED_FLAG = 0x80
+# Messages smaller than this (in bytes) are always sent uncompressed:
+COMPRESSION_THRESHOLD = 256
+
+# Codecs by name, in order of preference:
+_codecs = {}
+
+# Adds a codec. compress(data) -> bytes, decompress(data, max_size) -> bytes must raise ValueError
+# if the data is invalid or decompresses to more than max_size bytes.
+def register(name:str, compress, decompress):
+    _codecs[name] = (compress, decompress)
+
+def names() -> list[str]:
+    return list(_codecs.keys())
+
+# Returns the first of the offered codecs that is available, or None.
+def select(offered:list[str]) -> str | None:
+    for name in offered:
+        if name in _codecs:
+            return name
+    return None
+
+# Compresses everything but the first byte of the message, which gets the compressed flag.
+# Returns the message unchanged if it is below the threshold, no codec is given or it doesn't get smaller.
+def compress_message(data:bytes, name:str|None, threshold:int=COMPRESSION_THRESHOLD) -> bytes:
+    if name == None or len(data) < threshold:
+        return data
+
+    compress, _ = _codecs[name]
+    compressed = compress(data[1:])
+    if len(compressed) + 1 >= len(data):
+        return data
+    return (data[0] | COMPRESSED_FLAG).to_bytes(1) + compressed
+
+# Reverses compress_message. Raises ValueError if the message is compressed but no codec has been negotiated.
+def decompress_message(data:bytes, name:str|None, max_size:int=2**24) -> bytes:
+    if len(data) == 0 or not data[0] & COMPRESSED_FLAG:
+        return data
+
+    if name == None:
+        raise ValueError("Received a compressed message, but no compression codec has been negotiated.")
+
+    _, decompress = _codecs[name]
+    return (data[0] & ~COMPRESSED_FLAG).to_bytes(1) + decompress(data[1:], max_size)
+
+
+def _zlib_decompress(data:bytes, max_size:int) -> bytes:
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ValueError(f"Invalid zlib data: {e}")
+    # Guard against small messages that decompress to huge amounts of data:
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed message exceeds {max_size} bytes")
+    return result
+
+register("zlib", zlib.compress, _zlib_decompress)
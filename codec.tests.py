@@ -0,0 +1,48 @@
+from os import urandom
+import unittest
+import zlib
+
+import codec
+
+class TestCodec(unittest.TestCase):
+
+    def test_select(self):
+        self.assertIn("zlib", codec.names())
+        self.assertEqual(codec.select(["unknown", "zlib"]), "zlib", "The first available codec should be selected.")
+        self.assertIsNone(codec.select(["unknown"]))
+
+    def test_compress_message(self):
+        data = b'\x00' + b'{"text": "hello"}' * 100
+        compressed = codec.compress_message(data, "zlib")
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(compressed[0], codec.COMPRESSED_FLAG, "Compressed messages should have the flag set on the first byte.")
+        self.assertEqual(codec.decompress_message(compressed, "zlib"), data)
+
+        self.assertEqual(codec.compress_message(data[:codec.COMPRESSION_THRESHOLD-1], "zlib"), data[:codec.COMPRESSION_THRESHOLD-1], "Messages below the threshold should not be compressed.")
+        self.assertEqual(codec.compress_message(data, None), data, "Messages should not be compressed without a codec.")
+        random_data = b'\x00' + urandom(1000)
+        self.assertEqual(codec.compress_message(random_data, "zlib"), random_data, "Messages that don't get smaller should be sent as they are.")
+        self.assertEqual(codec.decompress_message(random_data, "zlib"), random_data, "Uncompressed messages should be returned as they are.")
+
+    def test_decompress_failures(self):
+        data = b'\x00' + bytes(2**16)
+        compressed = codec.compress_message(data, "zlib")
+
+        with self.assertRaises(ValueError, msg="Compressed messages should be rejected when no codec has been negotiated."):
+            codec.decompress_message(compressed, None)
+        with self.assertRaises(ValueError, msg="Messages that decompress to more than max_size should be rejected."):
+            codec.decompress_message(compressed, "zlib", max_size=2**10)
+        with self.assertRaises(ValueError, msg="Invalid data should be rejected."):
+            codec.decompress_message(b'\x80' + urandom(100), "zlib")
+
+    def test_register(self):
+        codec.register("test", lambda data: zlib.compress(data, 9), lambda data, max_size: zlib.decompress(data))
+        try:
+            self.assertEqual(codec.select(["test"]), "test")
+            data = b'\x00' + bytes(1000)
+            self.assertEqual(codec.decompress_message(codec.compress_message(data, "test"), "test"), data)
+        finally:
+            del codec._codecs["test"]
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -1,43 +1,338 @@
+import asyncio
+import os
+from concurrent.futures import Executor
+
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 import key
 
-def read(conn, private_key:rsa.RSAPrivateKey=None):
-    l_b = conn.recv(2)
+# Size of the length header for each frame version. Version 1 is used until the client and server
+# have agreed on another version during the challenge:
+HEADER_SIZES = {
+    1: 2,
+    2: 4
+}
+# Highest frame version supported:
+FRAME_VERSION = 2
+
+# Optional executor used to encrypt and decrypt the RSA blocks of large frames in parallel, see set_crypto_executor:
+_crypto_executor  = None
+_crypto_parts     = 1
+_crypto_threshold = 2**16
+
+# Frames of at least threshold bytes are encrypted/decrypted by splitting their blocks into parts
+# that run on the executor. Use None to do all of the work on the calling thread.
+def set_crypto_executor(executor:Executor|None, threshold:int=2**16, parts:int=None):
+    global _crypto_executor, _crypto_parts, _crypto_threshold
+    _crypto_executor  = executor
+    _crypto_parts     = parts if parts != None else (os.cpu_count() or 1)
+    _crypto_threshold = threshold
+
+class FrameTooLarge(ValueError):
+    def __init__(self, size:int, max_size:int):
+        super().__init__(f"Frame of {size} bytes exceeds the maximum frame size ({max_size} bytes)")
+
+# Reads frames from a single connection into a reusable buffer. Partially received frames are kept
+# when the socket times out, so the next call continues where the previous one stopped.
+class FrameReader:
+    def __init__(self, conn, private_key:rsa.RSAPrivateKey|key.Session=None, version:int=1, max_size:int=None, buffer_size:int=2**16):
+        self.conn = conn
+        self.private_key = private_key
+        self.version = version
+        self.max_size = max_size
+        self._cipher = key.CipherContext(private_key) if isinstance(private_key, rsa.RSAPrivateKey) else None
+
+        self._header_size = HEADER_SIZES[version]
+        self._buffer = bytearray(max(buffer_size, self._header_size))
+        # Position of the current frame and the end of the data received so far:
+        self._start = 0
+        self._end   = 0
+        # Length of the current frame's payload, once the header has been received:
+        self._length = None
+        # RSA blocks are decrypted as they arrive, AES-GCM needs the whole frame to verify the tag:
+        self._plain = None
+        self._decrypted = 0
+
+    # Returns the next frame, or None for an empty frame. Raises TimeoutError if the socket times out
+    # before the frame is complete and ConnectionError if the connection is closed.
+    def read(self):
+        while True:
+            complete, data = self._parse()
+            if complete:
+                return data
+            self._fill()
+
+    # Reads whatever is available on the socket with a single call and returns all completed frames.
+    # Intended for sockets known to be readable, e.g. from a selector.
+    def read_available(self) -> list[bytes]:
+        self._fill()
+        frames = []
+        while True:
+            complete, data = self._parse()
+            if not complete:
+                return frames
+            if data != None:
+                frames.append(data)
+
+    def _fill(self):
+        if self._end == len(self._buffer):
+            self._make_room()
+
+        with memoryview(self._buffer) as view:
+            n = self.conn.recv_into(view[self._end:])
+
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        self._end += n
+
+    # Moves the current frame to the start of the buffer, replacing the buffer with a larger one if the frame doesn't fit:
+    def _make_room(self):
+        pending = self._end - self._start
+        needed  = self._header_size + (self._length if self._length != None else 0)
+
+        if self._start > 0 and needed <= len(self._buffer):
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            buffer = bytearray(max(needed, 2 * len(self._buffer)))
+            buffer[:pending] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+
+        self._start = 0
+        self._end   = pending
+
+    # Returns (True, frame) once the current frame is complete, otherwise (False, None).
+    def _parse(self):
+        available = self._end - self._start
+
+        if self._length == None:
+            if available < self._header_size:
+                return False, None
+            self._length = int.from_bytes(self._buffer[self._start:self._start+self._header_size])
+            _check_size(self._length, self.version, self.max_size)
+            # Large frames are decrypted in parallel once complete instead of block by block:
+            self._plain = bytearray() if self._cipher != None and not _offload(self._length) else None
+            self._decrypted = 0
+            if self._length > 0:
+                print(f"Receiving {self._length} bytes")
+
+        payload_start = self._start + self._header_size
+        received = min(available - self._header_size, self._length)
+
+        if self._plain != None:
+            self._decrypt_blocks(payload_start, received, received == self._length)
+
+        if received < self._length:
+            return False, None
+
+        frame_end = payload_start + self._length
+        if self._length == 0:
+            data = None
+        elif self.private_key == None:
+            data = bytes(self._buffer[payload_start:frame_end])
+        elif self._plain != None:
+            data = bytes(self._plain)
+        else:
+            with memoryview(self._buffer) as view:
+                data = _decrypt(self.private_key, view[payload_start:frame_end])
+
+        self._start  = frame_end
+        self._length = None
+        self._plain  = None
+        if self._start == self._end:
+            self._start = self._end = 0
+
+        return True, data
+
+    def _decrypt_blocks(self, payload_start:int, received:int, final:bool):
+        block_size = self._cipher.block_size
+        with memoryview(self._buffer) as view:
+            while self._decrypted + block_size <= received:
+                self._plain += self._cipher.decrypt_block(view[payload_start+self._decrypted:payload_start+self._decrypted+block_size])
+                self._decrypted += block_size
+
+            if final and self._decrypted < received:
+                self._plain += self._cipher.decrypt_block(view[payload_start+self._decrypted:payload_start+received])
+                self._decrypted = received
+
+
+# Collects frames for a single connection and writes them to the socket together, so that a burst
+# of messages costs one system call instead of one per frame.
+class FrameWriter:
+    def __init__(self, conn, public_key:rsa.RSAPublicKey|key.Session=None, version:int=1, max_size:int=None, coalesce_size:int=2**16):
+        self.conn = conn
+        self.public_key = public_key
+        self.version = version
+        self.max_size = max_size
+        # Amount of pending data (in bytes) after which callers should flush rather than add more frames:
+        self.coalesce_size = coalesce_size
+
+        self._pending = []
+        self.pending_size = 0
+
+    # Adds a frame to the output buffer, raises FrameTooLarge without buffering anything if the frame is too large.
+    def write(self, msg:bytes):
+        data = msg if self.public_key == None else _encrypt(self.public_key, msg)
+        l = len(data)
+        _check_size(l, self.version, self.max_size)
+        print(f"Sending {l} bytes")
+
+        self._pending.append(l.to_bytes(HEADER_SIZES[self.version]))
+        self._pending.append(data)
+        self.pending_size += HEADER_SIZES[self.version] + l
+
+    def full(self) -> bool:
+        return self.pending_size >= self.coalesce_size
+
+    # Writes all buffered frames to the socket.
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+        _send_buffers(self.conn, self.take())
+
+    # Removes and returns the buffered frames (as a list of buffers) without writing them,
+    # for connections that aren't plain sockets, e.g. asyncio streams.
+    def take(self) -> list:
+        pending = self._pending
+        self._pending = []
+        self.pending_size = 0
+        return pending
+
+    def send(self, msg:bytes):
+        self.write(msg)
+        self.flush()
+
+
+# Returns the next frame, or None for an empty frame. Raises ConnectionError if the connection is closed.
+def read(conn, private_key:rsa.RSAPrivateKey|key.Session=None, version:int=1, max_size:int=None):
+    l_b = _recv_exact(conn, HEADER_SIZES[version])
     l   = int.from_bytes(l_b)
 
     if l == 0:
         return None
     
+    _check_size(l, version, max_size)
+
     print(f"Receiving {l} bytes")
 
-    data = conn.recv(l)
+    data = _recv_exact(conn, l)
 
     if (private_key == None):
         return data
     
     # TODO: Add a function to decrypt directly from socket.
-    return key.decrypt(private_key, data)
+    return _decrypt(private_key, data)
     
 
-def send(conn, msg, public_key:rsa.RSAPublicKey=None):
+def send(conn, msg, public_key:rsa.RSAPublicKey|key.Session=None, version:int=1, max_size:int=None):
     
     if public_key == None:
         # Send clear text:
         l = len(msg)
+        _check_size(l, version, max_size)
         print(f"Sending {l} bytes")
 
-        l_b = l.to_bytes(2)
-        conn.send(l_b)
-        conn.sendall(msg)
+        l_b = l.to_bytes(HEADER_SIZES[version])
+        _send_buffers(conn, [l_b, msg])
         return
         
     # Send encrypted:
-    enc_data = key.encrypt(public_key, msg)
+    enc_data = _encrypt(public_key, msg)
     l = len(enc_data)
+    _check_size(l, version, max_size)
     print(f"Sending {l} bytes")
     
-    l_b = l.to_bytes(2)
-    conn.send(l_b)
-    conn.sendall(enc_data)
+    l_b = l.to_bytes(HEADER_SIZES[version])
+    _send_buffers(conn, [l_b, enc_data])
     
+
+
+# asyncio equivalent of read, raises asyncio.IncompleteReadError if the stream closes mid-frame.
+async def read_async(reader:asyncio.StreamReader, private_key:rsa.RSAPrivateKey|key.Session=None, version:int=1, max_size:int=None):
+    l_b = await reader.readexactly(HEADER_SIZES[version])
+    l   = int.from_bytes(l_b)
+
+    if l == 0:
+        return None
+
+    _check_size(l, version, max_size)
+
+    data = await reader.readexactly(l)
+
+    if (private_key == None):
+        return data
+
+    return _decrypt(private_key, data)
+
+
+# asyncio equivalent of send.
+async def send_async(writer:asyncio.StreamWriter, msg, public_key:rsa.RSAPublicKey|key.Session=None, version:int=1, max_size:int=None):
+    data = msg if public_key == None else _encrypt(public_key, msg)
+    _check_size(len(data), version, max_size)
+
+    writer.write(len(data).to_bytes(HEADER_SIZES[version]) + data)
+    await writer.drain()
+
+
+# Returns the largest frame that can be sent using the given version, limited to max_size if provided.
+def max_frame_size(version:int=1, max_size:int=None) -> int:
+    header_max = 2**(8*HEADER_SIZES[version]) - 1
+    return header_max if max_size == None else min(header_max, max_size)
+
+# Frames (and even headers) may arrive in several pieces, keep reading until we have all of it.
+# Raises ConnectionError if the connection is closed first.
+def _recv_exact(conn, l:int) -> bytes:
+    chunks = []
+    received = 0
+    while received < l:
+        chunk = conn.recv(l - received)
+        if chunk == b'':
+            raise ConnectionError(f"Connection closed after {received} of {l} bytes")
+        chunks.append(chunk)
+        received += len(chunk)
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+# Most platforms limit the number of buffers passed to a single sendmsg call:
+_MAX_SEND_BUFFERS = 512
+
+# Writes all buffers to the socket, using scatter-gather I/O where available so that the
+# header and payload don't need to be copied together or sent separately:
+def _send_buffers(conn, buffers:list):
+    if not hasattr(conn, "sendmsg"):
+        # Windows sockets don't support sendmsg:
+        conn.sendall(b''.join(buffers))
+        return
+
+    views = [memoryview(buffer) for buffer in buffers]
+    while len(views) > 0:
+        sent = conn.sendmsg(views[:_MAX_SEND_BUFFERS])
+
+        # Drop the buffers that were sent completely and trim the one that was sent partially:
+        i = 0
+        while i < len(views) and sent >= len(views[i]):
+            sent -= len(views[i])
+            i += 1
+        views = views[i:]
+        if sent > 0:
+            views[0] = views[0][sent:]
+
+def _check_size(size:int, version:int, max_size:int):
+    limit = max_frame_size(version, max_size)
+    if size > limit:
+        raise FrameTooLarge(size, limit)
+
+def _offload(size:int) -> bool:
+    return _crypto_executor != None and _crypto_parts > 1 and size >= _crypto_threshold
+
+def _encrypt(public_key:rsa.RSAPublicKey|key.Session, msg:bytes) -> bytes:
+    if isinstance(public_key, key.Session):
+        return public_key.encrypt(msg)
+    if _offload(len(msg)):
+        return bytes(key.CipherContext(public_key).encrypt(msg, _crypto_executor, _crypto_parts))
+    return key.encrypt(public_key, msg)
+
+def _decrypt(private_key:rsa.RSAPrivateKey|key.Session, data:bytes) -> bytes:
+    if isinstance(private_key, key.Session):
+        return private_key.decrypt(data)
+    if _offload(len(data)):
+        return bytes(key.CipherContext(private_key).decrypt(data, _crypto_executor, _crypto_parts))
+    return key.decrypt(private_key, data)
@@ -1,6 +1,9 @@
 from os import urandom
 import socket
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import frame, key
 
@@ -34,5 +37,218 @@ class TestFrameFunctions(unittest.TestCase):
         sock1.close()
         sock2.close()
 
+    def test_session_encrypted(self):
+        secret = urandom(key.SESSION_SECRET_SIZE)
+        salt   = urandom(2048)
+        client_session = key.Session(secret, salt, initiator=True)
+        server_session = key.Session(secret, salt, initiator=False)
+
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        l = 256
+        data = urandom(l)
+        frame.send(sock1, data, client_session)
+        self.assertEqual(data, frame.read(sock2, server_session), "Data receiveed across the socket connection should match the data sent")
+        frame.send(sock1, data, client_session)
+        with self.assertRaises(
+            ValueError,
+            msg="Should raise a ValueError if the sending end of the session is used to decrypt the data."
+        ):
+            frame.read(sock2, client_session)
+        sock1.close()
+        sock2.close()
+
+    def test_extended_header(self):
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        data = urandom(2**17)
+        with self.assertRaises(frame.FrameTooLarge, msg="Version 1 frames can't be larger than 64KiB."):
+            frame.send(sock1, data)
+        with self.assertRaises(frame.FrameTooLarge, msg="Frames larger than max_size should not be sent."):
+            frame.send(sock1, data, version=2, max_size=2**16)
+
+        result = {}
+        reader = threading.Thread(target=lambda: result.update(data=frame.read(sock2, version=2)))
+        reader.start()
+        frame.send(sock1, data, version=2)
+        reader.join(timeout=3)
+        self.assertEqual(data, result["data"], "Version 2 frames should carry more than 64KiB.")
+
+        frame.send(sock1, data[:2**10], version=2)
+        with self.assertRaises(frame.FrameTooLarge, msg="Frames larger than max_size should be rejected by the reader."):
+            frame.read(sock2, version=2, max_size=2**9)
+        sock1.close()
+        sock2.close()
+
+    def test_split_header(self):
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        data = urandom(256)
+        try:
+            # The header arrives in two pieces, which should not throw the reader off:
+            def send_split():
+                header = len(data).to_bytes(frame.HEADER_SIZES[2])
+                sock1.sendall(header[:1])
+                time.sleep(0.1)
+                sock1.sendall(header[1:] + data)
+            sender = threading.Thread(target=send_split)
+            sender.start()
+            self.assertEqual(frame.read(sock2, version=2), data)
+            sender.join()
+
+            sock1.close()
+            with self.assertRaises(ConnectionError, msg="A closed connection should not be read as an empty frame."):
+                frame.read(sock2, version=2)
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_crypto_executor(self):
+        private_key = key.generate()
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        reader = frame.FrameReader(sock2, private_key, version=2)
+
+        try:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                frame.set_crypto_executor(executor, threshold=2**12, parts=4)
+                for l in (2**10, 2**15):
+                    data = urandom(l)
+                    sender = threading.Thread(target=frame.send, args=(sock1, data, private_key.public_key(), 2))
+                    sender.start()
+                    self.assertEqual(data, reader.read(), "Frames should decrypt the same with and without the crypto executor.")
+                    sender.join()
+
+                    sender = threading.Thread(target=frame.send, args=(sock1, data, private_key.public_key(), 2))
+                    sender.start()
+                    self.assertEqual(data, frame.read(sock2, private_key, version=2))
+                    sender.join()
+        finally:
+            frame.set_crypto_executor(None)
+            sock1.close()
+            sock2.close()
+
+class TestFrameReader(unittest.TestCase):
+
+    def test_partial_frames(self):
+        private_key = key.generate()
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        sock2.settimeout(0.1)
+        reader = frame.FrameReader(sock2, private_key, buffer_size=64)
+
+        data = urandom(1000)
+        enc_data = key.encrypt(private_key.public_key(), data)
+        raw = len(enc_data).to_bytes(2) + enc_data
+
+        try:
+            # Send the frame in pieces, timing out between each of them:
+            for i in range(0, len(raw), 300):
+                sock1.sendall(raw[i:i+300])
+                if i + 300 < len(raw):
+                    with self.assertRaises(TimeoutError, msg="The reader should time out while the frame is incomplete."):
+                        reader.read()
+            self.assertEqual(data, reader.read(), "Partially received data should be kept across timeouts.")
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_multiple_frames(self):
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        reader = frame.FrameReader(sock2, version=2, buffer_size=16)
+
+        sent = [urandom(l) for l in (10, 0, 2**17, 5)]
+        raw = b''.join(len(data).to_bytes(4) + data for data in sent)
+
+        try:
+            sender = threading.Thread(target=sock1.sendall, args=(raw,))
+            sender.start()
+            received = [reader.read() for _ in sent]
+            sender.join()
+            self.assertEqual(received, [sent[0], None, sent[2], sent[3]], "Frames should be returned in order, with None for empty frames.")
+
+            sock1.sendall(raw[:2**10])
+            sock2.settimeout(1)
+            self.assertEqual(reader.read_available(), [sent[0]], "read_available should only return completed frames.")
+
+            sock1.close()
+            with self.assertRaises(ConnectionError, msg="The reader should raise a ConnectionError once the connection is closed."):
+                while True:
+                    reader.read()
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_session(self):
+        secret = urandom(key.SESSION_SECRET_SIZE)
+        salt   = urandom(2048)
+        client_session = key.Session(secret, salt, initiator=True)
+        server_session = key.Session(secret, salt, initiator=False)
+
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        reader = frame.FrameReader(sock2, server_session)
+
+        try:
+            for l in (16, 2**12, 2**15):
+                data = urandom(l)
+                frame.send(sock1, data, client_session)
+                self.assertEqual(data, reader.read())
+        finally:
+            sock1.close()
+            sock2.close()
+
+class TestFrameWriter(unittest.TestCase):
+
+    def test_coalesced_frames(self):
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        writer = frame.FrameWriter(sock1, version=2, coalesce_size=2**10)
+        reader = frame.FrameReader(sock2, version=2)
+
+        sent = [urandom(l) for l in (10, 200, 500, 400)]
+
+        try:
+            for data in sent:
+                self.assertFalse(writer.full(), "The writer should not be full before the coalesce size is reached.")
+                writer.write(data)
+            self.assertTrue(writer.full(), "The writer should be full once the coalesce size is reached.")
+
+            writer.flush()
+            self.assertEqual(writer.pending_size, 0, "Flushing should empty the writer.")
+            self.assertEqual([reader.read() for _ in sent], sent, "Coalesced frames should be read back in order.")
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_too_large(self):
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        writer = frame.FrameWriter(sock1, version=2, max_size=100)
+        reader = frame.FrameReader(sock2, version=2)
+
+        try:
+            writer.write(b'first')
+            with self.assertRaises(frame.FrameTooLarge):
+                writer.write(urandom(101))
+            writer.write(b'second')
+            writer.flush()
+            self.assertEqual([reader.read(), reader.read()], [b'first', b'second'], "Frames that are too large should not be buffered.")
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_large_send(self):
+        sock1, sock2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        reader = frame.FrameReader(sock2, version=2)
+
+        # More buffers than a single sendmsg call accepts, and more data than the socket buffer holds:
+        sent = [urandom(2**12) for _ in range(600)]
+
+        try:
+            writer = frame.FrameWriter(sock1, version=2)
+            for data in sent:
+                writer.write(data)
+            sender = threading.Thread(target=writer.flush)
+            sender.start()
+            received = [reader.read() for _ in sent]
+            sender.join()
+            self.assertEqual(received, sent, "All frames should arrive intact when the data is sent in several calls.")
+        finally:
+            sock1.close()
+            sock2.close()
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
\ No newline at end of file
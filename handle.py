@@ -1,17 +1,25 @@
 # handle.py
 # Client handler and associated functionality
-from threading import Thread, Event, Semaphore
+from threading import Thread, Event, Lock, Semaphore
 import socket
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
+import json
+import functools
 
 from uuid import UUID
 from queue import Empty, Queue
 
+import codec
 import frame
-from message import BackboneMessage, BackboneMessageC2S as MsgC2S, BackboneC2SType as MsgC2SType, BackboneMessageFormat as MsgFormat, BackboneMessageS2S as MsgS2S, BackboneS2SType as MsgS2SType
+import timer
+from message import BackboneMessage, BackboneMessageBatch as MsgBatch, BackboneMessageC2S as MsgC2S, BackboneC2SType as MsgC2SType, BackboneMessageFormat as MsgFormat, BackboneMessageS2S as MsgS2S, BackboneS2SType as MsgS2SType
 
 from identity import Identity, IdentityComponent
+from reactor import Reactor
+from relay import Relay
+from spool import Spool
+from wakeup import StopFlag
 
 class TerminateTaskGroup(Exception):
     def __init__(self):
@@ -19,43 +27,393 @@ class TerminateTaskGroup(Exception):
 
 # Global server queue, used to pass messages to the main thread
 server_queue = Queue()
+# What happens when a message is routed to a client queue that has reached its limit:
+#   block:       the sender waits (up to the block timeout) for the queue to drain, then drops the message.
+#                Senders on threads shared with other clients (reactors, the relay) drop the message instead.
+#   drop_oldest: the oldest message on the queue is dropped to make room
+#   drop_newest: the new message is dropped
+#   disconnect:  the recipient is disconnected
+QUEUE_POLICIES = ("block", "drop_oldest", "drop_newest", "disconnect")
+
+# Client queue with a limit on the number of routed messages it holds. Messages routed from other clients
+# are added with offer, which applies the queue's policy. put is left unbounded for messages from the
+# server itself (e.g. STOP), which must always be queued.
+class ClientQueue(Queue):
+    def __init__(self, limit:int=0, policy:str="drop_newest", block_timeout:float=1) -> None:
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy '{policy}', expected one of: {', '.join(QUEUE_POLICIES)}")
+        super().__init__()
+        self.limit = limit
+        self.policy = policy
+        self.block_timeout = block_timeout
+        # Statistics, see stats():
+        self.high_water = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.overflowed = False
+        # Set once the handler has stopped reading the queue, see close():
+        self.closed = False
+
+    # Adds a routed message, returns False if the message (or the recipient) was dropped because the queue was full.
+    # on_taken is called once the message has left the queue, whether it was read, dropped or the queue was closed.
+    # It isn't called if offer returns False. When block is False the "block" policy drops the message rather than waiting.
+    def offer(self, msg:BackboneMessage, on_taken=None, block:bool=True) -> bool:
+        # Callbacks for dropped messages are made after the lock has been released, since they may put
+        # messages on other queues:
+        dropped = None
+        with self.not_full:
+            if self.closed:
+                return False
+            if 0 < self.limit <= self._qsize():
+                policy = self.policy if block or self.policy != "block" else "drop_newest"
+                match policy:
+                    case "block":
+                        self.blocked += 1
+                        deadline = time.monotonic() + self.block_timeout
+                        while self._qsize() >= self.limit:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0 or self.closed:
+                                self.dropped += 1
+                                return False
+                            self.not_full.wait(remaining)
+                    case "drop_oldest":
+                        # Messages from the server (e.g. STOP) and wakeups are never dropped:
+                        if not isinstance(self.queue[0], tuple) and (self.queue[0] == None or self.queue[0].format != MsgFormat.C2C):
+                            self.dropped += 1
+                            return False
+                        dropped = self._get()
+                        self.unfinished_tasks -= 1
+                        self.dropped += 1
+                    case "drop_newest":
+                        self.dropped += 1
+                        return False
+                    case "disconnect":
+                        if not self.overflowed:
+                            self.overflowed = True
+                            self._put(MsgS2S(MsgS2SType.STOP, payload=b'queue limit exceeded'))
+                            self.unfinished_tasks += 1
+                            self.not_empty.notify()
+                        self.dropped += 1
+                        return False
+
+            self._put(msg if on_taken == None else (msg, on_taken))
+            self.unfinished_tasks += 1
+            self.high_water = max(self.high_water, self._qsize())
+            self.not_empty.notify()
+
+        if isinstance(dropped, tuple):
+            dropped[1]()
+        return True
+
+    # Returns None if the reader was woken up, see wake().
+    def get(self, block=True, timeout=None) -> BackboneMessage | None:
+        item = super().get(block, timeout)
+        if isinstance(item, tuple):
+            item[1]()
+            return item[0]
+        return item
+
+    # Puts None on the queue, so that a reader blocked in get returns without waiting for a message.
+    def wake(self):
+        with self.not_empty:
+            self._put(None)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    # Stops accepting routed messages and empties the queue, so that callbacks for messages that
+    # will never be read are still made.
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            items = list(self.queue)
+            self.queue.clear()
+            self.not_full.notify_all()
+        for item in items:
+            if isinstance(item, tuple):
+                item[1]()
+
+    def stats(self) -> dict:
+        with self.mutex:
+            return {
+                "depth": self._qsize(),
+                "limit": self.limit,
+                "policy": self.policy,
+                "high_water": self.high_water,
+                "dropped": self.dropped,
+                "blocked": self.blocked
+            }
+
+# Number of C2C messages a client may send before the messages it has sent are taken off the recipients' queues.
+# Credit is returned to the client in CREDIT messages, once a quarter of the window can be granted at a time.
+class CreditWindow:
+    def __init__(self, size:int) -> None:
+        self.size = size
+        self._lock = Lock()
+        self._available = size
+        self._pending = 0
+
+    # Takes credit for a message, returns False if the client has none left.
+    def consume(self) -> bool:
+        with self._lock:
+            if self._available <= 0:
+                return False
+            self._available -= 1
+            return True
+
+    # Returns credit for a message that has left the recipient's queue (or was never queued).
+    # Returns the amount of credit to grant the client, or 0 if it should be held back for now.
+    def release(self) -> int:
+        with self._lock:
+            self._pending += 1
+            if self._pending < max(1, self.size // 4):
+                return 0
+            grant = self._pending
+            self._pending = 0
+            self._available += grant
+            return grant
+
+# Limits applied to new client queues, see set_queue_limits:
+_queue_limits = {
+    "limit": 0,
+    "policy": "drop_newest",
+    "block_timeout": 1,
+    "overrides": {}
+}
+
+# Sets the limit and policy of client queues created from now on. overrides maps client IDs (as hex strings)
+# to a dict that replaces any of limit, policy and block_timeout for that client.
+def set_queue_limits(limit:int=0, policy:str="drop_newest", block_timeout:float=1, overrides:dict={}):
+    if policy not in QUEUE_POLICIES:
+        raise ValueError(f"Unknown queue policy '{policy}', expected one of: {', '.join(QUEUE_POLICIES)}")
+    _queue_limits["limit"] = limit
+    _queue_limits["policy"] = policy
+    _queue_limits["block_timeout"] = block_timeout
+    _queue_limits["overrides"] = { UUID(hex=client_id).bytes: override for client_id, override in overrides.items() }
+
+# Returns the limit, policy and block timeout for the client's queue, taking its overrides into account.
+def get_queue_limits(client_id:UUID) -> tuple[int, str, float]:
+    limits = _queue_limits
+    overrides = limits["overrides"][client_id.bytes] if client_id.bytes in limits["overrides"] else {}
+    return (
+        overrides["limit"] if "limit" in overrides else limits["limit"],
+        overrides["policy"] if "policy" in overrides else limits["policy"],
+        overrides["block_timeout"] if "block_timeout" in overrides else limits["block_timeout"]
+    )
+
+def _new_client_queue(client_id:UUID) -> ClientQueue:
+    return ClientQueue(*get_queue_limits(client_id))
+
+# Shortest time (in seconds) between two THROTTLE messages to the same client:
+THROTTLE_INTERVAL = 1
+
+# Number of independently locked shards in the routing table:
+ROUTING_SHARDS = 16
+
+# Client queues keyed by the raw bytes of the client ID, split across several shards so that handlers
+# registering and deregistering at the same time don't all wait on the same lock. Lookups don't take a
+# lock at all, since reading a single key from a dict is atomic.
+#
+# The table also tracks group subscriptions, so that a C2C message addressed to a group ID can be
+# delivered to every subscribed client.
+class RoutingTable:
+    def __init__(self, shards:int=ROUTING_SHARDS) -> None:
+        self._shards = [{} for _ in range(shards)]
+        self._groups = [{} for _ in range(shards)]
+        self._locks  = [Lock() for _ in range(shards)]
+
+    def get(self, client_id:UUID) -> Queue | None:
+        key = client_id.bytes
+        return self._shards[key[15] % len(self._shards)].get(key)
+
+    # Subscriptions belong to the connection (Identity) that made them, so a stale connection
+    # unsubscribing doesn't remove the subscription of a newer connection for the same client.
+    # Returns True if the client is the group's first member.
+    def subscribe(self, group_id:UUID, client:Identity) -> bool:
+        key = group_id.bytes
+        i = key[15] % len(self._groups)
+        with self._locks[i]:
+            created = key not in self._groups[i]
+            if created:
+                self._groups[i][key] = {}
+            self._groups[i][key][client.id.bytes] = client
+            return created
+
+    # Returns True if the client was the group's last member.
+    def unsubscribe(self, group_id:UUID, client:Identity) -> bool:
+        key = group_id.bytes
+        i = key[15] % len(self._groups)
+        with self._locks[i]:
+            members = self._groups[i].get(key)
+            if members == None or members.get(client.id.bytes) is not client:
+                return False
+            del members[client.id.bytes]
+            if len(members) == 0:
+                del self._groups[i][key]
+                return True
+            return False
+
+    # Returns the queues of all connected members of the group.
+    def members(self, group_id:UUID) -> list[Queue]:
+        key = group_id.bytes
+        i = key[15] % len(self._groups)
+        with self._locks[i]:
+            members = self._groups[i].get(key)
+            client_keys = list(members.keys()) if members != None else []
+
+        queues = []
+        for client_key in client_keys:
+            queue = self._shards[client_key[15] % len(self._shards)].get(client_key)
+            if queue != None:
+                queues.append(queue)
+        return queues
+
+    # Creates a queue for the client, replacing any queue left by an earlier connection.
+    def register(self, client_id:UUID) -> Queue:
+        key = client_id.bytes
+        i = key[15] % len(self._shards)
+        queue = _new_client_queue(client_id)
+        with self._locks[i]:
+            self._shards[i][key] = queue
+        return queue
+
+    # Removes the client's queue. If a queue is given it is only removed if it is still the registered one,
+    # so a handler that is shutting down doesn't remove the queue of a newer connection for the same client.
+    # Returns True if a queue was removed.
+    def deregister(self, client_id:UUID, queue:Queue=None) -> bool:
+        key = client_id.bytes
+        i = key[15] % len(self._shards)
+        with self._locks[i]:
+            if queue == None or self._shards[i].get(key) is queue:
+                return self._shards[i].pop(key, None) != None
+            return False
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    # Returns the statistics of every registered client queue, keyed by client ID.
+    def stats(self) -> dict[UUID, dict]:
+        stats = {}
+        for i in range(len(self._shards)):
+            with self._locks[i]:
+                entries = list(self._shards[i].items())
+            for key, queue in entries:
+                stats[UUID(bytes=key)] = queue.stats()
+        return stats
+
 # Individual client queues, used to pass messages to individual handlers
-queues = {}
-# Semaphore to coordinate access to the queues, since hashmaps are not thread-safe
-queues_semaphore = Semaphore()
+routes = RoutingTable()
+
+# Spool for messages addressed to clients that aren't connected, see spool.py. None drops such messages:
+_spool = None
+
+def set_spool(spool:Spool | None):
+    global _spool
+    _spool = spool
+
+def get_spool() -> Spool | None:
+    return _spool
+
+# Relay to the other worker processes of a cluster, see cluster.py. None when the server runs on its own:
+_relay = None
+# Keeps announcements to the relay in the same order as the changes to the routing table:
+_relay_lock = Lock()
+
+def set_relay(relay:Relay | None):
+    global _relay
+    _relay = relay
+
+def get_relay() -> Relay | None:
+    return _relay
 
 def get_client_queue(client_id:UUID):
-    queue = None
-    queues_semaphore.acquire()
-    if client_id.hex in queues:
-        queue = queues[client_id.hex]
-    queues_semaphore.release()
-    return queue
+    return routes.get(client_id)
 
 def get_server_queue():
     return server_queue
 
+def get_queue_stats() -> dict[UUID, dict]:
+    return routes.stats()
+
 def _register_client(client_id:UUID) -> Queue:
-    queues_semaphore.acquire()
-    queues[client_id.hex] = Queue()
-    queues_semaphore.release()
-    return queues[client_id.hex]
+    if _relay == None:
+        return routes.register(client_id)
+    with _relay_lock:
+        queue = routes.register(client_id)
+        _relay.announce(client_id, True)
+    return queue
+
+def _deregister_client(client_id:UUID, queue:Queue=None) -> None:
+    if _relay == None:
+        routes.deregister(client_id, queue)
+        return
+    with _relay_lock:
+        if routes.deregister(client_id, queue):
+            _relay.announce(client_id, False)
+
+# Workers in a cluster only tell the broker when a group gains its first, or loses its last, local member:
+def _subscribe(group_id:UUID, client:Identity) -> None:
+    if _relay == None:
+        routes.subscribe(group_id, client)
+        return
+    with _relay_lock:
+        if routes.subscribe(group_id, client):
+            _relay.join(group_id, True)
+
+def _unsubscribe(group_id:UUID, client:Identity) -> None:
+    if _relay == None:
+        routes.unsubscribe(group_id, client)
+        return
+    with _relay_lock:
+        if routes.unsubscribe(group_id, client):
+            _relay.join(group_id, False)
 
-def _deregister_client(client_id:UUID) -> None:
-    queues_semaphore.acquire()
-    queues[client_id.hex] = None
-    queues_semaphore.release()
+# Removes what the routing table holds for a connection that has ended: its group subscriptions, and its
+# queue if that is still registered (a queue is closed once its handler stops reading it).
+def release_routes(client:Identity) -> None:
+    for group_id in list(client.groups):
+        _unsubscribe(group_id, client)
+    queue = routes.get(client.id)
+    if isinstance(queue, ClientQueue) and queue.closed:
+        _deregister_client(client.id, queue)
 
+# Stops the handler of a connected client, returns False if the client isn't connected.
+def disconnect_client(client_id:UUID, reason:bytes=b'connection refused') -> bool:
+    queue = get_client_queue(client_id)
+    if queue == None:
+        return False
+    queue.put(MsgS2S(MsgS2SType.STOP, payload=reason))
+    return True
+
+# Delivers a C2C message passed on by the cluster's broker to the clients connected to this worker.
+def deliver_relayed(data:bytes) -> None:
+    msg = BackboneMessage.from_bytes(data)
+    if msg == None or msg.format != MsgFormat.C2C:
+        print(f"relay: Received something other than a C2C message, dropping it.")
+        return
+
+    recipient_queue = get_client_queue(msg.recipient)
+    queues = [recipient_queue] if recipient_queue != None else routes.members(msg.recipient)
+    if len(queues) == 0:
+        print(f"relay: Recipient {msg.recipient} is not connected, dropping message.")
+    for queue in queues:
+        # The relay thread delivers messages for every client on the worker, so it mustn't wait for a full queue:
+        ClientHandler._deliver("relay", msg, queue, block=False)
 
         
 
+# Time (in seconds) without any frames from the client before the handler assumes that it is dead:
+DEFAULT_HEARTBEAT_TIMEOUT = 30
+
 class ClientHandler:
-    def __init__(self, client_connection: socket.socket, client:Identity, server:IdentityComponent):
+    def __init__(self, client_connection: socket.socket, client:Identity, server:IdentityComponent, reactor:Reactor=None):
         self.id = client.id
         self.connection = client_connection
         self.client = client
         self.server = server
-        self.stop_flag = Event()
+        # When a reactor is provided it monitors the socket in place of a dedicated socket monitor thread:
+        self.reactor = reactor
+        # Setting the flag wakes up the monitors, so the handler stops right away:
+        self.stop_flag = StopFlag()
     
     def start(self):
         self.thread = Thread(target=self._run, daemon=True)
@@ -73,128 +431,475 @@ class ClientHandler:
     def _run(self):
         print(f"{self.id}: handler started")
 
+        try:
+            # Frames are coalesced before they are written, so Nagle's algorithm only adds latency:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
         socket_semaphore = Semaphore()
         arguments = (self.connection, socket_semaphore, self.stop_flag, self.client, self.server)
         self.queue_monitor  = Thread(target=ClientHandler._monitor_queue, args=arguments, daemon=False)
-        self.socket_monitor = Thread(target=ClientHandler._monitor_socket, args=arguments, daemon=False)
+        self.socket_monitor = None
 
         self.queue_monitor.start()
-        self.socket_monitor.start()
+        if self.reactor == None:
+            self.socket_monitor = Thread(target=ClientHandler._monitor_socket, args=arguments, daemon=False)
+            self.socket_monitor.start()
+        else:
+            self._watch_socket()
         self.stop_flag.wait()
 
         print(f"{self.id}: Handler stopping...")
 
         self.queue_monitor.join()
-        self.socket_monitor.join()
+        if self.socket_monitor != None:
+            self.socket_monitor.join()
+        else:
+            self._unwatch_socket(socket_semaphore)
 
         print(f"{self.id}: Handler stopped")
-        get_server_queue().put(MsgS2S(MsgS2SType.DONE))
-        
         self.queue_monitor = None
         self.socket_monitor = None
         self.thread = None
 
+        # The handler no longer counts as running once the DONE message can be read:
+        get_server_queue().put(MsgS2S(MsgS2SType.DONE, payload=self.id.bytes))
+
+    # Registers the socket with the reactor, which reads and routes frames as they arrive.
+    def _watch_socket(self):
+        handler_id = f"{self.id}-socket"
+        print(f"{handler_id}: Socket registered with {self.reactor.name}")
+        # The reactor only reads when data is available, the timeout only applies to sends:
+        self.connection.settimeout(10.0)
+        receive_key = self.client.session if self.client.session != None else self.server.server_state["private_key"]
+        reader = frame.FrameReader(self.connection, receive_key, self.client.frame_version, self.client.max_frame_size)
+        last_activity = time.monotonic()
+
+        def on_readable(conn:socket.socket) -> bool:
+            nonlocal last_activity
+            try:
+                frames = reader.read_available()
+            except (BlockingIOError, TimeoutError):
+                return True
+            except OSError as e:
+                print(f"{handler_id}: Failed to read data from socket: {e}")
+                self.stop_flag.set()
+                return False
+            except Exception as e:
+                print(f"{handler_id}: Failed to process data from socket: {e}")
+                self.stop_flag.set()
+                return False
+
+            last_activity = time.monotonic()
+
+            try:
+                for data in frames:
+                    msg = ClientHandler._read_message(handler_id, data, self.client)
+                    if msg == None:
+                        print(f"{handler_id}: Failed to parse data as a message: {data}")
+                        continue
+
+                    if not ClientHandler._process_message(handler_id, msg, datetime.now(), self.client, self.server, block=False):
+                        self.stop_flag.set()
+                        return False
+            except Exception as e:
+                print(f"{handler_id}: Failed to process data from socket: {e}")
+                self.stop_flag.set()
+                return False
+
+            return True
+
+        self._heartbeat_timer = ClientHandler._watch_heartbeat(handler_id, self.stop_flag, lambda: last_activity)
+        self.reactor.register(self.connection, on_readable)
+
+    def _unwatch_socket(self, send_access:Semaphore):
+        handler_id = f"{self.id}-socket"
+        self._heartbeat_timer.cancel()
+        release_routes(self.client)
+        # Wait for the reactor to let go of the socket before closing it:
+        self.reactor.unregister(self.connection).wait(timeout=5)
+        send_key = self.client.session if self.client.session != None else self.client.key
+        send_access.acquire()
+        try:
+            ClientHandler._close_connection(handler_id, self.connection, send_key, self.client.frame_version)
+        finally:
+            send_access.release()
+
     @staticmethod
-    def _monitor_queue(client_connection: socket.socket, send_access:Semaphore, stop_flag:Event, client:Identity, server:IdentityComponent):
+    def _monitor_queue(client_connection: socket.socket, send_access:Semaphore, stop_flag:StopFlag, client:Identity, server:IdentityComponent):
         handler_id = f"{client.id}-queue"
         print(f"{handler_id}: Queue monitor started")
+        send_key = client.session if client.session != None else client.key
+        # Messages that are already waiting on the queue are written to the socket together:
+        writer = frame.FrameWriter(client_connection, send_key, client.frame_version)
+        client_queue = None
         try:
             client_queue = _register_client(client.id)
+            # Stopping wakes up the monitor, rather than it checking the stop flag every so often:
+            stop_flag.on_set(client_queue.wake)
+            if _spool != None:
+                ClientHandler._replay_spool(handler_id, client, writer, send_access)
             while not stop_flag.is_set():
                 
-                try:
-                    msg = client_queue.get(timeout=1)
-                except Empty:
+                msg = client_queue.get()
+                if msg == None:
                     continue
-                
-                match msg.format:
-                    case MsgFormat.C2C:
-                        if msg.recipient != client.id:
-                            print(f"{handler_id}: Invalid routing: handler for {client.id} received message for {msg.recipient}. Dropping message!")
-                            continue
-                        send_access.acquire()
-                        frame.send(client_connection, msg.to_bytes(), client.key)
-                        send_access.release()
-                    case MsgFormat.S2S:
-                        match msg.type:
-                            case MsgS2SType.STOP:
-                                print(f"{handler_id}: Received {msg.type.name} message on queue, stopping...")
-                                break
-                    case _:
-                        print(f"{handler_id}: Recevied a {msg.format} message on queue, dropping it (only C2C or S2S permitted)")
+
+                stopping = False
+                outgoing = []
+                outgoing_size = 0
+                while True:
+                    if msg.format == MsgFormat.S2S and msg.type == MsgS2SType.STOP:
+                        print(f"{handler_id}: Received {msg.type.name} message on queue, stopping...")
+                        stopping = True
+                        break
+                    data = ClientHandler._queued_message_data(handler_id, msg, client)
+                    if data != None:
+                        outgoing.append(data)
+                        outgoing_size += len(data)
+                    if outgoing_size >= writer.coalesce_size:
+                        break
+                    try:
+                        msg = client_queue.get_nowait()
+                    except Empty:
+                        break
+                    if msg == None:
+                        break
+
+                ClientHandler._write_messages(handler_id, client, writer, outgoing)
+
+                send_access.acquire()
+                try:
+                    writer.flush()
+                finally:
+                    send_access.release()
+
+                if stopping:
+                    break
 
         finally:
             print(f"{handler_id}: QM stopping...")
-            _deregister_client(client.id)
+            if client_queue != None:
+                stop_flag.remove(client_queue.wake)
+                _deregister_client(client.id, client_queue)
+                # Return the credit of any messages left on the queue to their senders:
+                client_queue.close()
             stop_flag.set()
             print(f"{handler_id}: QM stopped")
 
+    # Returns the data to send to the client for a message taken from the client queue, or None if it should be dropped.
+    @staticmethod
+    def _queued_message_data(handler_id:str, msg:BackboneMessage, client:Identity) -> bytes | None:
+        match msg.format:
+            case MsgFormat.C2C:
+                if msg.recipient != client.id and msg.recipient not in client.groups:
+                    print(f"{handler_id}: Invalid routing: handler for {client.id} received message for {msg.recipient}. Dropping message!")
+                    return None
+                return msg.to_bytes()
+            case MsgFormat.S2S:
+                match msg.type:
+                    case MsgS2SType.THROTTLE:
+                        return MsgC2S(MsgC2SType.THROTTLE, payload=msg.payload).to_bytes()
+                    case MsgS2SType.CREDIT:
+                        return MsgC2S(MsgC2SType.CREDIT, payload=msg.payload).to_bytes()
+                return None
+            case _:
+                print(f"{handler_id}: Recevied a {msg.format} message on queue, dropping it (only C2C or S2S permitted)")
+                return None
+
+    # Adds messages to the writer, packing them into batches if the client accepts them.
     @staticmethod
-    def _monitor_socket(client_connection: socket.socket, send_access:Semaphore, stop_flag:Event, client:Identity, server:IdentityComponent):
+    def _write_messages(handler_id:str, client:Identity, writer:frame.FrameWriter, messages:list[bytes]):
+        groups = MsgBatch.group(messages) if client.batching else [[data] for data in messages]
+        for group in groups:
+            try:
+                # Batches hold messages from different senders, compressing them together would let a sender
+                # learn about the other messages from the size of the batch (as in CRIME), so only single
+                # messages are compressed:
+                writer.write(codec.compress_message(group[0], client.compression) if len(group) == 1 else MsgBatch.encode(group))
+                continue
+            except frame.FrameTooLarge as e:
+                if len(group) == 1:
+                    print(f"{handler_id}: Dropping message for {client.id}: {e}")
+                    continue
+
+            # The batch didn't fit in a frame, fall back to sending its messages one by one:
+            for data in group:
+                try:
+                    writer.write(codec.compress_message(data, client.compression))
+                except frame.FrameTooLarge as e:
+                    print(f"{handler_id}: Dropping message for {client.id}: {e}")
+
+    @staticmethod
+    def _monitor_socket(client_connection: socket.socket, send_access:Semaphore, stop_flag:StopFlag, client:Identity, server:IdentityComponent):
         handler_id = f"{client.id}-socket"
         print(f"{handler_id}: Socket monitor started")
         client_connection.setblocking(True)
+        # Stopping shuts down the receiving side of the socket to wake up the monitor, the timeout is only a fallback:
         client_connection.settimeout(1.0)
+        wake_reader = functools.partial(ClientHandler._wake_reader, client_connection)
+        stop_flag.on_set(wake_reader)
         # TODO: Implement connection settings:
-        last_activity = datetime.now()
-        heartbeat_timeout = timedelta(seconds=30)
+        last_activity = time.monotonic()
+        heartbeat_timer = ClientHandler._watch_heartbeat(handler_id, stop_flag, lambda: last_activity)
+        # Clients that established a session during the challenge use it for all frames:
+        send_key    = client.session if client.session != None else client.key
+        receive_key = client.session if client.session != None else server.server_state["private_key"]
+        reader = frame.FrameReader(client_connection, receive_key, client.frame_version, client.max_frame_size)
         try:
             while not stop_flag.is_set():
                 
                 try:
-                    data = frame.read(client_connection, server.server_state["private_key"])
-                    last_activity = datetime.now()
+                    data = reader.read()
+                    last_activity = time.monotonic()
                 except TimeoutError as e:
-                    # This is expected if the client isn't sending any messages.
-                    if heartbeat_timeout < datetime.now() - last_activity:
-                        break
+                    # This is expected if the client isn't sending any messages, the heartbeat timer deals with clients that have gone quiet.
                     continue
                 except OSError as e:
-                    print(f"{handler_id}: Failed to read data from socket: {e}")
+                    # Unless the socket was shut down to wake up the monitor:
+                    if not stop_flag.is_set():
+                        print(f"{handler_id}: Failed to read data from socket: {e}")
+                    break
+                except frame.FrameTooLarge as e:
+                    # The rest of the frame can't be skipped safely, so drop the connection:
+                    print(f"{handler_id}: {e}, closing connection.")
                     break
                 
                 # Handle the case case where the socket has a timeout and may return None,
                 # or where OS let us read 0 bytes because it turns off blocking when timeout is set:
                 if data in (None, b''):
-                    if heartbeat_timeout < datetime.now() - last_activity:
-                        break
                     continue
 
-                msg = BackboneMessage.from_bytes(data)
+                msg = ClientHandler._read_message(handler_id, data, client)
 
                 if msg == None:
                     print(f"{handler_id}: Failed to parse data as a message: {data}")
                     continue
                 
-                match msg.format:
-                    case MsgFormat.C2C:
-                        recipient_queue = get_client_queue(msg.recipient)
-                        # TODO: Handle case where the recipient is not connected
-                        recipient_queue.put(msg)
-                        continue
-
-                    case MsgFormat.C2S:
-                        match msg.type:
-                            case MsgC2SType.HEARTBEAT:
-                                print(f"{handler_id}: Received {msg.type.name} @ {last_activity}")
-                                pass
-                            case MsgC2SType.STOP:
-                                print(f"{handler_id}: Received {msg.type.name} @ {last_activity}, stopping...")
-                                break
-                            case _:
-                                print(f"Received unknown C2S message type ({msg.type}) @ {last_activity}, dropping it.")
-                    case _:
-                        print(f"{handler_id}: Recevied a {msg.format} message on socket, dropping it (only C2C or C2S permitted)")
+                if not ClientHandler._process_message(handler_id, msg, datetime.now(), client, server):
+                    break
 
         finally:
             print(f"{handler_id}: SM stopping...")
-            try:
-                # Try to let the client know that the handler is stopping:
-                frame.send(client_connection, MsgC2S(MsgC2SType.STOP, payload=b'handler stopping').to_bytes(), client.key)
-                # Pause to let the client a chance to handle the message:
-                time.sleep(0.01)
-            except Exception as e:
-                print(f"{handler_id}: Failed to send STOP message to client: {e}")
-            client_connection.close()
+            stop_flag.remove(wake_reader)
+            heartbeat_timer.cancel()
+            release_routes(client)
+            ClientHandler._close_connection(handler_id, client_connection, send_key, client.frame_version)
             stop_flag.set()
-            print(f"{handler_id}: SM stopped")
\ No newline at end of file
+            print(f"{handler_id}: SM stopped")
+
+    # Stops the handler once nothing has been received for DEFAULT_HEARTBEAT_TIMEOUT seconds. last_activity()
+    # returns when (time.monotonic()) data was last received. Activity doesn't touch the timer: when it fires
+    # early, it is scheduled again for the time that is left.
+    @staticmethod
+    def _watch_heartbeat(handler_id:str, stop_flag:Event, last_activity) -> timer.Timer:
+        def on_timeout():
+            if stop_flag.is_set():
+                return None
+            remaining = DEFAULT_HEARTBEAT_TIMEOUT - (time.monotonic() - last_activity())
+            if remaining > 0:
+                return remaining
+
+            print(f"{handler_id}: No activity within {DEFAULT_HEARTBEAT_TIMEOUT}s, stopping...")
+            stop_flag.set()
+            return None
+
+        return timer.shared().schedule(DEFAULT_HEARTBEAT_TIMEOUT, on_timeout)
+
+    # Makes a read blocked on the socket return right away, writes are unaffected.
+    @staticmethod
+    def _wake_reader(connection:socket.socket):
+        try:
+            connection.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    # Parses data received on the socket, returns None if it isn't a valid message.
+    @staticmethod
+    def _read_message(handler_id:str, data:bytes, client:Identity) -> BackboneMessage | None:
+        try:
+            data = codec.decompress_message(data, client.compression, frame.max_frame_size(client.frame_version, client.max_frame_size))
+        except ValueError as e:
+            print(f"{handler_id}: Failed to decompress message: {e}")
+            return None
+        return BackboneMessage.from_bytes(data)
+
+    # Handles a message received on the socket, returns False if the handler should stop.
+    # block is False when called from a thread shared with other clients, see ClientQueue.offer.
+    @staticmethod
+    def _process_message(handler_id:str, msg:BackboneMessage, last_activity:datetime, client:Identity=None, server:IdentityComponent=None, block:bool=True) -> bool:
+        match msg.format:
+            case MsgFormat.C2C:
+                credit = client.credit if client != None else None
+                if credit != None and not credit.consume():
+                    print(f"{handler_id}: Client sent a message without credit, dropping it.")
+                    return True
+
+                recipient_queue = get_client_queue(msg.recipient)
+                if recipient_queue != None:
+                    # Credit for a message sent to a single client is returned once the recipient has taken it off its queue:
+                    ClientHandler._deliver(handler_id, msg, recipient_queue, client, credit != None, block)
+                    return True
+
+                # Messages addressed to a group are decrypted once and put on the queue of every member:
+                member_queues = routes.members(msg.recipient)
+                for member_queue in member_queues:
+                    ClientHandler._deliver(handler_id, msg, member_queue, client, block=block)
+                if _relay != None:
+                    # The recipient, or other members of the group, may be connected to another worker of the cluster:
+                    _relay.forward(msg.to_bytes())
+                elif len(member_queues) == 0:
+                    ClientHandler._spool_message(handler_id, msg)
+                if credit != None:
+                    ClientHandler._release_credit(client)
+
+            case MsgFormat.C2S:
+                match msg.type:
+                    case MsgC2SType.HEARTBEAT:
+                        print(f"{handler_id}: Received {msg.type.name} @ {last_activity}")
+                        pass
+                    case MsgC2SType.STOP:
+                        print(f"{handler_id}: Received {msg.type.name} @ {last_activity}, stopping...")
+                        return False
+                    case MsgC2SType.CONFIG:
+                        ClientHandler._apply_client_config(handler_id, msg, client)
+                    case MsgC2SType.SUBSCRIBE | MsgC2SType.UNSUBSCRIBE:
+                        ClientHandler._apply_subscription(handler_id, msg, client, _subscribe, _unsubscribe, server)
+                    case _:
+                        print(f"Received unknown C2S message type ({msg.type}) @ {last_activity}, dropping it.")
+            case MsgFormat.BATCH:
+                for batched_msg in msg.messages:
+                    if not ClientHandler._process_message(handler_id, batched_msg, last_activity, client, server, block):
+                        return False
+            case _:
+                print(f"{handler_id}: Recevied a {msg.format} message on socket, dropping it (only C2C or C2S permitted)")
+
+        return True
+
+    # Adds a routed message to a recipient queue, and lets the sender know if the queue is full.
+    @staticmethod
+    def _deliver(handler_id:str, msg:BackboneMessage, queue:ClientQueue, client:Identity=None, release_credit:bool=False, block:bool=True):
+        delivered = queue.offer(msg, functools.partial(ClientHandler._release_credit, client) if release_credit else None, block)
+        if release_credit and not delivered:
+            ClientHandler._release_credit(client)
+        if delivered and not 0 < queue.limit <= queue.qsize():
+            return
+        if not delivered:
+            print(f"{handler_id}: Queue for {msg.recipient} is full, dropped message.")
+        if client == None:
+            return
+
+        now = time.monotonic()
+        if now - client.throttled_at < THROTTLE_INTERVAL:
+            return
+        client.throttled_at = now
+        sender_queue = get_client_queue(client.id)
+        if sender_queue != None:
+            payload = json.dumps({ "recipient": msg.recipient.hex, "dropped": not delivered }).encode(encoding='utf-8')
+            sender_queue.put(MsgS2S(MsgS2SType.THROTTLE, payload=payload))
+
+    # Returns credit for one message to the client, sending it a CREDIT message once enough has built up.
+    @staticmethod
+    def _release_credit(client:Identity):
+        grant = client.credit.release()
+        if grant == 0:
+            return
+        client_queue = get_client_queue(client.id)
+        if client_queue != None:
+            client_queue.put(MsgS2S(MsgS2SType.CREDIT, payload=grant.to_bytes(4)))
+
+    # Stores a message for a recipient that isn't connected, or drops it if there's no spool.
+    @staticmethod
+    def _spool_message(handler_id:str, msg:BackboneMessage):
+        if _spool == None or not _spool.append(msg.recipient, msg.to_bytes()):
+            print(f"{handler_id}: Recipient {msg.recipient} is not connected, dropping message.")
+
+    # Writes the messages spooled while the client was offline, before anything on the client queue.
+    @staticmethod
+    def _replay_spool(handler_id:str, client:Identity, writer:frame.FrameWriter, send_access:Semaphore):
+        replayed = 0
+        outgoing = []
+        outgoing_size = 0
+
+        def flush():
+            ClientHandler._write_messages(handler_id, client, writer, outgoing)
+            send_access.acquire()
+            try:
+                writer.flush()
+            finally:
+                send_access.release()
+
+        # Segments are only deleted once the messages read from them have been sent, if sending fails they are
+        # replayed again next time:
+        replay = _spool.replay(client.id)
+        try:
+            for data in replay:
+                outgoing.append(data)
+                outgoing_size += len(data)
+                replayed += 1
+                if outgoing_size >= writer.coalesce_size:
+                    flush()
+                    replay.commit()
+                    outgoing = []
+                    outgoing_size = 0
+            flush()
+            replay.commit()
+        finally:
+            replay.close()
+
+        if replayed > 0:
+            print(f"{handler_id}: Replayed {replayed} spooled messages")
+
+    # Clients use CONFIG messages to announce which optional features they support.
+    @staticmethod
+    def _apply_client_config(handler_id:str, msg:MsgC2S, client:Identity):
+        try:
+            options = json.loads(msg.payload)
+        except Exception as e:
+            print(f"{handler_id}: Failed to parse CONFIG message from client: {e}")
+            return
+
+        if client == None:
+            return
+        if "batching" in options:
+            client.batching = options["batching"] == True
+        if "compression" in options:
+            client.compression = codec.select([options["compression"]]) if isinstance(options["compression"], str) else None
+            if client.compression != options["compression"]:
+                print(f"{handler_id}: Client requested unsupported compression codec {options['compression']}, sending uncompressed messages.")
+        if "credit" in options and options["credit"] == True and client.credit_window > 0 and client.credit == None:
+            client.credit = CreditWindow(client.credit_window)
+
+    # SUBSCRIBE and UNSUBSCRIBE messages list the raw 16 byte IDs of the groups to join or leave.
+    # Client IDs can't be used as group IDs, otherwise a client could subscribe to another client's ID and receive its
+    # messages whenever it isn't connected.
+    @staticmethod
+    def _apply_subscription(handler_id:str, msg:MsgC2S, client:Identity, subscribe, unsubscribe, server:IdentityComponent=None):
+        payload = msg.payload if msg.payload != None else b''
+        if client == None or len(payload) == 0 or len(payload) % 16 != 0:
+            print(f"{handler_id}: Received invalid {msg.type.name} message, dropping it.")
+            return
+
+        for i in range(0, len(payload), 16):
+            group_id = UUID(bytes=payload[i:i+16])
+            if msg.type == MsgC2SType.SUBSCRIBE:
+                if server != None and server.is_client(group_id):
+                    print(f"{handler_id}: Refused subscription to {group_id}, which is a client ID.")
+                    continue
+                client.groups.add(group_id)
+                subscribe(group_id, client)
+            else:
+                client.groups.discard(group_id)
+                unsubscribe(group_id, client)
+
+    @staticmethod
+    def _close_connection(handler_id:str, client_connection:socket.socket, send_key, frame_version:int=1):
+        try:
+            # Try to let the client know that the handler is stopping:
+            frame.send(client_connection, MsgC2S(MsgC2SType.STOP, payload=b'handler stopping').to_bytes(), send_key, frame_version)
+            # Pause to let the client a chance to handle the message:
+            time.sleep(0.01)
+        except Exception as e:
+            print(f"{handler_id}: Failed to send STOP message to client: {e}")
+        client_connection.close()
\ No newline at end of file
@@ -3,11 +3,15 @@ import uuid
 import socket
 import queue
 import time
+import tempfile
+import threading
 
 import key, frame, message
 from identity import IdentityComponent, Identity
 
 import handle
+from reactor import Reactor
+from spool import Spool
 
 class TestClientQueues(unittest.TestCase):
     def test_get_server_queue(self):
@@ -23,7 +27,132 @@ class TestClientQueues(unittest.TestCase):
         handle._deregister_client(client_id)
         self.assertIsNone(handle.get_client_queue(client_id))
 
+    def test_routing_table(self):
+        routes = handle.RoutingTable(shards=4)
+        client_ids = [uuid.uuid4() for _ in range(32)]
+        for client_id in client_ids:
+            routes.register(client_id)
+        self.assertEqual(len(routes), 32)
+
+        client_id = client_ids[0]
+        old_queue = routes.get(client_id)
+        new_queue = routes.register(client_id)
+        self.assertEqual(len(routes), 32, "Registering a client again should replace its queue.")
+        routes.deregister(client_id, old_queue)
+        self.assertIs(routes.get(client_id), new_queue, "Deregistering a replaced queue should not remove the new one.")
+
+        for client_id in client_ids:
+            routes.deregister(client_id)
+        self.assertEqual(len(routes), 0, "Deregistered clients should be removed from the table.")
+
+    def test_client_queue_policies(self):
+        msgs = [message.BackboneMessageC2C(uuid.uuid4(), f'#{i}'.encode()) for i in range(3)]
+
+        q = handle.ClientQueue(limit=2, policy="drop_newest")
+        self.assertEqual([q.offer(msg) for msg in msgs], [True, True, False])
+        self.assertEqual([q.get_nowait(), q.get_nowait()], msgs[:2])
+
+        q = handle.ClientQueue(limit=2, policy="drop_oldest")
+        self.assertEqual([q.offer(msg) for msg in msgs], [True, True, True])
+        self.assertEqual([q.get_nowait(), q.get_nowait()], msgs[1:])
+        self.assertEqual(q.stats()["dropped"], 1)
+        self.assertEqual(q.stats()["high_water"], 2)
+
+        q = handle.ClientQueue(limit=2, policy="block", block_timeout=0.1)
+        start = time.monotonic()
+        self.assertEqual([q.offer(msg) for msg in msgs], [True, True, False])
+        self.assertGreaterEqual(time.monotonic() - start, 0.1, "Senders should wait for the queue to drain before dropping the message.")
+        self.assertEqual(q.stats()["blocked"], 1)
+        start = time.monotonic()
+        self.assertFalse(q.offer(msgs[2], block=False))
+        self.assertLess(time.monotonic() - start, 0.1, "Senders on shared threads should not wait for the queue to drain.")
+        self.assertEqual(q.stats()["blocked"], 1)
+
+        q = handle.ClientQueue(limit=2, policy="disconnect")
+        self.assertEqual([q.offer(msg) for msg in msgs], [True, True, False])
+        q.get_nowait(), q.get_nowait()
+        stop = q.get_nowait()
+        self.assertEqual((stop.format, stop.type), (message.BackboneMessageFormat.S2S, message.BackboneS2SType.STOP), "Overflowing the queue should stop the recipient's handler.")
+
+        with self.assertRaises(ValueError):
+            handle.ClientQueue(policy="unknown")
+
+    def test_throttle_sender(self):
+        sender = Identity(uuid.uuid4(), None)
+        sender_queue = handle._register_client(sender.id)
+        recipient_queue = handle.ClientQueue(limit=1, policy="drop_newest")
+        try:
+            for i in range(3):
+                handle.ClientHandler._deliver("test", message.BackboneMessageC2C(uuid.uuid4(), b'data'), recipient_queue, sender)
+            throttle = sender_queue.get_nowait()
+            self.assertEqual(throttle.type, message.BackboneS2SType.THROTTLE)
+            self.assertTrue(sender_queue.empty(), "THROTTLE messages should be rate limited.")
+            data = handle.ClientHandler._queued_message_data("test", throttle, sender)
+            self.assertEqual(message.BackboneMessage.from_bytes(data).type, message.BackboneC2SType.THROTTLE)
+        finally:
+            handle._deregister_client(sender.id)
+
+    def test_credit_window(self):
+        credit = handle.CreditWindow(8)
+        self.assertEqual([credit.consume() for _ in range(9)], [True] * 8 + [False], "Clients should not be able to send more than the window.")
+        self.assertEqual(credit.release(), 0, "Credit should be held back until a quarter of the window can be granted.")
+        self.assertEqual(credit.release(), 2)
+        self.assertEqual([credit.consume() for _ in range(3)], [True, True, False])
+
+        taken = []
+        q = handle.ClientQueue(limit=2, policy="drop_oldest")
+        msgs = [message.BackboneMessageC2C(uuid.uuid4(), f'#{i}'.encode()) for i in range(4)]
+        for msg in msgs[:3]:
+            q.offer(msg, lambda msg=msg: taken.append(msg))
+        self.assertEqual(taken, msgs[:1], "Callbacks should be made for dropped messages.")
+        self.assertEqual(q.get_nowait(), msgs[1])
+        self.assertEqual(taken, msgs[:2], "Callbacks should be made when messages are taken off the queue.")
+        q.close()
+        self.assertEqual(taken, msgs[:3], "Callbacks should be made for messages left on a closed queue.")
+        self.assertFalse(q.offer(msgs[3], lambda: taken.append(msgs[3])), "Closed queues should not accept messages.")
+
 class TestClientHandler(unittest.TestCase):
+    def test_write_messages_compression(self):
+        client = Identity(uuid.uuid4(), None)
+        client.batching = True
+        client.compression = "zlib"
+        writer = frame.FrameWriter(None, version=2)
+        messages = [message.BackboneMessageC2C(client.id, f'secret #{i} '.encode() * 64).to_bytes() for i in range(2)]
+
+        handle.ClientHandler._write_messages("test", client, writer, messages)
+        handle.ClientHandler._write_messages("test", client, writer, messages[:1])
+        frames = writer.take()[1::2]
+        self.assertEqual(frames[0], message.BackboneMessageBatch.encode(messages), "Batches of messages from different senders should not be compressed.")
+        self.assertLess(len(frames[1]), len(messages[0]), "Single messages should be compressed.")
+
+    def test_replay_spool_failure(self):
+        # Fails on the third flush, as if the connection had been lost partway through the replay:
+        class FailingWriter(frame.FrameWriter):
+            def flush(self):
+                if len(sent) == 2:
+                    raise ConnectionResetError("connection lost")
+                sent.append(self.take())
+
+        client = Identity(uuid.uuid4(), None)
+        messages = [message.BackboneMessageC2C(client.id, f'#{i:02}'.encode()).to_bytes() for i in range(20)]
+        sent = []
+        with tempfile.TemporaryDirectory() as tmp_path:
+            # Each flush holds messages from several segments:
+            spool = Spool(tmp_path, segment_size=64)
+            for data in messages:
+                spool.append(client.id, data)
+            handle.set_spool(spool)
+            try:
+                with self.assertRaises(ConnectionResetError):
+                    handle.ClientHandler._replay_spool("test", client, FailingWriter(None, coalesce_size=160), threading.Semaphore())
+                replayed = [bytes(data) for data in spool.replay(client.id)]
+            finally:
+                handle.set_spool(None)
+
+        unsent = messages[sum(len(buffers) // 2 for buffers in sent):]
+        self.assertEqual(replayed[-len(unsent):], unsent, "Spooled messages that weren't sent should be replayed again.")
+        self.assertLess(len(replayed), len(messages), "Segments that were sent in full should not be replayed again.")
+
     def test_creation(self):
         client_key = key.generate()
         client_key_pub = client_key.public_key
@@ -36,6 +165,24 @@ class TestClientHandler(unittest.TestCase):
         # Cleaning up sockets here since we're forefully closing the handler:
         socket1.close()
         socket2.close()
+
+    def test_subscribe_to_client_id(self):
+        server = IdentityComponent()
+        victim_id = uuid.uuid4()
+        server.add_client_key(victim_id, key.generate().public_key())
+        client = Identity(uuid.uuid4(), None)
+        client_queue = handle._register_client(client.id)
+        group_id = uuid.uuid4()
+        try:
+            msg = message.BackboneMessageC2S(message.BackboneC2SType.SUBSCRIBE, payload=victim_id.bytes + group_id.bytes)
+            self.assertTrue(handle.ClientHandler._process_message("test", msg, None, client, server))
+            self.assertEqual(client.groups, { group_id }, "Subscriptions to client IDs should be refused.")
+            self.assertEqual(server.key_cache_misses, 0, "Checking group IDs should not read keys from the key store.")
+            self.assertEqual(handle.routes.members(group_id), [client_queue])
+            self.assertEqual(handle.routes.members(victim_id), [], "Clients should not be able to subscribe to another client's messages.")
+        finally:
+            handle.release_routes(client)
+            handle._deregister_client(client.id)
     
     def test_stop_by_queue(self):
         client_key = key.generate()
@@ -124,6 +271,68 @@ class TestClientHandler(unittest.TestCase):
             connection_handler.stop(block=True)
             socket2.close()
 
+class TestReactorClientHandler(unittest.TestCase):
+    def setUp(self):
+        self.reactor = Reactor()
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.stop(block=True)
+
+    def test_stop_by_stop_message(self):
+        client_key = key.generate()
+        client = Identity(uuid.uuid4(), client_key.public_key())
+        server = IdentityComponent()
+        socket1, socket2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+
+        connection_handler = handle.ClientHandler(socket1, client, server, reactor=self.reactor)
+
+        try:
+            connection_handler.start()
+
+            time.sleep(0.01)
+
+            frame.send(socket2, message.BackboneMessageC2S(message.BackboneC2SType.STOP).to_bytes(), server.server_state["public_key"])
+
+            connection_handler.thread.join(timeout=3)
+
+            self.assertTrue(connection_handler.stop_flag.is_set(), "A STOP message read by the reactor should cause the handler to stop.")
+            self.assertFalse(connection_handler.is_running(), "With the stop_flag set, the handler should stop all threads.")
+            with self.assertRaises(OSError, msg="The socket held by the handler should have been closed."):
+                socket1.sendall(b'Hi!')
+        finally:
+            connection_handler.stop(block=True)
+            socket2.close()
+
+    def test_message_routing_rebound(self):
+        client_key = key.generate()
+        client = Identity(uuid.uuid4(), client_key.public_key())
+        server = IdentityComponent()
+        socket1, socket2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+
+        connection_handler = handle.ClientHandler(socket1, client, server, reactor=self.reactor)
+
+        try:
+            connection_handler.start()
+
+            time.sleep(0.01)
+
+            # Several frames in one write, the reactor should split them up:
+            sent_msgs = [message.BackboneMessageC2C(recipient=client.id, payload=f'Hi #{i}!'.encode()) for i in range(3)]
+            sock_writes = []
+            for sent_msg in sent_msgs:
+                enc_data = key.encrypt(server.server_state["public_key"], sent_msg.to_bytes())
+                sock_writes.append(len(enc_data).to_bytes(2) + enc_data)
+            socket2.sendall(b''.join(sock_writes))
+
+            for sent_msg in sent_msgs:
+                received_msg = message.BackboneMessage.from_bytes(frame.read(socket2, client_key))
+                self.assertEqual(received_msg, sent_msg)
+
+        finally:
+            connection_handler.stop(block=True)
+            socket2.close()
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -1,12 +1,17 @@
+import asyncio
 import uuid
 import os
 import json
+import threading
+from collections import OrderedDict
 
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 
+import codec
 import frame
 import key
+from keystore import FileKeyStore, SQLiteKeyStore, open_key_store
 from message import BackboneC2SType, BackboneMessageC2S
 
 class ChallengeFailed(Exception) :
@@ -14,13 +19,29 @@ class ChallengeFailed(Exception) :
         super().__init__(f"Authentication challenge failed: {text}")
 
 class Identity:
-    def __init__(self, id: uuid, public_key: rsa.RSAPublicKey):
+    def __init__(self, id: uuid, public_key: rsa.RSAPublicKey, session: key.Session = None, frame_version: int = 1, max_frame_size: int = None):
         self.id = id
         self.key = public_key
+        self.session = session
+        # Frame format agreed during the challenge, used for all frames following the CONFIG message:
+        self.frame_version = frame_version
+        self.max_frame_size = max_frame_size
+        # Set once the client has announced that it can receive BATCH messages:
+        self.batching = False
+        # Compression codec announced by the client, see codec.py:
+        self.compression = None
+        # Groups the client has subscribed to on this connection:
+        self.groups = set()
+        # When (time.monotonic()) the client was last sent a THROTTLE message:
+        self.throttled_at = 0
+        # Number of C2C messages the client may have in flight, as offered in the CONFIG message (0 for no limit),
+        # and the handle.CreditWindow tracking them once the client has accepted:
+        self.credit_window = 0
+        self.credit = None
 
 class IdentityComponent:
 
-    def __init__(self, state_dir=None):
+    def __init__(self, state_dir=None, key_cache_size:int=1024, key_store:str|FileKeyStore|SQLiteKeyStore="file"):
         if state_dir == None:
             state_dir = os.path.dirname(__file__)
         self.server_dir  = os.path.join(state_dir, ".server")
@@ -33,16 +54,58 @@ class IdentityComponent:
             "public_key_bytes": None
         }
 
+        # Parsed client keys, most recently used last. Keys are read from disk on a miss and the
+        # least recently used key is dropped once the cache holds key_cache_size keys:
+        self.key_cache_size = key_cache_size
+        self.key_cache_hits   = 0
+        self.key_cache_misses = 0
+        self._key_cache = OrderedDict()
+        self._key_cache_lock = threading.Lock()
+        # Incremented whenever a key is changed or removed, so that a key read from the store before then
+        # isn't cached afterwards (see _cache_client_key):
+        self._key_generation = 0
+
         self.initialize()
 
-    def challenge(self, clientsock, challenge_size=1024, client_settings:dict=None):
-        challenge_data = os.urandom(challenge_size)
+        # Client keys are stored by a key store, either given directly or by name (see keystore.py):
+        self.key_store = open_key_store(key_store, self.server_dir) if isinstance(key_store, str) else key_store
 
-        msg = len(self.server_state["public_key_bytes"]).to_bytes(2) + self.server_state["public_key_bytes"] + challenge_data
+    def challenge(self, clientsock, challenge_size=1024, client_settings:dict=None, max_frame_size:int=None):
+        challenge_data, msg = self._create_challenge(challenge_size)
 
         frame.send(clientsock, msg)
         response = frame.read(clientsock, self.server_state["private_key"])
 
+        client = self._verify_response(challenge_data, response, max_frame_size)
+
+        frame.send(clientsock, self._create_config(client_settings, client), client.session if client.session != None else client.key)
+
+        return clientsock, client
+
+    # Same as challenge, but using asyncio streams. RSA decryption and signature verification
+    # are run in the event loop's default executor so that they don't block other connections.
+    async def challenge_async(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter, challenge_size=1024, client_settings:dict=None, max_frame_size:int=None) -> Identity:
+        challenge_data, msg = self._create_challenge(challenge_size)
+
+        await frame.send_async(writer, msg)
+        enc_response = await frame.read_async(reader)
+
+        def verify():
+            return self._verify_response(challenge_data, key.decrypt(self.server_state["private_key"], enc_response), max_frame_size)
+        client = await asyncio.get_running_loop().run_in_executor(None, verify)
+
+        await frame.send_async(writer, self._create_config(client_settings, client), client.session if client.session != None else client.key)
+
+        return client
+
+    def _create_challenge(self, challenge_size:int) -> tuple[bytes, bytes]:
+        challenge_data = os.urandom(challenge_size)
+
+        msg = len(self.server_state["public_key_bytes"]).to_bytes(2) + self.server_state["public_key_bytes"] + challenge_data
+
+        return challenge_data, msg
+
+    def _verify_response(self, challenge_data:bytes, response:bytes, max_frame_size:int=None) -> Identity:
         if len(response) < 16:
             raise ChallengeFailed("Invalid response returned.")
         
@@ -52,54 +115,140 @@ class IdentityComponent:
         client_key = self.get_client_key(client_id)
         if client_key == None:
             raise ChallengeFailed(f"No such client: {client_id.hex}")
-        
-        print(f"Response data ({len(response[16:])}): {response[16:]}")
 
-        if not key.verify(client_key, challenge_data, response[16:]):
+        # The signature is followed by an optional session secret and the highest frame version
+        # supported by the client, both of which are covered by the signature:
+        signature_size = client_key.key_size // 8
+        signature      = response[16:16+signature_size]
+        extensions     = response[16+signature_size:]
+
+        print(f"Response data ({len(signature)}): {signature}")
+
+        if not key.verify(client_key, challenge_data + extensions, signature):
             raise ChallengeFailed("Invalid signature returned.")
 
-        msg = BackboneMessageC2S(BackboneC2SType.CONFIG, payload=json.dumps(client_settings).encode(encoding='utf-8')) # b'Connection authenticated!'
-        frame.send(clientsock, msg.to_bytes(), client_key)
+        if len(extensions) not in (0, key.SESSION_SECRET_SIZE, key.SESSION_SECRET_SIZE + 1):
+            raise ChallengeFailed("Invalid session secret returned.")
+
+        session = None
+        if len(extensions) >= key.SESSION_SECRET_SIZE:
+            session = key.Session(extensions[:key.SESSION_SECRET_SIZE], challenge_data, initiator=False)
 
-        return clientsock, Identity(client_id, client_key)
+        frame_version = 1
+        if len(extensions) > key.SESSION_SECRET_SIZE:
+            frame_version = min(extensions[key.SESSION_SECRET_SIZE], frame.FRAME_VERSION)
+            if frame_version not in frame.HEADER_SIZES:
+                raise ChallengeFailed(f"Unsupported frame version: {frame_version}")
+
+        return Identity(client_id, client_key, session, frame_version, max_frame_size)
+
+    def _create_config(self, client_settings:dict, client:Identity) -> bytes:
+        if client.frame_version > 1:
+            # Let the client know which frame version to use from here on:
+            client_settings = dict(client_settings if client_settings != None else {})
+            client_settings["frame_version"]  = client.frame_version
+            client_settings["max_frame_size"] = frame.max_frame_size(client.frame_version, client.max_frame_size)
+            # Clients that understand frame version 2 may also send BATCH messages:
+            client_settings["batching"] = True
+            client_settings["compression"] = codec.names()
+
+        if client_settings != None and "credit_window" in client_settings:
+            client.credit_window = client_settings["credit_window"]
+
+        msg = BackboneMessageC2S(BackboneC2SType.CONFIG, payload=json.dumps(client_settings).encode(encoding='utf-8')) # b'Connection authenticated!'
+        return msg.to_bytes()
 
     def get_client_key(self, client_id: uuid.UUID) -> rsa.RSAPublicKey:
-        client_key_path = os.path.join(self.clients_dir, client_id.hex)
-        if not os.path.exists(client_key_path):
-            return None
-        
-        with open(client_key_path, 'rb') as f:
-            return key.deserialize(f.read())
+        with self._key_cache_lock:
+            client_key = self._key_cache.get(client_id)
+            if client_key != None:
+                self._key_cache.move_to_end(client_id)
+                self.key_cache_hits += 1
+                return client_key
+            self.key_cache_misses += 1
+            generation = self._key_generation
+
+        client_key = self.key_store.get(client_id)
+        if client_key != None:
+            self._cache_client_key(client_id, client_key, generation)
+        return client_key
+
+    # Returns True if the client has a key. Unlike get_client_key, the key isn't read or cached, so this is cheap
+    # for IDs that usually don't belong to a client.
+    def is_client(self, client_id: uuid.UUID) -> bool:
+        with self._key_cache_lock:
+            if client_id in self._key_cache:
+                return True
+        return self.key_store.contains(client_id)
 
     def add_client_key(self, client_id: uuid.UUID, client_key: rsa.RSAPublicKey) -> bool:
-        client_key_path = os.path.join(self.clients_dir, client_id.hex)
-        if os.path.exists(client_key_path):
+        if not self.key_store.add(client_id, client_key):
             return False
         
-        with open(client_key_path, 'wb') as f:
-            f.write(key.serialize(client_key))
-        
+        self._cache_client_key(client_id, client_key)
         return True
 
-    def set_client_key(self, client_id: uuid.UUID, client_key: rsa.RSAPublicKey) -> bool:
-        client_key_path = os.path.join(self.clients_dir, client_id.hex)
+    # Adds keys for several clients at once, skipping clients that already have a key.
+    # Returns the number of keys added.
+    def add_client_keys(self, client_keys: list[tuple[uuid.UUID, rsa.RSAPublicKey]]) -> int:
+        return self.key_store.add_many(client_keys)
 
-        if not os.path.exists(client_key_path):
+    def set_client_key(self, client_id: uuid.UUID, client_key: rsa.RSAPublicKey) -> bool:
+        if not self.key_store.set(client_id, client_key):
             return False
         
-        with open(client_key_path, 'wb') as f:
-            f.write(key.serialize(client_key))
-        
+        with self._key_cache_lock:
+            self._key_generation += 1
+        self._cache_client_key(client_id, client_key)
         return True
     
+    # The key is removed from the store before the cache, so that it can't be read back into the cache.
     def remove_client_key(self, client_id:uuid.UUID) -> bool:
-        client_key_path = os.path.join(self.clients_dir, client_id.hex)
+        removed = self.key_store.remove(client_id)
 
-        if not os.path.isfile(client_key_path):
-            return None
-        
-        os.remove(client_key_path)
-        return True
+        with self._key_cache_lock:
+            self._key_generation += 1
+            self._key_cache.pop(client_id, None)
+
+        return removed
+
+    # Reads client keys into the cache ahead of time (up to key_cache_size keys), so that clients
+    # reconnecting after a restart don't all have to wait for their key to be read from disk.
+    # Returns the number of keys loaded.
+    def preload_client_keys(self) -> int:
+        loaded = 0
+        for client_id in self.key_store.client_ids():
+            if loaded >= self.key_cache_size:
+                break
+
+            with self._key_cache_lock:
+                generation = self._key_generation
+            client_key = self.key_store.get(client_id)
+            if client_key != None:
+                self._cache_client_key(client_id, client_key, generation)
+                loaded += 1
+
+        return loaded
+
+    # Drops all cached keys, e.g. after the key store has been changed outside of this component.
+    def clear_key_cache(self):
+        with self._key_cache_lock:
+            self._key_generation += 1
+            self._key_cache.clear()
+
+    # generation is the key generation from before the key was read from the store, the key isn't cached
+    # if a key has been changed or removed since.
+    def _cache_client_key(self, client_id: uuid.UUID, client_key: rsa.RSAPublicKey, generation:int=None):
+        if self.key_cache_size <= 0:
+            return
+
+        with self._key_cache_lock:
+            if generation != None and generation != self._key_generation:
+                return
+            self._key_cache[client_id] = client_key
+            self._key_cache.move_to_end(client_id)
+            while len(self._key_cache) > self.key_cache_size:
+                self._key_cache.popitem(last=False)
 
 
 
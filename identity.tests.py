@@ -28,6 +28,17 @@ def stub_client(s:socket.socket, client_id:UUID, client_key:rsa.RSAPrivateKey, r
     data = frame.read(s, client_key)
     result["data"] = data
 
+def stub_session_client(s:socket.socket, client_id:UUID, client_key:rsa.RSAPrivateKey, result:dict):
+    data = frame.read(s)
+    kl = int.from_bytes(data[0:2])
+    server_public_key = key.deserialize(data[2:2+kl])
+    session_secret = os.urandom(key.SESSION_SECRET_SIZE)
+    signature = key.sign(client_key, data[2+kl:] + session_secret)
+    frame.send(s, client_id.bytes + signature + session_secret, server_public_key)
+    session = key.Session(session_secret, data[2+kl:], initiator=True)
+    result["data"] = frame.read(s, session)
+    result["session"] = session
+
 class TestIdentity(unittest.TestCase):
 
     def test_identity_creation(self):
@@ -67,6 +78,64 @@ class TestIdentityComponent(unittest.TestCase):
             self.assertFalse(identities.remove_client_key(client_id),                        "remove_client_key should return False for non-existent client_id.")
             self.assertFalse(identities.set_client_key(client_id, client_key1.public_key()),  "set_client_key should return False for non-existing client_id.")
 
+    def test_key_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            store_path = os.path.join(tmp_path, '.store')
+
+            identities = identity.IdentityComponent(state_dir=store_path, key_cache_size=2)
+
+            client_ids  = [uuid4() for _ in range(3)]
+            client_keys = [key.generate().public_key() for _ in range(3)]
+            for client_id, client_key in zip(client_ids, client_keys):
+                identities.add_client_key(client_id, client_key)
+
+            self.assertEqual(identities.get_client_key(client_ids[2]), client_keys[2])
+            self.assertEqual((identities.key_cache_hits, identities.key_cache_misses), (1, 0), "Added keys should be cached.")
+            self.assertEqual(identities.get_client_key(client_ids[0]), client_keys[0])
+            self.assertEqual((identities.key_cache_hits, identities.key_cache_misses), (1, 1), "The least recently used key should be dropped from a full cache.")
+
+            # Changes made through the component should be visible immediately:
+            new_key = key.generate().public_key()
+            identities.set_client_key(client_ids[0], new_key)
+            self.assertEqual(identities.get_client_key(client_ids[0]), new_key)
+            identities.remove_client_key(client_ids[0])
+            self.assertIsNone(identities.get_client_key(client_ids[0]))
+
+            identities = identity.IdentityComponent(state_dir=store_path, key_cache_size=2)
+            self.assertEqual(identities.preload_client_keys(), 2, "Preloading should stop once the cache is full.")
+            self.assertEqual(identities.get_client_key(client_ids[1]), client_keys[1])
+            self.assertEqual(identities.get_client_key(client_ids[2]), client_keys[2])
+            self.assertEqual((identities.key_cache_hits, identities.key_cache_misses), (2, 0), "Preloaded keys should be served from the cache.")
+
+    def test_key_cache_concurrent_revoke(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            identities = identity.IdentityComponent(state_dir=tmp_path)
+            client_id, client_key = uuid4(), key.generate().public_key()
+            identities.add_client_key(client_id, client_key)
+            identities.clear_key_cache()
+
+            # Holds up a lookup after it has read the key from the store, until the key has been revoked:
+            read, revoked = threading.Event(), threading.Event()
+            store_get = identities.key_store.get
+            def slow_get(client_id):
+                client_key = store_get(client_id)
+                read.set()
+                revoked.wait(5)
+                return client_key
+            identities.key_store.get = slow_get
+
+            looked_up = []
+            lookup = threading.Thread(target=lambda: looked_up.append(identities.get_client_key(client_id)))
+            lookup.start()
+            self.assertTrue(read.wait(5))
+            identities.key_store.get = store_get
+            self.assertTrue(identities.remove_client_key(client_id))
+            revoked.set()
+            lookup.join(5)
+
+            self.assertEqual(looked_up, [client_key])
+            self.assertIsNone(identities.get_client_key(client_id), "A lookup that was under way when the key was revoked should not put it back in the cache.")
+
     def test_challenge_default_success(self):
         with tempfile.TemporaryDirectory() as tmp_path:
             store_path = os.path.join(tmp_path, '.store')
@@ -105,6 +174,44 @@ class TestIdentityComponent(unittest.TestCase):
                 socket1.close()
                 socket2.close()
     
+    def test_challenge_session_success(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            store_path = os.path.join(tmp_path, '.store')
+
+            identities = identity.IdentityComponent(state_dir=store_path)
+
+            client_id   = uuid4()
+            client_key  = key.generate()
+
+            identities.add_client_key(client_id, client_key.public_key())
+
+            socket1, socket2 = socket.socketpair(family=socket.AF_INET, type=socket.SOCK_STREAM)
+
+            try:
+                result = {}
+                client_thread = threading.Thread(
+                    target=stub_session_client,
+                    kwargs={
+                        "s": socket2,
+                        "client_id": client_id,
+                        "client_key": client_key,
+                        "result": result
+                    }
+                )
+                client_thread.start()
+
+                client_socket, client = identities.challenge(socket1, client_settings=default_settings)
+
+                client_thread.join(timeout=3)
+
+                self.assertEqual(client.id, client_id)
+                self.assertIsInstance(client.session, key.Session, "A client offering a session secret should be given a session.")
+                self.assertEqual(result["data"], get_success_msg(), "The CONFIG message should be encrypted using the session.")
+                self.assertEqual(client.session.decrypt(result["session"].encrypt(b'Hi!')), b'Hi!', "Both ends should derive the same session keys.")
+            finally:
+                socket1.close()
+                socket2.close()
+
     def test_challenge_default_failed(self):
         with tempfile.TemporaryDirectory() as tmp_path:
             store_path = os.path.join(tmp_path, '.store')
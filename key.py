@@ -1,7 +1,17 @@
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.exceptions import InvalidSignature
+from cryptography.exceptions import InvalidSignature, InvalidTag
+
+# Size of the secret provided by the client to establish a session:
+SESSION_SECRET_SIZE = 32
+# Size of the random nonce prepended to every session-encrypted frame:
+SESSION_NONCE_SIZE  = 12
 
 
 def generate() -> rsa.RSAPrivateKey:
@@ -56,68 +66,156 @@ def deserialize(pem: bytes):
     if b'PRIVATE KEY' in pem:
         return serialization.load_pem_private_key(pem, password=None, backend=default_backend)
 
+# Compact binary encoding of public keys, used where keys are stored in bulk:
+def serialize_der(key: rsa.RSAPublicKey) -> bytes:
+    return key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.PKCS1
+    )
+
+def deserialize_der(der: bytes) -> rsa.RSAPublicKey:
+    return serialization.load_der_public_key(der, backend=default_backend)
+
 def encrypt(key: rsa.RSAPublicKey, data: bytes) -> bytes:
-    enc_data = b''
-    for chunk in encrypt_iter(key, data):
-        enc_data += chunk
-    return enc_data
+    return bytes(CipherContext(key).encrypt(data))
 
 def decrypt(key: rsa.RSAPrivateKey, enc_data: bytes) -> bytes:
-    data = b''
-    for chunk in decrypt_iter(key, enc_data):
-        data += chunk
-    return data
+    return bytes(CipherContext(key).decrypt(enc_data))
 
 
 def encrypt_iter(key: rsa.RSAPublicKey, data: bytes):
-    i = 0
-    inc = 190
-    max_i = (len(data) // inc) * inc
-    while i < max_i:
-        yield key.encrypt(
-            data[i:i+190],
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
-
-        i += inc
-    
-    if len(data) % inc != 0:
-        yield key.encrypt(
-            data[max_i:],
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+    context = CipherContext(key)
+    for i in range(0, len(data), context.chunk_size):
+        yield context.encrypt_block(data[i:i+context.chunk_size])
 
 def decrypt_iter(key: rsa.RSAPrivateKey, data: bytes):
-    i = 0
-    inc = 256
-    max_i = (len(data) // inc) * inc
-    
-    while i < max_i:
-        yield key.decrypt(
-            data[i:i+inc],
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
+    context = CipherContext(key)
+    for i in range(0, len(data), context.block_size):
+        yield context.decrypt_block(data[i:i+context.block_size])
+
+
+# RSA-OAEP encryption with a single key. Data is split into chunks that fit in one RSA block,
+# so the size of the output is known up front and can be written into a single buffer.
+# Reuse one context per key rather than calling encrypt/decrypt, which build a new one each time.
+class CipherContext:
+    def __init__(self, key: rsa.RSAPublicKey|rsa.RSAPrivateKey) -> None:
+        self.key = key
+        self._padding = padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
         )
+        # Size of each encrypted block, and the largest chunk of data that fits in one (OAEP uses 2 hashes + 2 bytes):
+        self.block_size = key.key_size // 8
+        self.chunk_size = self.block_size - 2 * hashes.SHA256.digest_size - 2
+
+    def encrypted_size(self, size:int) -> int:
+        return -(-size // self.chunk_size) * self.block_size
+
+    # Upper bound, the last block may hold less than a full chunk:
+    def decrypted_size(self, size:int) -> int:
+        return -(-size // self.block_size) * self.chunk_size
+
+    # Returns a bytearray rather than bytes, so the result isn't copied once more.
+    # Blocks are independent, so with an executor they are split into parts that are encrypted concurrently:
+    def encrypt(self, data: bytes, executor:Executor=None, parts:int=1) -> bytearray:
+        out = bytearray(self.encrypted_size(len(data)))
+        self.encrypt_into(data, out, executor, parts)
+        return out
+
+    def decrypt(self, enc_data: bytes, executor:Executor=None, parts:int=1) -> bytearray:
+        out = bytearray(self.decrypted_size(len(enc_data)))
+        del out[self.decrypt_into(enc_data, out, executor, parts):]
+        return out
+
+    # Encrypts data into out, which must hold at least encrypted_size(len(data)) bytes. Returns the number of bytes written.
+    def encrypt_into(self, data: bytes, out: bytearray|memoryview, executor:Executor=None, parts:int=1) -> int:
+        if executor != None and parts > 1:
+            return self._transform_parallel(data, out, self.chunk_size, False, executor, parts)
+        return self._transform(data, out, self.chunk_size, self.encrypt_block)
+
+    # Decrypts enc_data into out, which must hold at least decrypted_size(len(enc_data)) bytes. Returns the number of bytes written.
+    def decrypt_into(self, enc_data: bytes, out: bytearray|memoryview, executor:Executor=None, parts:int=1) -> int:
+        if executor != None and parts > 1:
+            return self._transform_parallel(enc_data, out, self.block_size, True, executor, parts)
+        return self._transform(enc_data, out, self.block_size, self.decrypt_block)
+
+    # The block functions only accept bytes, so anything else is copied one block at a time:
+    def encrypt_block(self, chunk: bytes) -> bytes:
+        return self.key.encrypt(chunk if isinstance(chunk, bytes) else bytes(chunk), self._padding)
+
+    def decrypt_block(self, block: bytes) -> bytes:
+        return self.key.decrypt(block if isinstance(block, bytes) else bytes(block), self._padding)
+
+    def _transform(self, data: bytes, out: bytearray|memoryview, step:int, transform) -> int:
+        n = 0
+        with memoryview(out) as view:
+            for i in range(0, len(data), step):
+                result = transform(data[i:i+step])
+                view[n:n+len(result)] = result
+                n += len(result)
+        return n
+
+    def _transform_parallel(self, data: bytes, out: bytearray|memoryview, step:int, decrypting:bool, executor:Executor, parts:int) -> int:
+        blocks = -(-len(data) // step)
+        part_size = -(-blocks // parts) * step
+
+        # Keys can't be pickled, so worker processes get the serialized key instead:
+        key_arg = serialize(self.key) if isinstance(executor, ProcessPoolExecutor) else self.key
+        with memoryview(data) as view:
+            futures = [executor.submit(_transform_part, key_arg, decrypting, bytes(view[i:i+part_size])) for i in range(0, len(data), part_size)]
+
+        n = 0
+        with memoryview(out) as view:
+            for future in futures:
+                result = future.result()
+                view[n:n+len(result)] = result
+                n += len(result)
+        return n
+
+
+# Keys deserialized by worker processes, parsing a private key is much slower than using it:
+_worker_keys = {}
+
+def _transform_part(key: rsa.RSAPublicKey|rsa.RSAPrivateKey|bytes, decrypting:bool, data: bytes) -> bytearray:
+    if isinstance(key, bytes):
+        if key not in _worker_keys:
+            if len(_worker_keys) >= 16:
+                _worker_keys.clear()
+            _worker_keys[key] = deserialize(key)
+        key = _worker_keys[key]
+
+    context = CipherContext(key)
+    return context.decrypt(data) if decrypting else context.encrypt(data)
+
+
+# Symmetric (AES-GCM) encryption for an authenticated connection.
+# Both ends derive one key per direction from the secret the client sent in its challenge response,
+# using the challenge data as salt, so the two directions never share a key.
+class Session:
+    def __init__(self, secret:bytes, salt:bytes, initiator:bool) -> None:
+        c2s_key = Session._derive(secret, salt, b'backbone c2s')
+        s2c_key = Session._derive(secret, salt, b'backbone s2c')
+
+        self._send_cipher    = AESGCM(c2s_key if initiator else s2c_key)
+        self._receive_cipher = AESGCM(s2c_key if initiator else c2s_key)
+
+    def encrypt(self, data:bytes) -> bytes:
+        nonce = os.urandom(SESSION_NONCE_SIZE)
+        return nonce + self._send_cipher.encrypt(nonce, data, None)
+
+    def decrypt(self, enc_data:bytes) -> bytes:
+        try:
+            return self._receive_cipher.decrypt(enc_data[:SESSION_NONCE_SIZE], enc_data[SESSION_NONCE_SIZE:], None)
+        except InvalidTag:
+            # Match the RSA functions, which raise ValueError when the wrong key is used:
+            raise ValueError("Failed to decrypt session data: authentication tag mismatch.")
 
-        i += inc
-
-    if len(data) % inc != 0:
-        yield key.decrypt(
-            data[max_i:],
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
\ No newline at end of file
+    @staticmethod
+    def _derive(secret:bytes, salt:bytes, info:bytes) -> bytes:
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            info=info
+        ).derive(secret)
@@ -91,6 +91,41 @@ class TestKeyFunctions(unittest.TestCase):
             decrypted_data += chunk
         self.assertEqual(data, decrypted_data)
 
+    def test_cipher_context(self):
+        private_key = key.generate()
+        encryption = key.CipherContext(private_key.public_key())
+        decryption = key.CipherContext(private_key)
+
+        data = urandom(1000)
+        self.assertEqual(encryption.encrypted_size(len(data)), 6 * 256, "1000 bytes should fit in 6 blocks of 190 bytes.")
+
+        # Encrypt into the middle of a caller-supplied buffer:
+        out = bytearray(16 + encryption.encrypted_size(len(data)))
+        with memoryview(out) as view:
+            n = encryption.encrypt_into(memoryview(data), view[16:])
+        self.assertEqual(n, len(out) - 16)
+        self.assertEqual(out[:16], bytes(16), "Bytes outside the target view should be left alone.")
+
+        self.assertEqual(decryption.decrypt(bytes(out[16:])), data)
+        self.assertEqual(decryption.decrypt(encryption.encrypt(b'')), b'', "Empty data should round-trip.")
+
+    def test_session(self):
+        secret = urandom(key.SESSION_SECRET_SIZE)
+        salt   = urandom(2048)
+        client_session = key.Session(secret, salt, initiator=True)
+        server_session = key.Session(secret, salt, initiator=False)
+        foreign_session = key.Session(urandom(key.SESSION_SECRET_SIZE), salt, initiator=False)
+
+        data = urandom((2**10)**2) # 1MiBi
+
+        encrypted_data = client_session.encrypt(data)
+        self.assertNotEqual(data, encrypted_data, "Encrypted message should differ from the unencrypted message")
+        self.assertEqual(len(encrypted_data), len(data) + key.SESSION_NONCE_SIZE + 16, "Session encryption should only add the nonce and authentication tag.")
+        self.assertEqual(data, server_session.decrypt(encrypted_data), "The server end of the session should decrypt data encrypted by the client end.")
+        self.assertEqual(data, client_session.decrypt(server_session.encrypt(data)), "The client end of the session should decrypt data encrypted by the server end.")
+        self.assertRaises(ValueError, lambda: client_session.decrypt(encrypted_data))
+        self.assertRaises(ValueError, lambda: foreign_session.decrypt(encrypted_data))
+
 
 
 
@@ -0,0 +1,201 @@
+# keystore.py
+# Storage backends for client public keys. IdentityComponent reads and writes client keys through
+# one of these, so the layout on disk can be changed without touching the authentication code.
+#
+# Keys can be migrated between backends by running this module directly:
+#   python keystore.py file sqlite [state_dir]
+import argparse
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Iterable, Iterator
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import key
+
+# One PEM file per client in a single directory. This is the original layout and remains the default.
+class FileKeyStore:
+    def __init__(self, clients_dir:str) -> None:
+        self.clients_dir = clients_dir
+        if not os.path.exists(self.clients_dir):
+            os.makedirs(self.clients_dir)
+
+    def get(self, client_id:uuid.UUID) -> rsa.RSAPublicKey:
+        try:
+            with open(self._path(client_id), 'rb') as f:
+                return key.deserialize(f.read())
+        except FileNotFoundError:
+            return None
+
+    # Checks for a key without reading it.
+    def contains(self, client_id:uuid.UUID) -> bool:
+        return os.path.exists(self._path(client_id))
+
+    def add(self, client_id:uuid.UUID, client_key:rsa.RSAPublicKey) -> bool:
+        # Exclusive create, so two concurrent adds for the same client can't both succeed:
+        try:
+            with open(self._path(client_id), 'xb') as f:
+                f.write(key.serialize(client_key))
+        except FileExistsError:
+            return False
+        return True
+
+    def set(self, client_id:uuid.UUID, client_key:rsa.RSAPublicKey) -> bool:
+        client_key_path = self._path(client_id)
+        if not os.path.exists(client_key_path):
+            return False
+
+        # Write to a temporary file and swap it in, so readers never see a partially written key:
+        tmp_path = f"{client_key_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(key.serialize(client_key))
+        os.replace(tmp_path, client_key_path)
+        return True
+
+    def remove(self, client_id:uuid.UUID) -> bool:
+        try:
+            os.remove(self._path(client_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    # Adds all keys that don't already exist, returns the number of keys added.
+    def add_many(self, client_keys:Iterable[tuple[uuid.UUID, rsa.RSAPublicKey]]) -> int:
+        added = 0
+        for client_id, client_key in client_keys:
+            if self.add(client_id, client_key):
+                added += 1
+        return added
+
+    def client_ids(self) -> Iterator[uuid.UUID]:
+        with os.scandir(self.clients_dir) as entries:
+            for entry in entries:
+                try:
+                    yield uuid.UUID(hex=entry.name)
+                except ValueError:
+                    continue
+
+    def close(self):
+        pass
+
+    def _path(self, client_id:uuid.UUID) -> str:
+        return os.path.join(self.clients_dir, client_id.hex)
+
+
+# All client keys in a single SQLite database, indexed by the raw client ID.
+class SQLiteKeyStore:
+    def __init__(self, db_path:str) -> None:
+        self.db_path = db_path
+        # The connection is shared by all handshake threads, sqlite3 connections must not be used concurrently:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS client_keys (client_id BLOB PRIMARY KEY, public_key BLOB NOT NULL) WITHOUT ROWID")
+
+    def get(self, client_id:uuid.UUID) -> rsa.RSAPublicKey:
+        with self._lock:
+            row = self._db.execute("SELECT public_key FROM client_keys WHERE client_id = ?", (client_id.bytes,)).fetchone()
+        if row == None:
+            return None
+        return key.deserialize_der(row[0])
+
+    def contains(self, client_id:uuid.UUID) -> bool:
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM client_keys WHERE client_id = ?", (client_id.bytes,)).fetchone()
+        return row != None
+
+    def add(self, client_id:uuid.UUID, client_key:rsa.RSAPublicKey) -> bool:
+        with self._lock:
+            cursor = self._db.execute("INSERT OR IGNORE INTO client_keys VALUES (?, ?)", (client_id.bytes, key.serialize_der(client_key)))
+        return cursor.rowcount == 1
+
+    def set(self, client_id:uuid.UUID, client_key:rsa.RSAPublicKey) -> bool:
+        with self._lock:
+            cursor = self._db.execute("UPDATE client_keys SET public_key = ? WHERE client_id = ?", (key.serialize_der(client_key), client_id.bytes))
+        return cursor.rowcount == 1
+
+    def remove(self, client_id:uuid.UUID) -> bool:
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM client_keys WHERE client_id = ?", (client_id.bytes,))
+        return cursor.rowcount == 1
+
+    # Adds all keys that don't already exist in a single transaction, returns the number of keys added.
+    def add_many(self, client_keys:Iterable[tuple[uuid.UUID, rsa.RSAPublicKey]]) -> int:
+        rows = [(client_id.bytes, key.serialize_der(client_key)) for client_id, client_key in client_keys]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR IGNORE INTO client_keys VALUES (?, ?)", rows)
+                self._db.execute("COMMIT")
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            return self._db.total_changes - before
+
+    def client_ids(self) -> Iterator[uuid.UUID]:
+        with self._lock:
+            rows = self._db.execute("SELECT client_id FROM client_keys").fetchall()
+        for row in rows:
+            yield uuid.UUID(bytes=row[0])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Names accepted by the key_store setting:
+KEY_STORES = ("file", "sqlite")
+
+# Opens the named key store in the given server state directory (the .server directory).
+def open_key_store(name:str, server_dir:str) -> FileKeyStore | SQLiteKeyStore:
+    match name:
+        case "file":
+            return FileKeyStore(os.path.join(server_dir, ".clients"))
+        case "sqlite":
+            if not os.path.exists(server_dir):
+                os.makedirs(server_dir)
+            return SQLiteKeyStore(os.path.join(server_dir, "clients.db"))
+        case _:
+            raise ValueError(f"Unknown key store '{name}', expected one of: {', '.join(KEY_STORES)}")
+
+# Copies all keys from one store to another in batches, returns the number of keys copied.
+# Keys that already exist in the destination are left as they are.
+def migrate(src, dst, batch_size:int=10000) -> int:
+    copied = 0
+    batch = []
+    for client_id in src.client_ids():
+        client_key = src.get(client_id)
+        if client_key == None:
+            continue
+        batch.append((client_id, client_key))
+        if len(batch) >= batch_size:
+            copied += dst.add_many(batch)
+            batch = []
+    if len(batch) > 0:
+        copied += dst.add_many(batch)
+    return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy client keys between key stores.")
+    parser.add_argument("source", choices=KEY_STORES)
+    parser.add_argument("destination", choices=KEY_STORES)
+    parser.add_argument("state_dir", nargs="?", default=os.path.dirname(__file__), help="Directory containing the .server directory.")
+    args = parser.parse_args()
+
+    if args.source == args.destination:
+        parser.error("source and destination must be different key stores")
+
+    server_dir = os.path.join(args.state_dir, ".server")
+    src = open_key_store(args.source, server_dir)
+    dst = open_key_store(args.destination, server_dir)
+    try:
+        print(f"Copied {migrate(src, dst)} client keys from {args.source} to {args.destination}.")
+    finally:
+        src.close()
+        dst.close()
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import threading
+import unittest
+from uuid import uuid4
+
+import key
+import keystore
+
+class TestKeyStores(unittest.TestCase):
+
+    def check_lifecycle(self, store):
+        client_id   = uuid4()
+        client_key1 = key.generate().public_key()
+        client_key2 = key.generate().public_key()
+
+        self.assertIsNone(store.get(client_id),                 "get should return None for unknown clients.")
+        self.assertFalse(store.contains(client_id))
+        self.assertTrue(store.add(client_id, client_key1),      "add should return True for new clients.")
+        self.assertFalse(store.add(client_id, client_key2),     "add should return False for existing clients.")
+        self.assertEqual(store.get(client_id), client_key1)
+        self.assertTrue(store.contains(client_id))
+        self.assertTrue(store.set(client_id, client_key2),      "set should return True for existing clients.")
+        self.assertEqual(store.get(client_id), client_key2)
+        self.assertTrue(store.remove(client_id),                "remove should return True for existing clients.")
+        self.assertIsNone(store.get(client_id))
+        self.assertFalse(store.remove(client_id),               "remove should return False for unknown clients.")
+        self.assertFalse(store.set(client_id, client_key1),     "set should return False for unknown clients.")
+
+        client_keys = [(uuid4(), key.generate().public_key()) for _ in range(3)]
+        self.assertEqual(store.add_many(client_keys), 3)
+        self.assertEqual(store.add_many(client_keys[1:] + [(client_id, client_key1)]), 1, "add_many should skip existing clients.")
+        self.assertEqual(set(store.client_ids()), set([client_id] + [c[0] for c in client_keys]))
+
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            self.check_lifecycle(keystore.open_key_store("file", tmp_path))
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            store = keystore.open_key_store("sqlite", tmp_path)
+            try:
+                self.check_lifecycle(store)
+            finally:
+                store.close()
+
+    def test_concurrent_add(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            store = keystore.open_key_store("file", tmp_path)
+            client_id  = uuid4()
+            client_key = key.generate().public_key()
+
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(store.add(client_id, client_key))) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(results.count(True), 1, "Only one concurrent add for the same client should succeed.")
+
+    def test_migrate(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            src = keystore.open_key_store("file", tmp_path)
+            dst = keystore.open_key_store("sqlite", tmp_path)
+            try:
+                client_keys = [(uuid4(), key.generate().public_key()) for _ in range(5)]
+                src.add_many(client_keys)
+                # Unrelated files in the clients directory should be ignored:
+                with open(os.path.join(src.clients_dir, "README"), 'w') as f:
+                    f.write("not a key")
+
+                self.assertEqual(keystore.migrate(src, dst, batch_size=2), 5)
+                for client_id, client_key in client_keys:
+                    self.assertEqual(dst.get(client_id), client_key)
+                self.assertEqual(keystore.migrate(src, dst), 0, "Migrating again should not copy existing keys.")
+            finally:
+                dst.close()
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -1,11 +1,18 @@
 import uuid
 from datetime import datetime
 import enum
+import functools
+import struct
+import time
 
 class BackboneMessageFormat(enum.IntEnum):
     C2C = 0
     C2S = 1
     S2S = 2
+    BATCH = 3
+
+# Default limit for the combined size (in bytes) of the messages packed into a single batch:
+BATCH_SIZE = 2**14
 
 class BackboneMessageType(enum.IntEnum):
     pass
@@ -13,24 +20,49 @@ class BackboneMessageType(enum.IntEnum):
 class BackboneC2SType(BackboneMessageType):
     HEARTBEAT = 0   # Used by client to let the handler know that it is alive.
     CONFIG    = 1   # Used by handler to inform client about connection configuration changes.
+    SUBSCRIBE   = 2 # Used by client to join the groups listed in the payload.
+    UNSUBSCRIBE = 3 # Used by client to leave the groups listed in the payload.
+    THROTTLE    = 4 # Used by handler to let the client know that a recipient's queue is full.
+    CREDIT      = 5 # Used by handler to allow the client to send more C2C messages.
     STOP      = 15  # Used by client & handler to inform the other end to close the connection.
 
 class BackboneS2SType(BackboneMessageType):
+    THROTTLE = 1    # Queued for a handler to pass a THROTTLE message on to its client.
+    CREDIT   = 2    # Queued for a handler to pass a CREDIT message on to its client.
     DONE  = 14
     STOP  = 15
 
+# Placeholder for fields that haven't been decoded from the original frame yet:
+_LAZY = object()
+
+# Type byte followed by a timestamp in epoch seconds (C2S and S2S headers):
+_TIMESTAMP_HEADER = struct.Struct(">BI")
+# Length prefix of messages in a batch:
+_LENGTH = struct.Struct(">I")
+
 # Base class for all Backbone messages:
 class BackboneMessage:
+    __slots__ = ("format", "type", "_raw")
+
     def __init__(self, format:BackboneMessageFormat, type:BackboneMessageType) -> None:
         if format not in BackboneMessageFormat:
             raise ValueError(f"Invalid Backbone message format: {format}")
 
         self.format = format
         self.type = type
+        # Messages parsed by from_bytes keep the frame they were parsed from and only decode fields
+        # when they are accessed. The frame is returned by to_bytes until the message is modified:
+        self._raw = None
     
+    def type_byte(self) -> int:
+        return (self.format << 4) + self.type
+
     def to_bytes(self):
-        msg_typing = ((self.format << 4) + self.type).to_bytes(1)
-        return msg_typing
+        return self.type_byte().to_bytes(1)
+
+    # Decodes any remaining fields and drops the original frame, called before a field is modified.
+    def _detach(self):
+        self._raw = None
     
     def  __eq__(self, __o: object) -> bool:
         if not isinstance(__o, BackboneMessage):
@@ -39,94 +71,292 @@ class BackboneMessage:
     
     @staticmethod
     def from_bytes(frame:bytes):
-        t =  frame[0] & 0b00001111
-        f = (frame[0] & 0b11110000) >> 4
-
-        try:
-            f = BackboneMessageFormat(f)
-            match f:
-                case BackboneMessageFormat.C2C:
-                    # C2C messages don't have separate types, so this should be 0.
-                    if t != 0: return None # This is not a valid message frame
-                    recipient_id = uuid.UUID(bytes=frame[1:17])
-                    payload      = frame[17:] if 17 < len(frame) else None
-                    return BackboneMessageC2C(recipient_id, payload)
-
-                case BackboneMessageFormat.C2S:
-                    t = BackboneC2SType(t)
-                    timestamp = datetime.fromtimestamp(int.from_bytes(frame[1:5]))
-                    payload = frame[5:] if 5 < len(frame) else None
-                    return BackboneMessageC2S(t, timestamp, payload)
-
-                case BackboneMessageFormat.S2S:
-                    t = BackboneS2SType(t)
-                    timestamp = datetime.fromtimestamp(int.from_bytes(frame[1:5]))
-                    payload = frame[5:] if 5 < len(frame) else None
-                    return BackboneMessageS2S(t, timestamp, payload)
-                
-        except ValueError as e:
-            print(e)
+        decoder = _decoders[frame[0]]
+        if decoder == None:
+            print(f"Invalid Backbone message type byte: {frame[0]:#04x}")
             return None
+        return decoder(frame)
 
 
 class BackboneMessageC2C(BackboneMessage):
+    __slots__ = ("_recipient", "_payload")
+
     def __init__(self, recipient:uuid.UUID, payload:bytes) -> None:
         super().__init__(BackboneMessageFormat.C2C, 0)
-        self.recipient = recipient
-        self.payload   = payload
+        self._recipient = recipient
+        self._payload   = payload
+
+    @property
+    def recipient(self) -> uuid.UUID:
+        if self._recipient is _LAZY:
+            self._recipient = uuid.UUID(bytes=bytes(self._raw[1:17]))
+        return self._recipient
+
+    @recipient.setter
+    def recipient(self, recipient:uuid.UUID):
+        self._detach()
+        self._recipient = recipient
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is _LAZY:
+            self._payload = bytes(self._raw[17:]) if 17 < len(self._raw) else None
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload:bytes):
+        self._detach()
+        self._payload = payload
     
     def to_bytes(self):
-        frame = super().to_bytes()
-        return frame + self.recipient.bytes + self.payload
+        if self._raw != None:
+            return self._raw
+        payload = self.payload if self.payload != None else b''
+        return b''.join((_C2C_TYPE_BYTE, self.recipient.bytes, payload))
+
+    def _detach(self):
+        self.recipient, self.payload
+        super()._detach()
     
     def __eq__(self, __o: object) -> bool:
         if not isinstance(__o, BackboneMessageC2C):
             return False
             
         return super().__eq__(__o) and __o.recipient == self.recipient and __o.payload == self.payload
+
+    @staticmethod
+    def _decode(frame:bytes):
+        if len(frame) < 17: return None # Too short to hold a recipient ID
+        msg = BackboneMessageC2C.__new__(BackboneMessageC2C)
+        msg.format      = BackboneMessageFormat.C2C
+        msg.type        = 0
+        msg._raw        = frame
+        msg._recipient  = _LAZY
+        msg._payload    = _LAZY
+        return msg
         
 
 class BackboneMessageC2S(BackboneMessage):
-    def __init__(self, type:BackboneC2SType, timestamp:datetime=None, payload:bytes=None) -> None:
+    __slots__ = ("_epoch", "_payload")
+
+    def __init__(self, type:BackboneC2SType, timestamp:datetime|int=None, payload:bytes=None) -> None:
         if type not in BackboneC2SType:
             raise ValueError(f"Invalid Backbone C2S type: {type}")
         super().__init__(BackboneMessageFormat.C2S, type)
-        if timestamp == None:
-            timestamp = datetime.now()
-        
-        self.timestamp = datetime.fromtimestamp(int(timestamp.timestamp()))
-        self.payload   = payload
+        self._epoch     = _epoch(timestamp)
+        self._payload   = payload
+
+    # Timestamp in whole epoch seconds, as sent on the wire:
+    @property
+    def epoch(self) -> int:
+        if self._epoch is _LAZY:
+            self._epoch = _TIMESTAMP_HEADER.unpack_from(self._raw)[1]
+        return self._epoch
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.epoch)
+
+    @timestamp.setter
+    def timestamp(self, timestamp:datetime|int):
+        self._detach()
+        self._epoch = _epoch(timestamp)
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is _LAZY:
+            self._payload = bytes(self._raw[5:]) if 5 < len(self._raw) else None
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload:bytes):
+        self._detach()
+        self._payload = payload
     
     def to_bytes(self):
-        frame = super().to_bytes()
-        payload = self.payload if self.payload != None else b''
-        return frame + int(self.timestamp.timestamp()).to_bytes(4) + payload
+        if self._raw != None:
+            return self._raw
+        header = _TIMESTAMP_HEADER.pack(self.type_byte(), self.epoch)
+        return header + self.payload if self.payload != None else header
+
+    def _detach(self):
+        self.epoch, self.payload
+        super()._detach()
 
     def __eq__(self, __o: object) -> bool:
         if not isinstance(__o, BackboneMessageC2S):
             return False
             
-        return super().__eq__(__o) and __o.timestamp == self.timestamp and __o.payload == self.payload
+        return super().__eq__(__o) and __o.epoch == self.epoch and __o.payload == self.payload
+
+    @staticmethod
+    def _decode(type:BackboneC2SType, frame:bytes):
+        if len(frame) < 5: return None # Too short to hold a timestamp
+        msg = BackboneMessageC2S.__new__(BackboneMessageC2S)
+        msg.format      = BackboneMessageFormat.C2S
+        msg.type        = type
+        msg._raw        = frame
+        msg._epoch      = _LAZY
+        msg._payload    = _LAZY
+        return msg
 
 
 class BackboneMessageS2S(BackboneMessage):
-    def __init__(self, type:BackboneS2SType, timestamp:datetime=None, payload:bytes=None) -> None:
+    __slots__ = ("_epoch", "_payload")
+
+    def __init__(self, type:BackboneS2SType, timestamp:datetime|int=None, payload:bytes=None) -> None:
         if type not in BackboneS2SType:
             raise ValueError(f"Invalid Backbone S2S type: {type}")
         super().__init__(BackboneMessageFormat.S2S, type)
-        if timestamp == None:
-            timestamp = datetime.now()
-        
-        self.timestamp = datetime.fromtimestamp(int(timestamp.timestamp()))
-        self.payload   = payload
+        self._epoch     = _epoch(timestamp)
+        self._payload   = payload
+
+    # Timestamp in whole epoch seconds, as sent on the wire:
+    @property
+    def epoch(self) -> int:
+        if self._epoch is _LAZY:
+            self._epoch = _TIMESTAMP_HEADER.unpack_from(self._raw)[1]
+        return self._epoch
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.epoch)
+
+    @timestamp.setter
+    def timestamp(self, timestamp:datetime|int):
+        self._detach()
+        self._epoch = _epoch(timestamp)
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is _LAZY:
+            self._payload = bytes(self._raw[5:]) if 5 < len(self._raw) else None
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload:bytes):
+        self._detach()
+        self._payload = payload
 
     def to_bytes(self):
-        frame = super().to_bytes()
-        payload = self.payload if self.payload != None else b''
-        return frame + int(self.timestamp.timestamp()).to_bytes(4) + payload
+        if self._raw != None:
+            return self._raw
+        header = _TIMESTAMP_HEADER.pack(self.type_byte(), self.epoch)
+        return header + self.payload if self.payload != None else header
+
+    def _detach(self):
+        self.epoch, self.payload
+        super()._detach()
     
     def __eq__(self, __o: object) -> bool:
         if not isinstance(__o, BackboneMessageS2S):
             return False
             
-        return super().__eq__(__o) and __o.timestamp == self.timestamp and __o.payload == self.payload
+        return super().__eq__(__o) and __o.epoch == self.epoch and __o.payload == self.payload
+
+    @staticmethod
+    def _decode(type:BackboneS2SType, frame:bytes):
+        if len(frame) < 5: return None # Too short to hold a timestamp
+        msg = BackboneMessageS2S.__new__(BackboneMessageS2S)
+        msg.format      = BackboneMessageFormat.S2S
+        msg.type        = type
+        msg._raw        = frame
+        msg._epoch      = _LAZY
+        msg._payload    = _LAZY
+        return msg
+
+
+# Converts a timestamp to whole epoch seconds, None means now.
+def _epoch(timestamp:datetime|int|None) -> int:
+    if timestamp == None:
+        return int(time.time())
+    if isinstance(timestamp, datetime):
+        return int(timestamp.timestamp())
+    return timestamp
+
+
+# Several messages packed into a single frame, so that small messages don't each pay for a frame
+# header, encryption overhead and a write. Each message is prefixed with its length:
+class BackboneMessageBatch(BackboneMessage):
+    __slots__ = ("messages",)
+
+    def __init__(self, messages:list[BackboneMessage]) -> None:
+        super().__init__(BackboneMessageFormat.BATCH, 0)
+        self.messages = messages
+
+    def to_bytes(self):
+        return BackboneMessageBatch.encode([msg.to_bytes() for msg in self.messages])
+
+    def __eq__(self, __o: object) -> bool:
+        if not isinstance(__o, BackboneMessageBatch):
+            return False
+
+        return super().__eq__(__o) and __o.messages == self.messages
+
+    # Builds a batch directly from messages that have already been converted to bytes.
+    @staticmethod
+    def encode(messages:list[bytes]) -> bytes:
+        parts = [_BATCH_TYPE_BYTE]
+        for data in messages:
+            parts.append(_LENGTH.pack(len(data)))
+            parts.append(data)
+        return b''.join(parts)
+
+    @staticmethod
+    def from_bytes(frame:bytes):
+        messages = []
+        view = memoryview(frame)
+        i = 1
+        while i < len(frame):
+            if i + 4 > len(frame):
+                return None
+            l = _LENGTH.unpack_from(frame, i)[0]
+            data = view[i+4:i+4+l]
+            i += 4 + l
+            if len(data) != l or l == 0:
+                return None
+
+            # C2C messages are copied out of the batch frame, since they end up on queues where a view would keep
+            # the whole frame in memory until the last of them has been sent. Other messages are handled right away
+            # and keep referring to the frame:
+            msg = BackboneMessage.from_bytes(bytes(data) if data[0] == _C2C_TYPE_BYTE[0] else data)
+            # Batches can't be nested:
+            if msg == None or msg.format == BackboneMessageFormat.BATCH:
+                return None
+            messages.append(msg)
+
+        return BackboneMessageBatch(messages)
+
+    # Splits items into consecutive groups where the combined size of each group is at most max_size.
+    # Items larger than max_size end up in a group of their own.
+    @staticmethod
+    def group(items:list, max_size:int=BATCH_SIZE, size=len) -> list[list]:
+        groups = []
+        current = []
+        current_size = 0
+        for item in items:
+            item_size = size(item) + 4
+            if len(current) > 0 and current_size + item_size > max_size:
+                groups.append(current)
+                current = []
+                current_size = 0
+            current.append(item)
+            current_size += item_size
+        if len(current) > 0:
+            groups.append(current)
+        return groups
+
+
+_C2C_TYPE_BYTE   = bytes([BackboneMessageFormat.C2C << 4])
+_BATCH_TYPE_BYTE = bytes([BackboneMessageFormat.BATCH << 4])
+
+# Decoders indexed by the first byte of a frame, None for bytes that aren't valid message types.
+# Built once so from_bytes doesn't need to construct enums or match on the format for every frame:
+_decoders = [None] * 256
+_decoders[BackboneMessageFormat.C2C << 4]   = BackboneMessageC2C._decode
+_decoders[BackboneMessageFormat.BATCH << 4] = BackboneMessageBatch.from_bytes
+for _t in BackboneC2SType:
+    _decoders[(BackboneMessageFormat.C2S << 4) + _t] = functools.partial(BackboneMessageC2S._decode, _t)
+for _t in BackboneS2SType:
+    _decoders[(BackboneMessageFormat.S2S << 4) + _t] = functools.partial(BackboneMessageS2S._decode, _t)
+del _t
@@ -4,7 +4,7 @@ from uuid import uuid4
 import unittest, uuid
 
 import message
-from message import BackboneMessage, BackboneMessageC2C, BackboneMessageC2S, BackboneMessageS2S, BackboneC2SType, BackboneS2SType, BackboneMessageFormat
+from message import BackboneMessage, BackboneMessageC2C, BackboneMessageC2S, BackboneMessageS2S, BackboneMessageBatch, BackboneC2SType, BackboneS2SType, BackboneMessageFormat
 
 class TestMessageTranslation(unittest.TestCase):
 
@@ -12,6 +12,7 @@ class TestMessageTranslation(unittest.TestCase):
         self.assertTrue(BackboneMessageFormat.C2C == 0)
         self.assertTrue(BackboneMessageFormat.C2S == 1)
         self.assertTrue(BackboneMessageFormat.S2S == 2)
+        self.assertTrue(BackboneMessageFormat.BATCH == 3)
     
     def test_message_c2s_types(self):
         self.assertTrue(BackboneC2SType.HEARTBEAT == 0)
@@ -118,5 +119,62 @@ class TestMessageTranslation(unittest.TestCase):
         self.assertEqual(msg, BackboneMessage.from_bytes(b'\x2F' + timestamp_b + payload))
 
 
+    def test_message_batch(self):
+        msgs = [BackboneMessageC2C(uuid4(), urandom(i)) for i in range(1, 10)] + [BackboneMessageC2S(BackboneC2SType.HEARTBEAT)]
+        msg = BackboneMessageBatch(msgs)
+        msg_b = msg.to_bytes()
+        self.assertEqual(msg_b[0], 0x30)
+        self.assertEqual(msg_b, BackboneMessageBatch.encode([m.to_bytes() for m in msgs]))
+        self.assertEqual(msg, BackboneMessage.from_bytes(msg_b))
+
+        self.assertIsNone(BackboneMessage.from_bytes(msg_b[:-1]), "Truncated batches should be rejected.")
+        self.assertIsNone(BackboneMessage.from_bytes(BackboneMessageBatch.encode([msg_b])), "Nested batches should be rejected.")
+
+    def test_message_lazy_decoding(self):
+        recipient = uuid4()
+        payload = urandom(32)
+        msg_b = BackboneMessageC2C(recipient, payload).to_bytes()
+        msg = BackboneMessage.from_bytes(msg_b)
+        self.assertIs(msg.to_bytes(), msg_b, "Unmodified messages should return the frame they were parsed from.")
+        self.assertEqual(msg.recipient, recipient)
+        self.assertEqual(msg.payload, payload)
+        self.assertIs(msg.to_bytes(), msg_b, "Reading fields should not invalidate the original frame.")
+
+        msg.payload = b'changed'
+        self.assertEqual(msg.to_bytes(), BackboneMessageC2C(recipient, b'changed').to_bytes(), "Modified messages should be encoded again.")
+
+        msg = BackboneMessage.from_bytes(BackboneMessageC2S(BackboneC2SType.CONFIG, payload=payload).to_bytes())
+        timestamp = msg.timestamp
+        msg.payload = None
+        self.assertEqual(msg.timestamp, timestamp, "Fields should be kept when the original frame is dropped.")
+
+        self.assertIsNone(BackboneMessage.from_bytes(msg_b[:16]), "C2C messages without a full recipient ID should be rejected.")
+
+        msgs = [BackboneMessageC2C(uuid4(), urandom(i)) for i in range(1, 4)] + [BackboneMessageC2S(BackboneC2SType.HEARTBEAT)]
+        batch = BackboneMessage.from_bytes(BackboneMessageBatch(msgs).to_bytes())
+        self.assertIsInstance(batch.messages[0].to_bytes(), bytes, "C2C messages in a batch should not keep the whole batch frame in memory.")
+        self.assertIsInstance(batch.messages[-1]._raw, memoryview, "Other messages in a batch should refer to the batch frame.")
+        self.assertEqual(batch.messages, msgs)
+
+    def test_message_compact(self):
+        msg = BackboneMessageC2S(BackboneC2SType.HEARTBEAT, 1700000000)
+        self.assertFalse(hasattr(msg, "__dict__"), "Messages should not have a per-instance __dict__.")
+        self.assertEqual(msg.epoch, 1700000000)
+        self.assertEqual(msg.timestamp, datetime.fromtimestamp(1700000000))
+        self.assertEqual(msg, BackboneMessageC2S(BackboneC2SType.HEARTBEAT, datetime.fromtimestamp(1700000000)))
+        self.assertEqual(BackboneMessage.from_bytes(msg.to_bytes()).epoch, 1700000000)
+
+        self.assertIsNone(BackboneMessage.from_bytes(b'\x01' + bytes(16)), "C2C messages with a type should be rejected.")
+        self.assertIsNone(BackboneMessage.from_bytes(b'\x1e' + bytes(4)), "Unknown C2S types should be rejected.")
+        self.assertIsNone(BackboneMessage.from_bytes(b'\x40'), "Unknown formats should be rejected.")
+        self.assertIsNone(BackboneMessage.from_bytes(b'\x10\x00'), "C2S messages without a full timestamp should be rejected.")
+
+    def test_message_batch_group(self):
+        items = [urandom(10) for _ in range(10)] + [urandom(100)]
+        groups = BackboneMessageBatch.group(items, max_size=50)
+        self.assertEqual([len(g) for g in groups], [3, 3, 3, 1, 1], "Each group should hold at most max_size bytes, including the length prefixes.")
+        self.assertEqual(sum(groups, []), items, "Grouping should keep the order of the items.")
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+# reactor.py
+# Selector-based socket monitoring: one thread waits on many sockets and calls back when one becomes
+# readable, instead of every connection polling its own socket with a timeout.
+import selectors
+import socket
+import threading
+from queue import Empty, Queue
+
+from wakeup import Waker
+
+class Reactor:
+    def __init__(self, name:str="reactor") -> None:
+        self.name = name
+        self.stop_flag = threading.Event()
+        self.thread = None
+
+        # The selector is only touched by the reactor thread, other threads queue their changes
+        # and use the waker to interrupt the select call:
+        self._pending = Queue()
+        self._waker = Waker()
+
+    def start(self):
+        self.stop_flag.clear()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, block:bool=False):
+        self.stop_flag.set()
+        self._waker.wake()
+        if block and self.thread:
+            self.thread.join()
+
+    def is_running(self) -> bool:
+        return self.thread != None and self.thread.is_alive()
+
+    # Starts monitoring conn. on_readable(conn) is called whenever data is available, and can return False
+    # to have the socket unregistered. Timeouts are left to the shared timing wheel (see timer.py), so the
+    # reactor only wakes up when a socket is readable or a registration changes.
+    # Returns an event that is set once the socket is registered.
+    def register(self, conn:socket.socket, on_readable) -> threading.Event:
+        done = threading.Event()
+        self._pending.put((conn, on_readable, done))
+        self._waker.wake()
+        return done
+
+    # Stops monitoring conn. Returns an event that is set once the reactor no longer uses the socket,
+    # after which it is safe to close it.
+    def unregister(self, conn:socket.socket) -> threading.Event:
+        done = threading.Event()
+        self._pending.put((conn, None, done))
+        self._waker.wake()
+        return done
+
+    def _apply_pending(self, selector:selectors.BaseSelector):
+        while True:
+            try:
+                conn, on_readable, done = self._pending.get_nowait()
+            except Empty:
+                return
+
+            try:
+                if on_readable != None:
+                    selector.register(conn, selectors.EVENT_READ, on_readable)
+                elif conn in selector.get_map():
+                    selector.unregister(conn)
+            except (KeyError, ValueError, OSError) as e:
+                print(f"{self.name}: Failed to update registration for {conn}: {e}")
+            done.set()
+
+    def _run(self):
+        print(f"{self.name}: Reactor started")
+        selector = selectors.DefaultSelector()
+        selector.register(self._waker, selectors.EVENT_READ, None)
+
+        try:
+            while not self.stop_flag.is_set():
+                self._apply_pending(selector)
+
+                for selector_key, _ in selector.select():
+                    if selector_key.data == None:
+                        self._waker.clear()
+                        continue
+
+                    if not self._call(selector_key.data, selector_key.fileobj):
+                        selector.unregister(selector_key.fileobj)
+        finally:
+            # Release anyone waiting for a registration change:
+            self._apply_pending(selector)
+            selector.close()
+            print(f"{self.name}: Reactor stopped")
+
+    def _call(self, callback, arg) -> bool:
+        try:
+            return callback(arg) != False
+        except Exception as e:
+            print(f"{self.name}: Unexpected exception in callback {callback}: {e}")
+            return False
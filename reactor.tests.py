@@ -0,0 +1,66 @@
+import socket
+import threading
+import time
+import unittest
+
+from reactor import Reactor
+
+class TestReactor(unittest.TestCase):
+    def test_start_stop(self):
+        reactor = Reactor()
+        reactor.start()
+        self.assertTrue(reactor.is_running())
+        reactor.stop(block=True)
+        self.assertFalse(reactor.is_running())
+
+    def test_readable_callback(self):
+        reactor = Reactor()
+        socket1, socket2 = socket.socketpair()
+        received = []
+        received_flag = threading.Event()
+
+        def on_readable(conn:socket.socket):
+            received.append(conn.recv(1024))
+            received_flag.set()
+
+        try:
+            reactor.start()
+            self.assertTrue(reactor.register(socket2, on_readable).wait(1), "Registration should complete once the reactor has picked it up.")
+
+            socket1.sendall(b'Hi!')
+            self.assertTrue(received_flag.wait(1), "The callback should be called when data arrives on the socket.")
+            self.assertEqual(received, [b'Hi!'])
+
+            self.assertTrue(reactor.unregister(socket2).wait(1))
+            received_flag.clear()
+            socket1.sendall(b'Hi again!')
+            self.assertFalse(received_flag.wait(0.2), "The callback should not be called once the socket has been unregistered.")
+        finally:
+            reactor.stop(block=True)
+            socket1.close()
+            socket2.close()
+
+    def test_callback_unregister(self):
+        reactor = Reactor()
+        socket1, socket2 = socket.socketpair()
+        calls = { "readable": 0 }
+
+        def on_readable(conn:socket.socket):
+            calls["readable"] += 1
+            return False
+
+        try:
+            reactor.start()
+            reactor.register(socket2, on_readable).wait(1)
+
+            socket1.sendall(b'Hi!')
+            time.sleep(0.2)
+            self.assertEqual(calls["readable"], 1, "Returning False from the callback should unregister the socket, even if data remains unread.")
+        finally:
+            reactor.stop(block=True)
+            socket1.close()
+            socket2.close()
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,75 @@
+# relay.py
+# Connects a worker process of a cluster to the broker (see cluster.py), which passes C2C messages
+# between workers. The worker tells the broker which clients are connected to it and which groups
+# they have joined, so that the broker knows where to send messages for recipients that aren't local.
+import threading
+from multiprocessing.connection import Connection
+from uuid import UUID
+
+# Each message passed between a worker and the broker starts with one of these:
+READY   = b'Y'  # The worker is listening for connections.
+PRESENT = b'P'  # + client ID: the client has connected to the worker.
+ABSENT  = b'A'  # + client ID: the client has disconnected from the worker.
+JOIN    = b'J'  # + group ID: the group has gained its first member on the worker.
+LEAVE   = b'L'  # + group ID: the group has lost its last member on the worker.
+ROUTE   = b'R'  # + message: a C2C message for clients connected to other workers (or to this worker, from the broker).
+STOP    = b'S'  # The worker should stop (from the broker).
+REFUSE  = b'X'  # + client ID: the client is already connected to another worker, so its new connection should be closed (from the broker).
+
+class Relay:
+    def __init__(self, connection:Connection, deliver=None, refuse=None) -> None:
+        self.connection = connection
+        # deliver(data) is called with each message the broker routes to this worker:
+        self.deliver = deliver
+        # refuse(client_id) is called when the broker finds that a client is already connected to another worker:
+        self.refuse = refuse
+        # Handler threads share the connection:
+        self._send_lock = threading.Lock()
+
+    def ready(self):
+        self._send(READY)
+
+    def announce(self, client_id:UUID, present:bool):
+        self._send((PRESENT if present else ABSENT) + client_id.bytes)
+
+    def join(self, group_id:UUID, joined:bool):
+        self._send((JOIN if joined else LEAVE) + group_id.bytes)
+
+    def forward(self, data:bytes):
+        self._send(ROUTE + data)
+
+    # Passes messages from the broker to deliver until the broker asks the worker to stop or goes away.
+    def run(self):
+        while True:
+            try:
+                data = self.connection.recv_bytes()
+            except (EOFError, OSError):
+                print("relay: Lost the connection to the broker")
+                return
+
+            match data[:1]:
+                case b'S':
+                    return
+                case b'R':
+                    if self.deliver == None:
+                        continue
+                    try:
+                        self.deliver(data[1:])
+                    except Exception as e:
+                        print(f"relay: Failed to deliver a message from the broker: {e}")
+                case b'X':
+                    if self.refuse == None or len(data) != 17:
+                        continue
+                    try:
+                        self.refuse(UUID(bytes=data[1:]))
+                    except Exception as e:
+                        print(f"relay: Failed to refuse a client connection: {e}")
+                case _:
+                    print(f"relay: Received unknown message from the broker ({data[:1]}), dropping it.")
+
+    def _send(self, data:bytes):
+        with self._send_lock:
+            try:
+                self.connection.send_bytes(data)
+            except (OSError, ValueError) as e:
+                print(f"relay: Failed to send to the broker: {e}")
@@ -4,35 +4,56 @@ import tomllib
 import time
 
 # Modules that are core to the server:
+import os
+import select
 import socket
 import traceback
 import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from identity import IdentityComponent, ChallengeFailed
+from reactor import Reactor
+from relay import Relay
+from spool import Spool
+from supervisor import Supervisor
+import frame
 import handle
+import timer
+from wakeup import StopFlag, Waker
 
 class BackboneServer:
-    def __init__(self, settings={}, identities:IdentityComponent = None) -> None:
+    # relay connects the server to the broker when it runs as a worker of a cluster, see cluster.py.
+    def __init__(self, settings={}, identities:IdentityComponent = None, relay:Relay = None) -> None:
         self.settings = settings
         self._ensure_settings()
         
         self.auth = identities
         if self.auth == None:
-            self.auth = IdentityComponent()
+            self.auth = IdentityComponent(key_cache_size=self.settings["key_cache_size"], key_store=self.settings["key_store"])
+
+        self.relay = relay
 
         self.server_thread = None
         self.stop_flag     = None
+        self.supervisor    = None
+        # Set once the server is listening for connections:
+        self.ready_flag    = None
     
     def start(self, block:bool = False) -> bool:
 
         if self.stop_flag != None and not self.stop_flag.is_set():
             return False
 
-        self.stop_flag = threading.Event()
-        self.server_thread    = threading.Thread(target=BackboneServer._run, kwargs={
+        self.stop_flag = StopFlag()
+        self.ready_flag = threading.Event()
+        self.supervisor = Supervisor(report_interval=self.settings["supervisor_report_interval"] if "supervisor_report_interval" in self.settings else 300)
+        self.server_thread    = threading.Thread(target=self._run, kwargs={
             "settings": self.settings,
             "auth": self.auth,
             "stop_flag": self.stop_flag,
+            "supervisor": self.supervisor,
+            "relay": self.relay,
+            "ready_flag": self.ready_flag
         })
         
 
@@ -56,13 +77,42 @@ class BackboneServer:
             self.server_thread.join()
         
         return True
+
+    # Returns the number of handlers being tracked, started and finished, and the number of routing entries.
+    def stats(self) -> dict | None:
+        if self.supervisor == None:
+            return None
+        return self.supervisor.stats()
     
     def _ensure_settings(self):
         default_settings = {
             "challenge_size": 2048,
+            "handshake_workers": os.cpu_count() or 4,
+            "handshake_backlog": 64,
+            "handshake_timeout": 10,
+            "reactor_threads": 0,
+            "max_frame_size": 2**20,
+            "crypto_workers": 0,
+            "crypto_executor": "thread",
+            "crypto_offload_threshold": 2**16,
+            "key_store": "file",
+            "key_cache_size": 1024,
+            "preload_client_keys": False,
+            "client_queue_limit": 10000,
+            "client_queue_policy": "drop_newest",
+            "client_queue_block_timeout": 1,
+            "client_queue_overrides": {},
+            "spool": False,
+            "spool_segment_size": 2**22,
+            "spool_max_size": 2**26,
+            "spool_max_age": 7*24*3600,
+            "supervisor_report_interval": 300,
+            "reuse_port": False,
+            "cluster_workers": 0,
             "client": {
                 "heartbeat_timout": 600,
-                "heartbeat_intervall": 300
+                "heartbeat_intervall": 300,
+                "credit_window": 1024
             }
         }
 
@@ -85,12 +135,55 @@ class BackboneServer:
         copy_settings(default_settings, self.settings)
     
     @staticmethod
-    def _run(stop_flag:threading.Event, auth:IdentityComponent, settings:dict):
+    def _run(stop_flag:StopFlag, auth:IdentityComponent, settings:dict, supervisor:Supervisor=None, relay:Relay=None, ready_flag:threading.Event=None):
         next_connection_id = 1
-        handlers = {}
 
-        port           = settings["port"] if "port" in settings else 4000
-        challenge_size = settings["challenge_size"] if "challenge_size" in settings else 2048
+        port              = settings["port"] if "port" in settings else 4000
+        handshake_workers = settings["handshake_workers"] if "handshake_workers" in settings else 4
+        handshake_backlog = settings["handshake_backlog"] if "handshake_backlog" in settings else 64
+
+        # Handshakes run on a bounded pool so that a slow client can't stall the accept loop.
+        # Each slot is held from accept until the handshake finishes, connections beyond
+        # workers + backlog are dropped rather than queued without limit:
+        handshakes      = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix="handshake")
+        handshake_slots = threading.BoundedSemaphore(handshake_workers + handshake_backlog)
+
+        if settings["preload_client_keys"] if "preload_client_keys" in settings else False:
+            print(f"Preloaded {auth.preload_client_keys()} client keys")
+
+        # RSA-encrypted frames above the threshold have their blocks encrypted/decrypted on a
+        # shared pool, so that large transfers aren't limited to a single core:
+        crypto_workers = settings["crypto_workers"] if "crypto_workers" in settings else 0
+        crypto_pool = None
+        if crypto_workers > 0:
+            if (settings["crypto_executor"] if "crypto_executor" in settings else "thread") == "process":
+                crypto_pool = ProcessPoolExecutor(max_workers=crypto_workers)
+            else:
+                crypto_pool = ThreadPoolExecutor(max_workers=crypto_workers, thread_name_prefix="crypto")
+            frame.set_crypto_executor(crypto_pool, settings["crypto_offload_threshold"] if "crypto_offload_threshold" in settings else 2**16, crypto_workers)
+
+        if relay != None and (settings["spool"] if "spool" in settings else False):
+            # Each worker would keep its own index of the same spool directory:
+            print("Spooling is not supported when running as part of a cluster, messages for clients that aren't connected will be dropped.")
+        else:
+            handle.set_spool(BackboneServer._open_spool(settings, auth))
+        handle.set_relay(relay)
+        BackboneServer._set_queue_limits(settings)
+
+        # With reactor threads enabled, client sockets are shared between them instead of each
+        # handler running its own socket monitor thread:
+        reactor_threads = settings["reactor_threads"] if "reactor_threads" in settings else 0
+        reactors = [Reactor(name=f"reactor-{i}") for i in range(reactor_threads)]
+        for reactor in reactors:
+            reactor.start()
+
+        # The supervisor keeps track of handlers and removes them once they are done:
+        if supervisor == None:
+            supervisor = Supervisor()
+
+        # The accept loop waits on the listening socket and the waker, which is woken when the server is stopped:
+        waker = Waker()
+        stop_flag.on_set(waker.wake)
 
         try:
             with socket.socket(
@@ -98,12 +191,23 @@ class BackboneServer:
                 type=socket.SOCK_STREAM
             ) as sock:
             
+                if settings["reuse_port"] if "reuse_port" in settings else False:
+                    # Lets the workers of a cluster listen on the same port, the kernel spreads connections between them:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 sock.bind(("0.0.0.0", port))
+                # Only guards against a connection going away between select and accept:
                 sock.settimeout(0.1)
                 sock.listen()
                 print(f"Server listening on {sock.getsockname()[1]}")
+                supervisor.start()
+                if ready_flag != None:
+                    ready_flag.set()
 
                 while not stop_flag.is_set():
+                    readable, _, _ = select.select([sock, waker], [], [])
+                    if waker in readable:
+                        waker.clear()
+                        continue
                     try:
                         clientsock, address = sock.accept()
                     except TimeoutError:
@@ -114,41 +218,37 @@ class BackboneServer:
                         
                     print(f"{connection_id}: New connection from {address}")
 
-                    try:
-                        client_socket, client = auth.challenge(clientsock, challenge_size, settings["client"])
-                        print(f"{connection_id}: challenge met for client {client.id}")
-
-                        if handle.get_client_queue(client.id) != None:
-                            print(f"{connection_id}: Client {client.id} is already connected, dropping this connection.")
-                            client_socket.close()
-                            continue
-                        
-                        # At this point the client is authenticated.
-                        handler = handle.ClientHandler(
-                            client_connection=client_socket,
-                            client=client,
-                            server=auth
-                        )
-
-                        handlers[client.id.hex] = handler
-                        handler.start()
-
-                    except ChallengeFailed as e:
-                        print(f"{connection_id}: Challenge failed: {e}")
-                        clientsock.close()
-                    except Exception as e:
-                        # Something went wrong with the underlying connection, close it.
-                        print(f"{connection_id}: Unexpected failure during challenge: {e}")
-                        traceback.print_tb(e.__traceback__)
+                    if not handshake_slots.acquire(blocking=False):
+                        print(f"{connection_id}: Too many pending handshakes, dropping connection from {address}.")
                         clientsock.close()
+                        continue
+
+                    handshakes.submit(BackboneServer._handshake, **{
+                        "connection_id": connection_id,
+                        "clientsock": clientsock,
+                        "auth": auth,
+                        "settings": settings,
+                        "stop_flag": stop_flag,
+                        "supervisor": supervisor,
+                        "handshake_slots": handshake_slots,
+                        "reactors": reactors
+                    })
         finally:
-            for handler in handlers.values():
+            stop_flag.remove(waker.wake)
+            waker.close()
+
+            # Pending handshakes notice the stop flag and close their sockets, those in progress are interrupted:
+            handshakes.shutdown(wait=True)
+
+            stopping = supervisor.handlers()
+
+            for handler in stopping:
                 try:
                     handler.stop()
                 except Exception as e:
                     print(f"Exception occurred while trying to stop a handler: {e}")
                     continue
-            for handler in handlers.values():
+            for handler in stopping:
                 if handler.is_running():
                     try:
                         print(f"Waiting for {handler} to stop running")
@@ -157,9 +257,113 @@ class BackboneServer:
                     except:
                         pass
 
+            supervisor.stop(block=True)
+
+            for reactor in reactors:
+                reactor.stop(block=True)
+
+            if crypto_pool != None:
+                frame.set_crypto_executor(None)
+                crypto_pool.shutdown(wait=True)
+
+            handle.set_spool(None)
+            handle.set_relay(None)
 
             print("Server stopped.")
 
+    # Messages for clients that aren't connected are kept in .server/spool when spooling is enabled:
+    @staticmethod
+    def _open_spool(settings:dict, auth:IdentityComponent) -> Spool | None:
+        if not (settings["spool"] if "spool" in settings else False):
+            return None
+
+        return Spool(
+            os.path.join(auth.server_dir, "spool"),
+            segment_size=settings["spool_segment_size"] if "spool_segment_size" in settings else 2**22,
+            max_size=settings["spool_max_size"] if "spool_max_size" in settings else 2**26,
+            max_age=settings["spool_max_age"] if "spool_max_age" in settings else 7*24*3600,
+            # Only spool messages for clients that could connect to collect them:
+            accept=lambda client_id: auth.get_client_key(client_id) != None
+        )
+
+    @staticmethod
+    def _set_queue_limits(settings:dict):
+        handle.set_queue_limits(
+            settings["client_queue_limit"] if "client_queue_limit" in settings else 0,
+            settings["client_queue_policy"] if "client_queue_policy" in settings else "drop_newest",
+            settings["client_queue_block_timeout"] if "client_queue_block_timeout" in settings else 1,
+            settings["client_queue_overrides"] if "client_queue_overrides" in settings else {}
+        )
+
+    @staticmethod
+    def _handshake(connection_id:int, clientsock:socket.socket, auth:IdentityComponent, settings:dict, stop_flag:StopFlag, supervisor:Supervisor, handshake_slots:threading.BoundedSemaphore, reactors:list[Reactor]=[]):
+        challenge_size    = settings["challenge_size"] if "challenge_size" in settings else 2048
+        handshake_timeout = settings["handshake_timeout"] if "handshake_timeout" in settings else 10
+        max_frame_size    = settings["max_frame_size"] if "max_frame_size" in settings else None
+
+        # The socket timeout only applies to each read and write, so a client trickling data could keep
+        # the handshake going indefinitely. The whole handshake has to complete before the timer fires:
+        expired = threading.Event()
+        def on_deadline():
+            expired.set()
+            try:
+                clientsock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        deadline = timer.shared().schedule(handshake_timeout, on_deadline)
+
+        def on_stop():
+            try:
+                clientsock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        try:
+            if stop_flag.is_set():
+                clientsock.close()
+                return
+            stop_flag.on_set(on_stop)
+
+            # Every read and write during the challenge must complete within the handshake timeout:
+            clientsock.settimeout(handshake_timeout)
+            client_socket, client = auth.challenge(clientsock, challenge_size, settings["client"], max_frame_size)
+            deadline.cancel()
+            stop_flag.remove(on_stop)
+            if expired.is_set():
+                raise TimeoutError()
+            if stop_flag.is_set():
+                client_socket.close()
+                return
+            print(f"{connection_id}: challenge met for client {client.id}")
+
+            # At this point the client is authenticated.
+            handler = handle.ClientHandler(
+                client_connection=client_socket,
+                client=client,
+                server=auth,
+                reactor=reactors[hash(client.id) % len(reactors)] if len(reactors) > 0 else None
+            )
+
+            if not supervisor.add(handler):
+                print(f"{connection_id}: Client {client.id} is already connected, dropping this connection.")
+                client_socket.close()
+                return
+
+        except Exception as e:
+            if expired.is_set() or isinstance(e, TimeoutError):
+                print(f"{connection_id}: Client did not complete the challenge within {handshake_timeout}s.")
+            elif isinstance(e, ChallengeFailed):
+                print(f"{connection_id}: Challenge failed: {e}")
+            else:
+                # Something went wrong with the underlying connection, close it.
+                print(f"{connection_id}: Unexpected failure during challenge: {e}")
+                traceback.print_tb(e.__traceback__)
+            clientsock.close()
+        finally:
+            deadline.cancel()
+            stop_flag.remove(on_stop)
+            handshake_slots.release()
+
 if __name__ == "__main__":
     with open("./settings.toml", 'rb') as f:
         settings = tomllib.load(f)
@@ -1,9 +1,16 @@
 import unittest
 import time
 import tomllib
+import random
+import socket
+from tempfile import TemporaryDirectory
+from uuid import uuid4
 
+import key
 from identity import IdentityComponent
 from server import BackboneServer
+from client import BackboneClient
+from message import BackboneMessageC2C as MsgC2C
 
 class TestServer(unittest.TestCase):
     def test_server_creation_default(self):
@@ -22,7 +29,250 @@ class TestServer(unittest.TestCase):
         server.start()
         time.sleep(1)
         server.stop()
-        
+
+    def test_stalled_handshake(self):
+        client_id  = uuid4()
+        client_key = key.generate()
+        client     = BackboneClient(client_id, client_key)
+        port       = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id, client_key.public_key())
+            server = BackboneServer(settings={ "port": port, "handshake_workers": 2, "handshake_timeout": 2 }, identities=auth)
+            stalled = None
+
+            try:
+                server.start()
+                time.sleep(0.2)
+
+                # A client that connects but never answers the challenge:
+                stalled = socket.create_connection(("127.0.0.1", port))
+
+                start_time = time.monotonic()
+                self.assertTrue(client.start("127.0.0.1", port).wait(3), "A stalled handshake should not prevent other clients from connecting.")
+                self.assertLess(time.monotonic() - start_time, 2, "The second client should not have to wait for the stalled handshake to time out.")
+
+                # Skip the challenge, the server should then close the connection once the timeout passes:
+                stalled.settimeout(3)
+                while stalled.recv(4096) != b'':
+                    pass
+                self.assertLess(time.monotonic() - start_time, 3, "The stalled connection should be closed once the handshake timeout has passed.")
+            finally:
+                client.stop()
+                server.stop(block=True)
+                if stalled != None:
+                    stalled.close()
+
+    def test_stop_latency(self):
+        # Clients share a key, so that the test doesn't spend its time generating keys:
+        client_key = key.generate()
+        client_ids = [uuid4() for _ in range(300)]
+        port       = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            for client_id in client_ids:
+                auth.add_client_key(client_id, client_key.public_key())
+            server = BackboneServer(settings={ "port": port, "reactor_threads": 4 }, identities=auth)
+            clients = [BackboneClient(client_id, client_key) for client_id in client_ids]
+            stalled = None
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                for client in clients:
+                    self.assertTrue(client.start("127.0.0.1", port).wait(3))
+                # A handshake in progress should be interrupted as well:
+                stalled = socket.create_connection(("127.0.0.1", port))
+                time.sleep(0.5)
+                self.assertEqual(server.stats()["handlers"], len(clients))
+
+                start_time = time.monotonic()
+                server.stop(block=True)
+                self.assertLess(time.monotonic() - start_time, 1, "Stopping the server should not wait for handlers or handshakes to time out.")
+            finally:
+                for client in clients:
+                    client.stop()
+                server.stop(block=True)
+                if stalled != None:
+                    stalled.close()
+
+    def test_handler_reaping(self):
+        client_id  = uuid4()
+        client_key = key.generate()
+        port       = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id, client_key.public_key())
+            server = BackboneServer(settings={ "port": port }, identities=auth)
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                for _ in range(5):
+                    client = BackboneClient(client_id, client_key)
+                    self.assertTrue(client.start("127.0.0.1", port).wait(3))
+                    client.stop()
+                    # Wait for the handler to be reaped, so the next connection isn't refused:
+                    deadline = time.monotonic() + 3
+                    while server.stats()["handlers"] > 0 and time.monotonic() < deadline:
+                        time.sleep(0.05)
+
+                stats = server.stats()
+                self.assertEqual(stats["handlers"], 0, "Handlers should be removed once their client disconnects.")
+                self.assertEqual(stats["started"], 5)
+                self.assertEqual(stats["finished"], 5)
+                self.assertEqual(stats["routes"], 0, "No routing entries should be left behind by disconnected clients.")
+            finally:
+                server.stop(block=True)
+
+    def test_c2c_reactor(self):
+        client_id1  = uuid4()
+        client_key1 = key.generate()
+        client_id2  = uuid4()
+        client_key2 = key.generate()
+        client1 = BackboneClient(client_id1, client_key1)
+        client2 = BackboneClient(client_id2, client_key2)
+        port    = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id1, client_key1.public_key())
+            auth.add_client_key(client_id2, client_key2.public_key())
+            server = BackboneServer(settings={ "port": port, "reactor_threads": 2 }, identities=auth)
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                self.assertTrue(client1.start("127.0.0.1", port).wait(3))
+                self.assertTrue(client2.start("127.0.0.1", port).wait(3))
+                # The handlers register their queues after the clients are ready:
+                time.sleep(0.2)
+
+                msg1 = MsgC2C(client_id2, b'client1->client2')
+                client1.send(msg1).wait()
+                self.assertEqual(client2.read(block=True), msg1)
+
+                msg2 = MsgC2C(client_id1, b'client2->client1')
+                client2.send(msg2).wait()
+                self.assertEqual(client1.read(block=True), msg2)
+            finally:
+                client1.stop()
+                client2.stop()
+                server.stop(block=True)
+
+    def test_c2c_group(self):
+        client_ids  = [uuid4() for _ in range(3)]
+        client_keys = [key.generate() for _ in range(3)]
+        clients     = [BackboneClient(client_id, client_key) for client_id, client_key in zip(client_ids, client_keys)]
+        group_id    = uuid4()
+        port        = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            for client_id, client_key in zip(client_ids, client_keys):
+                auth.add_client_key(client_id, client_key.public_key())
+            server = BackboneServer(settings={ "port": port }, identities=auth)
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                for client in clients:
+                    self.assertTrue(client.start("127.0.0.1", port).wait(3))
+                clients[1].subscribe(group_id).wait()
+                clients[2].subscribe(group_id).wait()
+                # The handlers register their queues and subscriptions after the clients are ready:
+                time.sleep(0.2)
+
+                msg1 = MsgC2C(group_id, b'client1->group')
+                clients[0].send(msg1).wait()
+                self.assertEqual(clients[1].read(block=True), msg1)
+                self.assertEqual(clients[2].read(block=True), msg1)
+
+                clients[2].unsubscribe(group_id).wait()
+                time.sleep(0.2)
+                msg2 = MsgC2C(group_id, b'client1->group again')
+                clients[0].send(msg2).wait()
+                self.assertEqual(clients[1].read(block=True), msg2)
+                time.sleep(0.2)
+                self.assertIsNone(clients[2].read(), "Clients should not receive group messages after unsubscribing.")
+            finally:
+                for client in clients:
+                    client.stop()
+                server.stop(block=True)
+
+    def test_c2c_spool(self):
+        client_id1  = uuid4()
+        client_key1 = key.generate()
+        client_id2  = uuid4()
+        client_key2 = key.generate()
+        client1 = BackboneClient(client_id1, client_key1)
+        client2 = BackboneClient(client_id2, client_key2)
+        port    = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id1, client_key1.public_key())
+            auth.add_client_key(client_id2, client_key2.public_key())
+            server = BackboneServer(settings={ "port": port, "spool": True }, identities=auth)
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                self.assertTrue(client1.start("127.0.0.1", port).wait(3))
+                time.sleep(0.2)
+
+                # client2 isn't connected yet, so these should be spooled:
+                msgs = [MsgC2C(client_id2, f'client1->client2 #{i}'.encode()) for i in range(5)]
+                for msg in msgs:
+                    client1.send(msg).wait()
+                client1.send(MsgC2C(uuid4(), b'unknown recipient')).wait()
+                time.sleep(0.2)
+
+                self.assertTrue(client2.start("127.0.0.1", port).wait(3))
+                received = [client2.read(block=True) for _ in msgs]
+                self.assertEqual(received, msgs, "Spooled messages should be delivered in order once the recipient connects.")
+            finally:
+                client1.stop()
+                client2.stop()
+                server.stop(block=True)
+
+    def test_c2c_credit(self):
+        client_id1  = uuid4()
+        client_key1 = key.generate()
+        client_id2  = uuid4()
+        client_key2 = key.generate()
+        client1 = BackboneClient(client_id1, client_key1)
+        client2 = BackboneClient(client_id2, client_key2)
+        port    = random.randint(40000, 50000)
+
+        with TemporaryDirectory() as tmp_path:
+            auth = IdentityComponent(state_dir=tmp_path)
+            auth.add_client_key(client_id1, client_key1.public_key())
+            auth.add_client_key(client_id2, client_key2.public_key())
+            server = BackboneServer(settings={ "port": port, "client": { "credit_window": 4 } }, identities=auth)
+
+            try:
+                server.start()
+                time.sleep(0.2)
+                self.assertTrue(client1.start("127.0.0.1", port).wait(3))
+                self.assertTrue(client2.start("127.0.0.1", port).wait(3))
+                # The handlers register their queues after the clients are ready:
+                time.sleep(0.2)
+
+                # Many more messages than the window, which should only get through as credit is returned:
+                msgs = [MsgC2C(client_id2, f'client1->client2 #{i}'.encode()) for i in range(50)]
+                for msg in msgs:
+                    client1.send(msg)
+                received = [client2.read(block=True) for _ in msgs]
+                self.assertEqual(received, msgs)
+            finally:
+                client1.stop()
+                client2.stop()
+                server.stop(block=True)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
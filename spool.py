@@ -0,0 +1,225 @@
+# spool.py
+# Disk-backed store for C2C messages addressed to clients that aren't connected. Messages are appended
+# to per-recipient segment files and replayed in order the next time the recipient connects.
+#
+# Layout: <spool_dir>/<client id hex>/<sequence number>.seg, where each segment is a sequence of
+# records. Segments are only ever appended to, and are deleted once their replay has been committed
+# or they fall outside the size/age limits.
+import os
+import struct
+import threading
+import time
+import uuid
+from typing import Iterator
+
+# Each record: size of the message (4 bytes) and the time it was spooled in epoch seconds (4 bytes),
+# followed by the message:
+_RECORD_HEADER = struct.Struct(">II")
+
+class Spool:
+    def __init__(self, spool_dir:str, segment_size:int=2**22, max_size:int=2**26, max_age:int=7*24*3600, accept=None) -> None:
+        self.spool_dir = spool_dir
+        # A new segment is started once the current one reaches segment_size bytes:
+        self.segment_size = segment_size
+        # Oldest segments are dropped once a recipient has more than max_size bytes spooled:
+        self.max_size = max_size
+        # Messages older than max_age seconds are dropped:
+        self.max_age = max_age
+        # Optional accept(client_id) -> bool, used to refuse messages for unknown recipients:
+        self.accept = accept
+
+        self._lock = threading.Lock()
+        # Segments per recipient (raw client ID), oldest first, each [sequence number, size, time of newest record]:
+        self._index = {}
+        self._next_sequence = {}
+
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        self._load_index()
+
+    # Stores a message for the client, returns False if it was refused.
+    def append(self, client_id:uuid.UUID, data:bytes) -> bool:
+        record_size = _RECORD_HEADER.size + len(data)
+        if record_size > self.max_size:
+            return False
+        if self.accept != None and not self.accept(client_id):
+            return False
+
+        key = client_id.bytes
+        now = int(time.time())
+        with self._lock:
+            if key not in self._index:
+                self._index[key] = []
+            segments = self._index[key]
+            if len(segments) == 0 or segments[-1][1] + record_size > self.segment_size:
+                if len(segments) == 0:
+                    os.makedirs(self._client_dir(key), exist_ok=True)
+                segments.append([self._take_sequence(key), 0, now])
+
+            segment = segments[-1]
+            with open(self._segment_path(key, segment[0]), 'ab') as f:
+                f.write(_RECORD_HEADER.pack(len(data), now) + bytes(data))
+            segment[1] += record_size
+            segment[2] = now
+
+            self._trim(key, segments, now)
+        return True
+
+    # Returns the messages spooled for the client, oldest first, see Replay.
+    def replay(self, client_id:uuid.UUID) -> "Replay":
+        return Replay(self, client_id.bytes)
+
+    # Returns True if there are messages spooled for the client.
+    def pending(self, client_id:uuid.UUID) -> bool:
+        with self._lock:
+            return client_id.bytes in self._index
+
+    # Returns the number of bytes spooled for the client.
+    def size(self, client_id:uuid.UUID) -> int:
+        with self._lock:
+            segments = self._index[client_id.bytes] if client_id.bytes in self._index else []
+            return sum(segment[1] for segment in segments)
+
+    # Drops the oldest segments until the recipient is within the size limit, as well as segments
+    # that only hold expired messages.
+    def _trim(self, key:bytes, segments:list, now:int):
+        total = sum(segment[1] for segment in segments)
+        while len(segments) > 1 and (total > self.max_size or segments[0][2] < now - self.max_age):
+            segment = segments.pop(0)
+            total -= segment[1]
+            try:
+                os.remove(self._segment_path(key, segment[0]))
+            except FileNotFoundError:
+                pass
+
+    # Puts segments that weren't fully replayed back in front of any that were added since.
+    def _restore(self, key:bytes, segments:list):
+        with self._lock:
+            if key in self._index:
+                segments = segments + self._index[key]
+            self._index[key] = segments
+
+    def _take_sequence(self, key:bytes) -> int:
+        sequence = self._next_sequence[key] if key in self._next_sequence else 0
+        self._next_sequence[key] = sequence + 1
+        return sequence
+
+    def _load_index(self):
+        with os.scandir(self.spool_dir) as entries:
+            for entry in entries:
+                try:
+                    key = uuid.UUID(hex=entry.name).bytes
+                except ValueError:
+                    continue
+
+                segments = []
+                with os.scandir(entry.path) as segment_entries:
+                    for segment_entry in segment_entries:
+                        name, ext = os.path.splitext(segment_entry.name)
+                        if ext != ".seg" or not name.isdigit():
+                            continue
+                        stat = segment_entry.stat()
+                        segments.append([int(name), stat.st_size, int(stat.st_mtime)])
+
+                if len(segments) > 0:
+                    segments.sort()
+                    self._index[key] = segments
+                    self._next_sequence[key] = segments[-1][0] + 1
+
+    def _client_dir(self, key:bytes) -> str:
+        return os.path.join(self.spool_dir, key.hex())
+
+    def _segment_path(self, key:bytes, sequence:int) -> str:
+        return os.path.join(self.spool_dir, key.hex(), f"{sequence:010d}.seg")
+
+
+# Iterates over the messages spooled for a client. Segments are only deleted by commit, once all of their
+# messages have been read, so the caller should commit after the messages it has read have been written.
+# Segments that haven't been committed when the replay is closed are kept and replayed again next time
+# (in whole, so messages may be replayed more than once but are never lost).
+class Replay:
+    def __init__(self, spool:Spool, key:bytes) -> None:
+        self._spool = spool
+        self._key = key
+        # Segments whose messages have all been read, waiting for commit:
+        self._read = []
+        # Segments taken from the index that haven't been read in full yet, the first is being read:
+        self._unread = []
+        self._finished = False
+        self._records = self._iterate()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> memoryview:
+        return next(self._records)
+
+    # Deletes the segments whose messages have all been read.
+    def commit(self):
+        spool, key = self._spool, self._key
+        for segment in self._read:
+            try:
+                os.remove(spool._segment_path(key, segment[0]))
+            except FileNotFoundError:
+                pass
+        self._read = []
+
+        if self._finished and len(self._unread) == 0:
+            with spool._lock:
+                if key not in spool._index:
+                    spool._next_sequence.pop(key, None)
+                    try:
+                        os.rmdir(spool._client_dir(key))
+                    except OSError:
+                        pass
+
+    # Puts back the segments that haven't been committed, so that they are replayed next time.
+    def close(self):
+        self._records.close()
+        segments = self._read + self._unread
+        self._read, self._unread = [], []
+        if len(segments) > 0:
+            self._spool._restore(self._key, segments)
+
+    def __del__(self):
+        self.close()
+
+    def _iterate(self) -> Iterator[memoryview]:
+        spool, key = self._spool, self._key
+        while True:
+            with spool._lock:
+                segments = spool._index.pop(key, None)
+            if segments == None:
+                self._finished = True
+                return
+            self._unread = segments
+
+            oldest = int(time.time()) - spool.max_age
+            while len(self._unread) > 0:
+                try:
+                    # Whole segments are read at once, rather than a read per message:
+                    with open(spool._segment_path(key, self._unread[0][0]), 'rb') as f:
+                        buffer = memoryview(f.read())
+                except FileNotFoundError:
+                    self._unread.pop(0)
+                    continue
+
+                records = []
+                offset = 0
+                while offset + _RECORD_HEADER.size <= len(buffer):
+                    size, spooled = _RECORD_HEADER.unpack_from(buffer, offset)
+                    offset += _RECORD_HEADER.size
+                    # A partially written record at the end of a segment is skipped:
+                    if offset + size > len(buffer):
+                        break
+                    if spooled >= oldest:
+                        records.append(buffer[offset:offset+size])
+                    offset += size
+
+                # The segment counts as read once its last message has been handed out, so that a commit
+                # following the write of that message deletes it:
+                for i in range(len(records) - 1):
+                    yield records[i]
+                self._read.append(self._unread.pop(0))
+                if len(records) > 0:
+                    yield records[-1]
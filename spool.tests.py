@@ -0,0 +1,107 @@
+import os
+import tempfile
+import unittest
+from uuid import uuid4
+
+from spool import Spool
+
+class TestSpool(unittest.TestCase):
+
+    def test_append_replay(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            spool = Spool(tmp_path, segment_size=64)
+            client_id = uuid4()
+            messages = [f"message #{i}".encode() for i in range(20)]
+            for msg in messages:
+                self.assertTrue(spool.append(client_id, msg))
+
+            self.assertTrue(spool.pending(client_id))
+            self.assertGreater(len(os.listdir(os.path.join(tmp_path, client_id.hex))), 1, "Messages should be split across several segments.")
+            replay = spool.replay(client_id)
+            self.assertEqual([bytes(data) for data in replay], messages)
+            self.assertFalse(spool.pending(client_id))
+            replay.commit()
+            self.assertFalse(os.path.exists(os.path.join(tmp_path, client_id.hex)), "Replayed segments should be removed.")
+            self.assertEqual(list(spool.replay(client_id)), [])
+
+    def test_limits(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            spool = Spool(tmp_path, segment_size=64, max_size=256)
+            client_id = uuid4()
+            messages = [f"message #{i:02}".encode() for i in range(50)]
+            for msg in messages:
+                spool.append(client_id, msg)
+
+            self.assertLessEqual(spool.size(client_id), 256)
+            replay = spool.replay(client_id)
+            replayed = [bytes(data) for data in replay]
+            replay.commit()
+            self.assertEqual(replayed, messages[-len(replayed):], "The oldest messages should be dropped first.")
+            self.assertFalse(spool.append(client_id, bytes(512)), "Messages larger than max_size should be refused.")
+
+            spool = Spool(tmp_path, accept=lambda client_id: False)
+            self.assertFalse(spool.append(client_id, b'refused'))
+            self.assertFalse(spool.pending(client_id))
+
+            spool = Spool(tmp_path, max_age=-1)
+            spool.append(client_id, b'expired')
+            self.assertEqual(list(spool.replay(client_id)), [], "Expired messages should not be replayed.")
+
+    def test_partial_replay(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            spool = Spool(tmp_path, segment_size=64)
+            client_id = uuid4()
+            messages = [f"message #{i}".encode() for i in range(10)]
+            for msg in messages:
+                spool.append(client_id, msg)
+
+            replay = spool.replay(client_id)
+            first = bytes(next(replay))
+            replay.close()
+            spool.append(client_id, b'new message')
+
+            replayed = [bytes(data) for data in spool.replay(client_id)]
+            self.assertEqual(first, messages[0])
+            self.assertEqual(replayed, messages + [b'new message'], "Segments that weren't fully replayed should be replayed again first.")
+
+    def test_uncommitted_replay(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            spool = Spool(tmp_path, segment_size=64)
+            client_id = uuid4()
+            messages = [f"message #{i}".encode() for i in range(10)]
+            for msg in messages:
+                spool.append(client_id, msg)
+            segment_count = len(os.listdir(os.path.join(tmp_path, client_id.hex)))
+
+            # Reading the first segment in full, then committing:
+            replay = spool.replay(client_id)
+            committed = []
+            while len(os.listdir(os.path.join(tmp_path, client_id.hex))) == segment_count:
+                committed.append(bytes(next(replay)))
+                replay.commit()
+            # The rest is read, but the replay is closed before it is committed (e.g. the connection failed):
+            self.assertEqual([bytes(data) for data in replay], messages[len(committed):])
+            replay.close()
+
+            self.assertTrue(spool.pending(client_id), "Segments that weren't committed should be kept.")
+            replay = spool.replay(client_id)
+            self.assertEqual([bytes(data) for data in replay], messages[len(committed):], "Segments that weren't committed should be replayed again.")
+            replay.commit()
+            self.assertFalse(os.path.exists(os.path.join(tmp_path, client_id.hex)))
+
+    def test_reload(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            client_id = uuid4()
+            messages = [f"message #{i}".encode() for i in range(10)]
+            spool = Spool(tmp_path, segment_size=64)
+            for msg in messages[:5]:
+                spool.append(client_id, msg)
+
+            # A new spool on the same directory should pick up where the old one left off:
+            spool = Spool(tmp_path, segment_size=64)
+            for msg in messages[5:]:
+                spool.append(client_id, msg)
+            self.assertEqual([bytes(data) for data in spool.replay(client_id)], messages)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
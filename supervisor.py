@@ -0,0 +1,108 @@
+# supervisor.py
+# Keeps track of the client handlers of a server. Handlers are added once their client has been
+# authenticated and are removed once they report that they are done (a DONE message on the server
+# queue), so that finished handlers and their routing entries don't pile up on a long-running server.
+import threading
+from uuid import UUID
+
+import handle
+import timer
+from handle import ClientHandler
+from message import BackboneMessageFormat as MsgFormat, BackboneS2SType as MsgS2SType
+
+class Supervisor:
+    def __init__(self, name:str="supervisor", report_interval:float=0) -> None:
+        self.name = name
+        # Time (in seconds) between reports of the handler counts, 0 disables reporting:
+        self.report_interval = report_interval
+        self.stop_flag = threading.Event()
+        self.thread = None
+
+        # Handlers keyed by the raw bytes of their client ID:
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._started = 0
+        self._finished = 0
+        self._report_timer = None
+
+    def start(self):
+        self.stop_flag.clear()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+        if self.report_interval > 0:
+            self._report_timer = timer.shared().schedule(self.report_interval, self._report)
+
+    def stop(self, block:bool=False):
+        self.stop_flag.set()
+        if self._report_timer != None:
+            self._report_timer.cancel()
+            self._report_timer = None
+        # Wake up the supervisor if it is waiting for a message:
+        handle.get_server_queue().put(None)
+        if block and self.thread:
+            self.thread.join()
+
+    def is_running(self) -> bool:
+        return self.thread != None and self.thread.is_alive()
+
+    # Starts the handler, unless its client is still connected through another handler.
+    # Returns False if the handler wasn't started.
+    def add(self, handler:ClientHandler) -> bool:
+        with self._lock:
+            existing = self._handlers.get(handler.id.bytes)
+            if handle.get_client_queue(handler.id) != None or (existing != None and existing.is_running()):
+                return False
+            if existing != None:
+                # The handler stopped but hasn't been reaped yet:
+                self._finished += 1
+                handle.release_routes(existing.client)
+            self._handlers[handler.id.bytes] = handler
+            self._started += 1
+            handler.start()
+        return True
+
+    # Returns the handlers that haven't been reaped yet.
+    def handlers(self) -> list[ClientHandler]:
+        with self._lock:
+            return list(self._handlers.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "handlers": len(self._handlers),
+                "started": self._started,
+                "finished": self._finished,
+                "routes": len(handle.routes)
+            }
+
+    def _run(self):
+        print(f"{self.name}: Supervisor started")
+        server_queue = handle.get_server_queue()
+        try:
+            while not self.stop_flag.is_set():
+                msg = server_queue.get()
+                if msg == None or msg.format != MsgFormat.S2S:
+                    continue
+
+                match msg.type:
+                    case MsgS2SType.DONE:
+                        if msg.payload == None or len(msg.payload) != 16:
+                            continue
+                        self._reap(UUID(bytes=msg.payload))
+        finally:
+            print(f"{self.name}: Supervisor stopped")
+
+    # Removes the client's handler, unless it has been replaced by one that is still running.
+    def _reap(self, client_id:UUID):
+        with self._lock:
+            handler = self._handlers.get(client_id.bytes)
+            if handler == None or handler.is_running():
+                return
+            del self._handlers[client_id.bytes]
+            self._finished += 1
+        handle.release_routes(handler.client)
+
+    def _report(self) -> float | None:
+        stats = self.stats()
+        print(f"{self.name}: {stats['handlers']} handlers ({stats['started']} started, {stats['finished']} finished), {stats['routes']} routes")
+        return self.report_interval
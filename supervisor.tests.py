@@ -0,0 +1,79 @@
+import time
+import unittest
+from uuid import uuid4
+
+import handle
+from identity import Identity
+from message import BackboneMessageS2S as MsgS2S, BackboneS2SType as MsgS2SType
+from supervisor import Supervisor
+
+# Stands in for a ClientHandler, running from start until finish:
+class TestHandler:
+    def __init__(self, client_id) -> None:
+        self.id = client_id
+        self.client = Identity(client_id, None)
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def finish(self):
+        self.running = False
+        handle.get_server_queue().put(MsgS2S(MsgS2SType.DONE, payload=self.id.bytes))
+
+    def is_running(self):
+        return self.running
+
+class TestSupervisor(unittest.TestCase):
+
+    def wait_for(self, supervisor:Supervisor, handlers:int):
+        deadline = time.monotonic() + 2
+        while supervisor.stats()["handlers"] != handlers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return supervisor.stats()
+
+    def test_reap(self):
+        supervisor = Supervisor()
+        supervisor.start()
+        try:
+            handlers = [TestHandler(uuid4()) for _ in range(10)]
+            for handler in handlers:
+                self.assertTrue(supervisor.add(handler))
+                self.assertTrue(handler.is_running(), "Handlers should be started when they are added.")
+            self.assertEqual(supervisor.stats()["handlers"], 10)
+
+            for handler in handlers[:5]:
+                handler.finish()
+            stats = self.wait_for(supervisor, 5)
+            self.assertEqual(stats["handlers"], 5, "Finished handlers should be removed.")
+            self.assertEqual(stats["started"], 10)
+            self.assertEqual(stats["finished"], 5)
+            self.assertEqual(set(supervisor.handlers()), set(handlers[5:]))
+        finally:
+            supervisor.stop(block=True)
+
+    def test_replace(self):
+        supervisor = Supervisor()
+        supervisor.start()
+        try:
+            client_id = uuid4()
+            first = TestHandler(client_id)
+            self.assertTrue(supervisor.add(first))
+            self.assertFalse(supervisor.add(TestHandler(client_id)), "A second handler should not be added while the first is running.")
+
+            # The first handler finishes, but the client reconnects before its DONE message is read:
+            first.running = False
+            second = TestHandler(client_id)
+            self.assertTrue(supervisor.add(second))
+            handle.get_server_queue().put(MsgS2S(MsgS2SType.DONE, payload=client_id.bytes))
+            time.sleep(0.1)
+            self.assertEqual(supervisor.handlers(), [second], "A stale DONE message should not remove the handler that replaced it.")
+            self.assertEqual(supervisor.stats()["finished"], 1)
+
+            second.finish()
+            self.assertEqual(self.wait_for(supervisor, 0)["finished"], 2)
+        finally:
+            supervisor.stop(block=True)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,135 @@
+# timer.py
+# Hashed timing wheel: one thread keeps track of every timeout (heartbeats, handshakes) and calls back
+# only when a deadline actually passes, instead of each connection waking up regularly to check.
+#
+# Deadlines are rounded up to the next tick and kept in the slot for that tick (modulo the number of
+# slots), so scheduling and cancelling are O(1) and each tick only looks at the timers in one slot.
+import threading
+import time
+
+class Timer:
+    def __init__(self, wheel, callback) -> None:
+        self._wheel = wheel
+        self._callback = callback
+        self._tick = None
+        self.cancelled = False
+
+    # Stops the timer, the callback won't be called after this returns (unless it is already running).
+    def cancel(self):
+        self._wheel._cancel(self)
+
+
+class TimingWheel:
+    def __init__(self, name:str="timer", tick:float=0.1, slots:int=512) -> None:
+        self.name = name
+        # Resolution (in seconds) of the wheel, callbacks may be called up to one tick late:
+        self.tick = tick
+        self.stop_flag = threading.Event()
+        self.thread = None
+
+        self._slots = [set() for _ in range(slots)]
+        self._lock = threading.Lock()
+        self._count = 0
+        self._start = time.monotonic()
+        # Last tick that has been processed:
+        self._current = 0
+        # Set when a timer is added, so that an idle wheel doesn't need to wake up every tick:
+        self._wakeup = threading.Event()
+
+    def start(self):
+        self.stop_flag.clear()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, block:bool=False):
+        self.stop_flag.set()
+        self._wakeup.set()
+        if block and self.thread:
+            self.thread.join()
+
+    def is_running(self) -> bool:
+        return self.thread != None and self.thread.is_alive()
+
+    # Calls callback() once delay seconds have passed. If the callback returns a number, the timer is
+    # scheduled again that many seconds later. This lets a timeout that is pushed back on every bit of
+    # activity be checked only when it might have expired, rather than rescheduled on every event.
+    def schedule(self, delay:float, callback) -> Timer:
+        timer = Timer(self, callback)
+        with self._lock:
+            self._add(timer, delay)
+        self._wakeup.set()
+        return timer
+
+    def _add(self, timer:Timer, delay:float):
+        # Round up, so callbacks are never made early:
+        tick = max(self._current + 1, -int(-(time.monotonic() - self._start + delay) // self.tick))
+        timer._tick = tick
+        self._slots[tick % len(self._slots)].add(timer)
+        self._count += 1
+
+    def _cancel(self, timer:Timer):
+        with self._lock:
+            timer.cancelled = True
+            if timer._tick == None:
+                return
+            slot = self._slots[timer._tick % len(self._slots)]
+            if timer in slot:
+                slot.remove(timer)
+                self._count -= 1
+            timer._tick = None
+
+    def _run(self):
+        try:
+            while not self.stop_flag.is_set():
+                with self._lock:
+                    idle = self._count == 0
+                    self._wakeup.clear()
+                if idle:
+                    self._wakeup.wait()
+                    continue
+
+                now_tick = int((time.monotonic() - self._start) / self.tick)
+                while self._current < now_tick:
+                    self._current += 1
+                    self._expire(self._current)
+
+                self.stop_flag.wait(max(0, self._start + (self._current + 1) * self.tick - time.monotonic()))
+        finally:
+            print(f"{self.name}: Timer stopped")
+
+    def _expire(self, tick:int):
+        with self._lock:
+            slot = self._slots[tick % len(self._slots)]
+            # Timers further than one revolution away share the slot, but aren't due yet:
+            expired = [timer for timer in slot if timer._tick <= tick]
+            for timer in expired:
+                slot.remove(timer)
+                timer._tick = None
+            self._count -= len(expired)
+
+        for timer in expired:
+            if timer.cancelled:
+                continue
+            try:
+                delay = timer._callback()
+            except Exception as e:
+                print(f"{self.name}: Unexpected exception in timer callback {timer._callback}: {e}")
+                continue
+
+            if delay != None:
+                with self._lock:
+                    if not timer.cancelled:
+                        self._add(timer, delay)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+# Returns the timing wheel shared by all connections in the process, starting it on first use.
+def shared() -> TimingWheel:
+    global _shared
+    with _shared_lock:
+        if _shared == None or not _shared.is_running():
+            _shared = TimingWheel(name="shared-timer")
+            _shared.start()
+        return _shared
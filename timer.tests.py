@@ -0,0 +1,55 @@
+import threading
+import time
+import unittest
+
+from timer import TimingWheel
+
+class TestTimingWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimingWheel(tick=0.01, slots=8)
+        self.wheel.start()
+
+    def tearDown(self):
+        self.wheel.stop(block=True)
+
+    def test_schedule(self):
+        fired = threading.Event()
+        start = time.monotonic()
+        self.wheel.schedule(0.05, lambda: fired.set())
+        self.assertTrue(fired.wait(2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05, "Callbacks should never be made early.")
+
+    def test_cancel(self):
+        fired = threading.Event()
+        timer = self.wheel.schedule(0.05, lambda: fired.set())
+        timer.cancel()
+        self.assertTrue(timer.cancelled)
+        self.assertFalse(fired.wait(0.2), "Cancelled timers should not call back.")
+
+    def test_reschedule(self):
+        calls = []
+        done = threading.Event()
+        def callback():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                return 0.02
+            done.set()
+            return None
+
+        self.wheel.schedule(0.02, callback)
+        self.assertTrue(done.wait(2))
+        time.sleep(0.1)
+        self.assertEqual(len(calls), 3, "The timer should stop once the callback returns None.")
+
+    def test_long_delay(self):
+        # Longer than one revolution of the wheel (8 slots * 0.01s), so the timer shares a slot with earlier ticks:
+        fired = threading.Event()
+        start = time.monotonic()
+        self.wheel.schedule(0.25, lambda: fired.set())
+        self.assertFalse(fired.wait(0.15), "Timers should not fire on an earlier revolution of the wheel.")
+        self.assertTrue(fired.wait(2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
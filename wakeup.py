@@ -0,0 +1,69 @@
+# wakeup.py
+# Lets threads that block on a socket, selector or queue be woken as soon as there is something for
+# them to do (e.g. stop), instead of waking up regularly to check.
+import socket
+import threading
+
+# Self-pipe that can be waited on alongside sockets. A socket pair is used rather than os.pipe,
+# since select only accepts sockets on Windows.
+class Waker:
+    def __init__(self) -> None:
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+
+    def fileno(self) -> int:
+        return self._reader.fileno()
+
+    def wake(self):
+        try:
+            self._writer.send(b'\0')
+        except OSError:
+            # The buffer is full (so the waiting thread will wake up anyway) or the waker has been closed.
+            pass
+
+    # Empties the pipe, call this once woken up.
+    def clear(self):
+        try:
+            while self._reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+# Event that calls back when it is set, so that threads blocked on something other than the event
+# itself can be woken up when it is time to stop.
+class StopFlag(threading.Event):
+    def __init__(self) -> None:
+        super().__init__()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    # Calls callback() once the flag is set, or right away if it already is. Callbacks are only called once,
+    # those that are no longer needed before then should be removed.
+    def on_set(self, callback):
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove(self, callback):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def set(self):
+        with self._callbacks_lock:
+            super().set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Unexpected exception in stop callback {callback}: {e}")
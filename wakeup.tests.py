@@ -0,0 +1,45 @@
+import select
+import threading
+import unittest
+
+from wakeup import StopFlag, Waker
+
+class TestWakeup(unittest.TestCase):
+
+    def test_waker(self):
+        waker = Waker()
+        try:
+            self.assertEqual(select.select([waker], [], [], 0)[0], [])
+            waker.wake()
+            waker.wake()
+            self.assertEqual(select.select([waker], [], [], 1)[0], [waker])
+            waker.clear()
+            self.assertEqual(select.select([waker], [], [], 0)[0], [], "The waker should not be readable once cleared.")
+        finally:
+            waker.close()
+
+    def test_stop_flag(self):
+        stop_flag = StopFlag()
+        calls = []
+        stop_flag.on_set(lambda: calls.append("first"))
+        removed = lambda: calls.append("removed")
+        stop_flag.on_set(removed)
+        stop_flag.remove(removed)
+        self.assertEqual(calls, [])
+
+        stop_flag.set()
+        self.assertTrue(stop_flag.is_set())
+        self.assertEqual(calls, ["first"], "Callbacks should be called once the flag is set, unless they were removed.")
+        stop_flag.set()
+        self.assertEqual(calls, ["first"], "Callbacks should only be called once.")
+
+        stop_flag.on_set(lambda: calls.append("late"))
+        self.assertEqual(calls, ["first", "late"], "Callbacks added after the flag is set should be called right away.")
+
+    def test_stop_flag_wait(self):
+        stop_flag = StopFlag()
+        threading.Timer(0.05, stop_flag.set).start()
+        self.assertTrue(stop_flag.wait(2), "The flag should still work as an event.")
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)